@@ -0,0 +1,81 @@
+"""Benchmark of position payload formats.
+
+Compares serialization time and size of the gzip JSON snapshot (next.json.gz), JSON
+frames (frames.json.gz) and binary PositionCodec frames, on synthetic trajectories.
+Run from process-live-data: `python -m benchmarks.bench_position_formats [n_vehicles]`.
+"""
+import gzip
+import json
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from src.PositionCodec import PositionCodec
+from src.PositionPublisher import PositionPublisher
+from src.TickEngine import TickEngine
+from src.Trajectories import Trajectories
+
+
+def generate_tick_engine(n_vehicles, n_samples=50, seed=0):
+    rng = np.random.default_rng(seed)
+    timestamps = [np.sort(rng.uniform(0, 3600, n_samples)) for _ in range(n_vehicles)]
+    coords = [np.column_stack([rng.uniform(2.2, 2.5, n_samples), rng.uniform(48.8, 48.9, n_samples)])
+              for _ in range(n_vehicles)]
+    trips = pd.DataFrame({
+        'id': [f"RATP-SIV:VehicleJourney::{rng.integers(10 ** 9)}_{rng.integers(10 ** 5)}:LOC"
+               for _ in range(n_vehicles)],
+        'line_short_id': [f"C0{1000 + i % 300}" for i in range(n_vehicles)],
+        'name': [f"{chr(65 + i % 26)}{chr(65 + i % 7)}RO" for i in range(n_vehicles)],
+        'destination_id': [str(40000 + i % 500) for i in range(n_vehicles)],
+    })
+    return TickEngine.from_lines({'L': (trips, Trajectories.from_arrays(timestamps, coords))})
+
+
+def serialize_json_snapshot(tick_engine, start):
+    return gzip.compress(json.dumps(tick_engine.get_vehicles(start)).encode('utf-8'))
+
+
+def serialize_json_frame(publisher, tick_engine, start):
+    keys, ticks, _ = publisher.get_frame_arrays(tick_engine, start)
+    return gzip.compress(json.dumps(publisher.build_frame(start, keys, ticks)).encode('utf-8'))
+
+
+def serialize_binary_snapshot(publisher, tick_engine, start):
+    active, x, y = tick_engine.get_positions(start)
+    keys = {k: tick_engine.metadata[k][active] for k in PositionCodec.KEYS}
+    payload = PositionCodec.encode(start, publisher.resolution, keys, [(np.arange(len(active)), x, y)])
+    return gzip.compress(payload, compresslevel=publisher.BINARY_COMPRESSION_LEVEL)
+
+
+def serialize_binary_frame(publisher, tick_engine, start):
+    keys, ticks, _ = publisher.get_frame_arrays(tick_engine, start)
+    payload = PositionCodec.encode(start, publisher.resolution, keys, ticks)
+    return gzip.compress(payload, compresslevel=publisher.BINARY_COMPRESSION_LEVEL)
+
+
+if __name__ == '__main__':
+    n_vehicles = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    tick_engine = generate_tick_engine(n_vehicles)
+    publisher = PositionPublisher(horizon=120, resolution=10)
+    start = 1800
+    print(f"{n_vehicles} vehicles, frames of {publisher.horizon} seconds at {publisher.resolution} seconds per tick.")
+
+    formats = [
+        ('next.json.gz', lambda: serialize_json_snapshot(tick_engine, start)),
+        ('next.bin.gz', lambda: serialize_binary_snapshot(publisher, tick_engine, start)),
+        ('frames.json.gz', lambda: serialize_json_frame(publisher, tick_engine, start)),
+        ('frames.bin.gz', lambda: serialize_binary_frame(publisher, tick_engine, start)),
+    ]
+    for name, serialize in formats:
+        size = len(serialize())
+        best = min(timeit.repeat(serialize, number=1, repeat=5))
+        print(f"{name:>16}: {1000 * best:8.1f} ms, {size / 1024:8.1f} kB")
+
+    # Check that the reference decoder reads back the frame
+    keys, ticks, _ = publisher.get_frame_arrays(tick_engine, start)
+    frame = PositionCodec.decode(PositionCodec.encode(start, publisher.resolution, keys, ticks))
+    error = max((np.abs(np.array(t['x']) - x).max() for t, (_, x, _) in zip(frame['ticks'], ticks) if len(x)), default=0)
+    assert frame['keys']['id'] == keys['id'].tolist(), "Decoded key table differs"
+    print(f"Decoded frame matches, max longitude error {error:.2e} degrees.")
@@ -0,0 +1,114 @@
+"""Benchmark of shortest path computation on line graphs.
+
+Compares, per line, hop-count all pairs shortest paths (nx.shortest_path, as computed
+before), length-weighted networkx Dijkstra from start stops, and RailGraph (CSR graph and
+scipy Dijkstra with cached predecessor trees), on synthetic lines with branches and loops.
+Also counts consecutive stops where the hop-count path is longer than the shortest one.
+Run from process-live-data: `python -m benchmarks.bench_rail_graph [n_lines] [n_segments]`.
+"""
+import sys
+import time
+
+import geopandas as gpd
+import momepy
+import networkx as nx
+import numpy as np
+from shapely import LineString
+
+from src.RailGraph import RailGraph
+from src.Utils import Utils
+
+
+def generate_line(n_segments, n_branches=3, seed=0):
+    """Return (momepy primal graph, list of stop node indices per branch) of a synthetic line."""
+    rng = np.random.default_rng(seed)
+    per_branch = n_segments // (n_branches + 1)
+    segments = []
+    branches = []
+    start = np.array([2.35, 48.85])
+    for branch in range(n_branches + 1):
+        # Branches start from the middle of the trunk, with irregular segment lengths
+        angle = rng.uniform(0, 2 * np.pi)
+        steps = rng.uniform(0.0002, 0.002, per_branch)[:, None] * np.array([np.cos(angle), np.sin(angle)])
+        origin = start if branch == 0 else branches[0][len(branches[0]) // 2]
+        points = np.vstack([origin, origin + np.cumsum(steps + rng.normal(0, 0.0001, steps.shape), axis=0)])
+        points = np.round(points, 7)
+        branches.append(points)
+        segments += [LineString(points[i:i + 2]) for i in range(len(points) - 1)]
+
+        # Long detour between two stops, shorter than the branch by hop count
+        step = max(1, len(points) // 20)
+        detour = np.array([points[2 * step], points[2 * step] + [0.03, 0.03], points[3 * step]])
+        segments.append(LineString(detour))
+
+    G = momepy.gdf_to_nx(gpd.GeoDataFrame(geometry=segments, crs=4326), approach='primal')
+    nodes = {node: i for i, node in enumerate(G.nodes)}
+    stops = [[nodes[tuple(p)] for p in points[::max(1, len(points) // 20)]] for points in branches]
+    return G, stops
+
+
+def get_consecutive_pairs(stops):
+    pairs = set()
+    for branch in stops:
+        pairs |= set(zip(branch[:-1], branch[1:])) | set(zip(branch[1:], branch[:-1]))
+    return sorted(pairs)
+
+
+def path_length(rail_graph, path):
+    return sum(rail_graph.matrix[a, b] for a, b in zip(path[:-1], path[1:]))
+
+
+def bench_line(G, stops):
+    nodes = list(G.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    pairs = get_consecutive_pairs(stops)
+    all_stops = sorted(set(s for branch in stops for s in branch))
+    results = {}
+
+    t = time.perf_counter()
+    # Recent networkx versions return an iterator of (source, paths)
+    shortest_paths = dict(nx.shortest_path(G))
+    hop_paths = {(a, b): [index[n] for n in shortest_paths[nodes[a]][nodes[b]]] for a, b in pairs}
+    results['hop count, all pairs'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for u, v, data in G.edges(data=True):
+        data['length'] = Utils.get_linestring_length_in_meters(data['geometry'])
+    nx_paths = {}
+    for source in set(a for a, b in pairs):
+        paths = nx.single_source_dijkstra_path(G, nodes[source], weight='length')
+        nx_paths.update({(a, b): paths[nodes[b]] for a, b in pairs if a == source})
+    results['networkx Dijkstra, start stops'] = time.perf_counter() - t
+
+    t = time.perf_counter()
+    rail_graph = RailGraph.from_networkx(G)
+    rail_graph.compute([a for a, b in pairs])
+    rail_paths = {(a, b): rail_graph.get_path(a, b) for a, b in pairs}
+    results['RailGraph, start stops'] = time.perf_counter() - t
+
+    # Same lengths with both Dijkstra implementations
+    for a, b in pairs:
+        assert abs(rail_graph.get_distance(a, b) - path_length(rail_graph, [index[n] for n in nx_paths[(a, b)]])) < 1
+
+    longer = sum(path_length(rail_graph, hop_paths[pair]) > path_length(rail_graph, rail_paths[pair]) + 1
+                 for pair in pairs)
+    return results, len(pairs), len(all_stops), longer
+
+
+if __name__ == '__main__':
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    n_segments = int(sys.argv[2]) if len(sys.argv) > 2 else 800
+
+    totals = {}
+    for seed in range(n_lines):
+        G, stops = generate_line(n_segments, seed=seed)
+        results, n_pairs, n_stops, longer = bench_line(G, stops)
+        print(f"Line {seed}: {G.number_of_nodes()} nodes, {G.number_of_edges()} edges, {n_stops} stops, "
+              f"{n_pairs} consecutive pairs ({longer} longer by hop count).")
+        for name, duration in results.items():
+            print(f"    {name:<32} {1000 * duration:8.1f} ms")
+            totals[name] = totals.get(name, 0) + duration
+
+    print("Mean build time per line:")
+    for name, duration in totals.items():
+        print(f"    {name:<32} {1000 * duration / n_lines:8.1f} ms")
@@ -0,0 +1,79 @@
+"""Micro-benchmark of stop-monitoring payload parsing.
+
+Compares PRIM_API.parse_trip_json (list of dicts) with SIRIParser (columnar buffers),
+both producing the trips dataframe of a line.
+
+Payloads are recorded by setting "prim_record_dir" in settings.json (files are named
+{line_short_id}_{stop_short_id}_{timestamp}.json). Without recordings, synthetic payloads
+are generated. Run from process-live-data: `python -m benchmarks.bench_siri_parser [dir]`.
+"""
+import glob
+import json
+import os
+import sys
+import time
+import timeit
+
+import pandas as pd
+
+from fake_prim_server import build_stop_visit
+from src.PRIM_API import PRIM_API
+from src.SIRIParser import SIRIParser, TripColumns
+
+
+def load_recorded_payloads(directory):
+    payloads = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        line_short_id, stop_short_id = os.path.basename(path).split('_')[:2]
+        # Skip estimated-timetable payloads of whole lines
+        if stop_short_id == 'line':
+            continue
+        with open(path, 'rb') as f:
+            payloads.append((f.read(), stop_short_id, line_short_id))
+    return payloads
+
+
+def generate_payloads(n_stops=500, n_visits=8, line_short_id='C01742'):
+    now = time.time()
+    payloads = []
+    for stop in range(n_stops):
+        visits = [build_stop_visit(line_short_id, str(stop), f"FAKE:{line_short_id}:{stop}:{i}", now + 120 * i, now)
+                  for i in range(n_visits)]
+        body = json.dumps({'Siri': {'ServiceDelivery': {'StopMonitoringDelivery': [{'MonitoredStopVisit': visits}]}}})
+        payloads.append((body.encode(), str(stop), line_short_id))
+    return payloads
+
+
+def parse_legacy(payloads):
+    trips = []
+    for body, stop_short_id, line_short_id in payloads:
+        visits = json.loads(body)['Siri']['ServiceDelivery']['StopMonitoringDelivery'][0]['MonitoredStopVisit']
+        trips += [PRIM_API.parse_trip_json(visit, stop_short_id, line_short_id) for visit in visits]
+    return pd.DataFrame.from_dict([t for t in trips if t is not None])
+
+
+def parse_columnar(payloads):
+    columns = TripColumns()
+    for body, stop_short_id, line_short_id in payloads:
+        SIRIParser.parse_stop_monitoring(body, stop_short_id, line_short_id, columns)
+    return columns.to_dataframe()
+
+
+if __name__ == '__main__':
+    directory = sys.argv[1] if len(sys.argv) > 1 else os.path.join('data', 'recorded_payloads')
+    payloads = load_recorded_payloads(directory)
+    source = f"{len(payloads)} recorded payloads from {directory}"
+    if len(payloads) == 0:
+        payloads = generate_payloads()
+        source = f"{len(payloads)} synthetic payloads"
+
+    n_bytes = sum(len(p[0]) for p in payloads)
+    print(f"Parsing {source} ({n_bytes / 1024:.0f} kB).")
+
+    n_rows = len(parse_columnar(payloads))
+    assert n_rows == len(parse_legacy(payloads)), "Parsers do not return the same number of trips"
+
+    for name, parse in [('parse_trip_json', parse_legacy), ('SIRIParser', parse_columnar)]:
+        durations = timeit.repeat(lambda: parse(payloads), number=1, repeat=5)
+        best = min(durations)
+        print(f"{name:>16}: {1000 * best:8.1f} ms, {1e6 * best / max(1, n_rows):6.2f} us/row ({n_rows} rows)")
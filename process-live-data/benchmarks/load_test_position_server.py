@@ -0,0 +1,114 @@
+"""Load test of the position server (src/PositionServer.py).
+
+Opens many WebSocket clients subscribed to random bounding boxes (or lines) and reports
+messages, bytes and delivery delay per tick. Without --url, a local server is started in
+the same process with synthetic vehicles moving around Paris, updated every --period seconds.
+
+Run from process-live-data: `python -m benchmarks.load_test_position_server --clients 2000`.
+"""
+import argparse
+import asyncio
+import json
+import struct
+import time
+
+import aiohttp
+import numpy as np
+
+from benchmarks.bench_position_formats import generate_tick_engine
+from src.PositionServer import PositionServer
+
+
+# Time of the last update of the local server, used to measure delivery delay
+last_update = [time.time()]
+
+
+class LoadStats:
+    def __init__(self):
+        self.connected = 0
+        self.messages = 0
+        self.bytes = 0
+        self.delays = []
+
+
+async def run_client(session, url, subscription, stats, duration):
+    async with session.ws_connect(url, heartbeat=30) as ws:
+        stats.connected += 1
+        await ws.send_str(json.dumps(subscription))
+        end = time.time() + duration
+        while time.time() < end:
+            try:
+                msg = await ws.receive(timeout=max(0.1, end - time.time()))
+            except asyncio.TimeoutError:
+                break
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                continue
+            stats.messages += 1
+            stats.bytes += len(msg.data)
+            stats.delays.append(time.time() - last_update[0])
+            # Group key is only parsed to check framing
+            (length,) = struct.unpack_from('<H', msg.data, 0)
+            msg.data[2:2 + length].decode('utf-8')
+
+
+def get_random_subscription(rng):
+    # Viewports of about 5 to 15 km around Paris, or a few lines
+    if rng.random() < 0.8:
+        lon, lat = rng.uniform(2.2, 2.5), rng.uniform(48.8, 48.9)
+        size = rng.uniform(0.05, 0.15)
+        return {'bbox': [lon - size, lat - size / 2, lon + size, lat + size / 2]}
+    return {'lines': [f"C0{1000 + i}" for i in rng.choice(300, 3, replace=False)]}
+
+
+async def update_forever(server, tick_engine, period):
+    start = 1800
+    while True:
+        await asyncio.sleep(period)
+        t = time.perf_counter()
+        last_update[0] = time.time()
+        await server.update(tick_engine, start + (time.time() % 1800))
+        print(f"Server update in {1000 * (time.perf_counter() - t):.1f} ms, {server.get_server_stats()}")
+
+
+async def main(args):
+    rng = np.random.default_rng(0)
+    url = args.url
+    updater = None
+    runner = None
+    if url is None:
+        server = PositionServer(zoom=args.zoom)
+        tick_engine = generate_tick_engine(args.vehicles)
+        runner = await server.start('127.0.0.1', args.port)
+        updater = asyncio.create_task(update_forever(server, tick_engine, args.period))
+        url = f"http://127.0.0.1:{args.port}/ws"
+
+    stats = LoadStats()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        clients = [run_client(session, url, get_random_subscription(rng), stats, args.duration)
+                   for _ in range(args.clients)]
+        results = await asyncio.gather(*clients, return_exceptions=True)
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    if updater is not None:
+        updater.cancel()
+        await runner.cleanup()
+
+    delays = np.array(stats.delays) if stats.delays else np.zeros(1)
+    print(f"{stats.connected}/{args.clients} clients connected ({len(errors)} errors), "
+          f"{stats.messages} messages, {stats.bytes / 1024 ** 2:.1f} MB received in {args.duration} s.")
+    if updater is not None:
+        print(f"Delivery delay after update: median {1000 * np.median(delays):.0f} ms, "
+              f"p99 {1000 * np.percentile(delays, 99):.0f} ms.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default=None, help="WebSocket URL of a running server (default: local server)")
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30, help="seconds")
+    parser.add_argument('--vehicles', type=int, default=5000, help="synthetic vehicles of the local server")
+    parser.add_argument('--period', type=float, default=5, help="seconds between updates of the local server")
+    parser.add_argument('--zoom', type=int, default=11)
+    parser.add_argument('--port', type=int, default=8765)
+    asyncio.run(main(parser.parse_args()))
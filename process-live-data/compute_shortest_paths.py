@@ -1,5 +1,19 @@
+"""Precompute shortest paths between stops of every rail line (metro, RER, train, tramway).
+
+Lines are built in parallel in a process pool. Paths of a line are saved to
+data/shortest_paths/<line_short_id>.parquet (or .gpkg with --pairs all) and recorded in
+data/shortest_paths/manifest.json with a hash of their inputs (line geometry, stops,
+consecutive stops and build settings): lines whose inputs did not change since their last
+successful build are skipped, so an interrupted build resumes where it stopped.
+
+Run from process-live-data: `python compute_shortest_paths.py [--lines "METRO 10" "RER C"] [--workers 8]`.
+"""
 import os
 import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import geopandas as gpd
 import pandas as pd
@@ -7,103 +21,182 @@ import networkx as nx
 import momepy
 import numpy as np
 
-from shapely import LineString, Point, MultiPoint
-from shapely.ops import nearest_points, linemerge
+import shapely
+from shapely import LineString, MultiPoint
+from shapely.ops import nearest_points
 
 from itertools import combinations
-import random
 from hashlib import md5
 
 from src.PRIM_API import PRIM_API
+from src.RailGraph import RailGraph
+from src.Snapper import Snapper
 from src.Utils import Utils
 
-# Load settings from settings.json
-with open('settings.json', 'r') as json_file:
-    settings_data = json.load(json_file)
-
-prim = PRIM_API(api_key=settings_data["prim_api_key"])
-
-# Download railroad network and stops database
-if not os.path.exists(prim.NETWORK_DATA_FILE_PATH):
-    print("Download network data.")
-    prim.download_network()
-if not os.path.exists(prim.STOPS_DATA_FILE_PATH):
-    print("Download stops data.")
-    prim.download_stops()
-
-# Load railroad network and get relevant fields
-print("Loading networks...")
-with open(prim.NETWORK_DATA_FILE_PATH, 'r') as data:
-    network_df = pd.json_normalize(json.load(data))
-
-network_relevant_fields = {
-    "fields.idrefligc": 'id',
-    "fields.geo_shape.coordinates": 'geometry',
-    "fields.res_com": 'name',
-    "fields.exploitant": 'company',
-    "fields.mode": 'transportation_type',
-    "fields.colourweb_hexa": 'color',
-    "fields.idf": 'in_idf',
-    "fields.picto_final": 'picture_url'
-}
-network_df = network_df[list(network_relevant_fields.keys())]
-network_df = network_df.rename(columns=network_relevant_fields)
-network_df = network_df[network_df.transportation_type.isin(
-    ['TRAMWAY', 'RER', 'METRO', 'TRAIN'])]
-network_df.geometry = network_df.geometry.apply(lambda x: LineString(x))
-network_df = gpd.GeoDataFrame(network_df, geometry='geometry')
-
-print("Network loaded as a GeoDataFrame.")
-
-# Load stop database and get relevant fields
-print("Loading stops...")
-with open(prim.STOPS_DATA_FILE_PATH, 'r') as data:
-    stops_df = pd.json_normalize(json.load(data))
-
-stops_relevant_fields = {
-    "fields.stop_id": 'id',
-    "fields.stop_lon": 'longitude',
-    "fields.stop_lat": 'latitude',
-    "fields.stop_name": 'name',
-    "fields.id": 'line_id',
-    "fields.operatorname": 'company',
-}
-stops_df = stops_df[list(stops_relevant_fields.keys())]
-stops_df = stops_df.rename(columns=stops_relevant_fields)
-
-# Match line ID format with network dataframe
-stops_df['line_id'] = stops_df['line_id'].apply(lambda x: x.split(":")[-1])
-
-# Remove prefix from stop ID
-stops_df['short_id'] = stops_df['id'].apply(lambda x: x.split(":")[-1])
-
-# Only use stops of railroad network (metro, train, tramway)
-stops_df = stops_df[stops_df.line_id.isin(network_df.id)]
-stops_df = gpd.GeoDataFrame(stops_df, geometry=gpd.points_from_xy(
-    stops_df.longitude, stops_df.latitude))
-
-print("Stops loaded as a GeoDataFrame.")
-
-# Iterate over each line
-# line_names = sorted(list(set(network_df.name.values)))
-# line_names = ['METRO 1', 'RER C']
-line_names = ['METRO 10']
-
-for name in line_names:
-    print(f"\n-------\nComputing data for {name}.")
-    line = network_df[network_df.name == name].copy()
-    line_id = line.id.iloc[0]
-    transportation_type = line.transportation_type.iloc[0]
-    line_stops = stops_df[stops_df.line_id == line_id].copy()
-
+SAVE_DIRECTORY = os.path.join('data', 'shortest_paths')
+MANIFEST_FILE_PATH = os.path.join(SAVE_DIRECTORY, 'manifest.json')
+CONSECUTIVE_STOPS_FILE_PATH = os.path.join(SAVE_DIRECTORY, 'consecutive_stops.parquet')
+
+# Changing how paths are built must invalidate previous builds
+BUILD_VERSION = 2
+
+
+def load_network(prim):
+    # Load railroad network and get relevant fields
+    print("Loading networks...")
+    with open(prim.NETWORK_DATA_FILE_PATH, 'r') as data:
+        network_df = pd.json_normalize(json.load(data))
+
+    network_relevant_fields = {
+        "fields.idrefligc": 'id',
+        "fields.geo_shape.coordinates": 'geometry',
+        "fields.res_com": 'name',
+        "fields.exploitant": 'company',
+        "fields.mode": 'transportation_type',
+        "fields.colourweb_hexa": 'color',
+        "fields.idf": 'in_idf',
+        "fields.picto_final": 'picture_url'
+    }
+    network_df = network_df[list(network_relevant_fields.keys())]
+    network_df = network_df.rename(columns=network_relevant_fields)
+    network_df = network_df[network_df.transportation_type.isin(
+        ['TRAMWAY', 'RER', 'METRO', 'TRAIN'])]
+    network_df.geometry = network_df.geometry.apply(lambda x: LineString(x))
+    network_df = gpd.GeoDataFrame(network_df, geometry='geometry')
+
+    print("Network loaded as a GeoDataFrame.")
+    return network_df
+
+
+def load_stops(prim, network_df):
+    # Load stop database and get relevant fields
+    print("Loading stops...")
+    with open(prim.STOPS_DATA_FILE_PATH, 'r') as data:
+        stops_df = pd.json_normalize(json.load(data))
+
+    stops_relevant_fields = {
+        "fields.stop_id": 'id',
+        "fields.stop_lon": 'longitude',
+        "fields.stop_lat": 'latitude',
+        "fields.stop_name": 'name',
+        "fields.id": 'line_id',
+        "fields.operatorname": 'company',
+    }
+    stops_df = stops_df[list(stops_relevant_fields.keys())]
+    stops_df = stops_df.rename(columns=stops_relevant_fields)
+
+    # Match line ID format with network dataframe
+    stops_df['line_id'] = stops_df['line_id'].apply(lambda x: x.split(":")[-1])
+
+    # Remove prefix from stop ID
+    stops_df['short_id'] = stops_df['id'].apply(lambda x: x.split(":")[-1])
+
+    # Only use stops of railroad network (metro, train, tramway)
+    stops_df = stops_df[stops_df.line_id.isin(network_df.id)]
+    stops_df = gpd.GeoDataFrame(stops_df, geometry=gpd.points_from_xy(
+        stops_df.longitude, stops_df.latitude))
+
+    print("Stops loaded as a GeoDataFrame.")
+    return stops_df
+
+
+def get_consecutive_stop_pairs(prim, line_short_ids):
+    """Return (line_short_id, short_id_start, short_id_end) of consecutive stops in trips of the GTFS timetable."""
+    trips = pd.read_csv(os.path.join(prim.STATIC_GTFS_PATH, 'trips.txt'),
+                        usecols=['trip_id', 'route_id'], dtype=str)
+    trips['line_short_id'] = trips['route_id'].map(Utils.compute_short_id)
+    trips = trips[trips.line_short_id.isin(line_short_ids)]
+
+    # Timetable of every line (including buses) does not fit in memory, only keep trips of the lines
+    chunks = pd.read_csv(os.path.join(prim.STATIC_GTFS_PATH, 'stop_times.txt'),
+                         usecols=['trip_id', 'stop_id', 'stop_sequence'],
+                         dtype={'trip_id': str, 'stop_id': str, 'stop_sequence': int},
+                         chunksize=1_000_000)
+    stop_times = pd.concat([chunk[chunk.trip_id.isin(trips.trip_id)] for chunk in chunks])
+    stop_times = stop_times.merge(trips[['trip_id', 'line_short_id']], on='trip_id')
+    stop_times = stop_times.sort_values(['trip_id', 'stop_sequence'])
+    stop_times['short_id'] = stop_times['stop_id'].map(Utils.compute_short_id)
+
+    trip_ids = stop_times.trip_id.values
+    short_ids = stop_times.short_id.values
+    consecutive = (trip_ids[:-1] == trip_ids[1:]) & (short_ids[:-1] != short_ids[1:])
+    pairs = pd.DataFrame({'line_short_id': stop_times.line_short_id.values[:-1][consecutive],
+                          'short_id_start': short_ids[:-1][consecutive],
+                          'short_id_end': short_ids[1:][consecutive]})
+    return pairs.drop_duplicates().reset_index(drop=True)
+
+
+def get_gtfs_signature(prim):
+    # Size and modification time of timetable files
+    signature = []
+    for file_name in ('trips.txt', 'stop_times.txt'):
+        stat = os.stat(os.path.join(prim.STATIC_GTFS_PATH, file_name))
+        signature.append([file_name, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def load_consecutive_stop_pairs(prim, manifest, line_short_ids):
+    """Return consecutive stops of lines, only read from the GTFS timetable when it changed since the last build."""
+    if not os.path.exists(prim.STATIC_GTFS_PATH):
+        print("Download static GTFS data.")
+        prim.download_static_gtfs()
+
+    signature = get_gtfs_signature(prim)
+    if manifest.get('gtfs') == [signature, sorted(line_short_ids)] and os.path.exists(CONSECUTIVE_STOPS_FILE_PATH):
+        print("Loading consecutive stops of previous build...")
+        return pd.read_parquet(CONSECUTIVE_STOPS_FILE_PATH)
+
+    print("Loading consecutive stops from GTFS timetable...")
+    pairs = get_consecutive_stop_pairs(prim, line_short_ids)
+    write_atomic(pairs, CONSECUTIVE_STOPS_FILE_PATH)
+    manifest['gtfs'] = [signature, sorted(line_short_ids)]
+    return pairs
+
+
+def write_atomic(df, file_path, driver=None):
+    """Write a (Geo)DataFrame to a temporary file next to file_path (parquet without driver), then rename it."""
+    tmp_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}.tmp")
+    try:
+        if driver is None:
+            df.to_parquet(tmp_path)
+        else:
+            df.to_file(tmp_path, driver=driver)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_manifest(manifest):
+    tmp_path = os.path.join(SAVE_DIRECTORY, '.manifest.json.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, MANIFEST_FILE_PATH)
+
+
+def get_line_hash(line, line_stops, line_pairs, pairs_mode, max_distance):
+    """Return hash of every input of the build of a line."""
+    h = md5()
+    h.update(json.dumps([BUILD_VERSION, pairs_mode, max_distance]).encode('utf-8'))
+    for wkb in sorted(geometry.wkb for geometry in line.geometry):
+        h.update(wkb)
+    stops = line_stops[['id', 'short_id', 'name', 'longitude', 'latitude']].sort_values('id')
+    h.update(pd.util.hash_pandas_object(stops, index=False).values.tobytes())
+    if line_pairs is not None:
+        pairs = line_pairs.sort_values(['short_id_start', 'short_id_end'])
+        h.update(pd.util.hash_pandas_object(pairs, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def connect_graph(name, line, max_distance):
+    """Return (line, graph) where disconnected subgraphes closer than max_distance are linked by new segments."""
     # Compute network graph from geospatial data
     G = momepy.gdf_to_nx(line, approach="primal")
-    nodes = list(G.nodes)
-    print("Graph computed.")
 
     # Network graph is sometimes not connected due to data error
     if not nx.is_connected(G):
-        print("--- Graph not connected!")
+        print(f"[{name}] --- Graph not connected!")
         graph_components = list(nx.connected_components(G))
 
         # Get pairs of disconnected subgraphes
@@ -114,7 +207,7 @@ for name in line_names:
             distance = x.distance(y)
 
             # Create the shortest segment linking subgraphes nodes
-            if distance > 0.0 and distance < settings_data["max_distance_between_two_subgraphes"]:
+            if distance > 0.0 and distance < max_distance:
                 node1, node2 = nearest_points(x, y)
                 segment = LineString([node1, node2])
                 segments.append(segment)
@@ -125,99 +218,111 @@ for name in line_names:
 
         # Recompute network graph
         G = momepy.gdf_to_nx(line, approach="primal")
-        nodes = list(G.nodes)
         if nx.is_connected(G):
-            print("--- Network graph artificially connected.")
-            print(f"--- Added segments: {segments}")
-
-    # Get nodes as geodataframe
-    nodes_gdf = momepy.nx_to_gdf(
-        G, points=True, lines=False, spatial_weights=True)[0]
-    nodes_position = nodes_gdf.geometry.unary_union
-
-    def nearest_node(point, nodes_position=nodes_position, nodes_gdf=nodes_gdf):
-        # find the nearest point and return the corresponding Node in graph
-        nearest = nodes_gdf.geometry == nearest_points(
-            point, nodes_position)[1]
-        return nodes_gdf[nearest].nodeID.values[0]
-
-    # Compute nearest node on graph for each stop
-    print("Computing nearest node on graph for each stop.")
-    line_stops['nearest_node_on_graph'] = line_stops.apply(
-        lambda row: nearest_node(row.geometry), axis=1)
-    line_stops['position_on_graph'] = line_stops.set_index("nearest_node_on_graph").join(
-        nodes_gdf.set_index("nodeID"), how="left", lsuffix='_stop', rsuffix='_nodes').geometry_nodes.values
-
-    # Plot
+            print(f"[{name}] --- Network graph artificially connected.")
+            print(f"[{name}] --- Added segments: {segments}")
+
+    return line, G
+
+
+def get_segment_coordinates(line):
+    """Return {(start, end): (n, 2) coordinates} of every segment of a line, indexed in both orientations."""
+    segment_coords = {}
+    segment_lengths = {}
+    for geometry in line.geometry:
+        coords = np.asarray(geometry.coords)
+        start, end = tuple(geometry.coords[0]), tuple(geometry.coords[-1])
+        length = Utils.get_linestring_length_in_meters(geometry)
+
+        # Keep the shortest of parallel segments, as routing does (see RailGraph)
+        if segment_lengths.get((start, end), float('inf')) <= length:
+            continue
+        segment_lengths[(start, end)] = segment_lengths[(end, start)] = length
+        segment_coords[(start, end)] = coords
+        segment_coords[(end, start)] = coords[::-1]
+    return segment_coords
+
+
+def get_path_geometry(path, segment_coords):
+    """Return LineString of a path given as a list of graph nodes."""
+    parts = [segment_coords[(a, b)] for a, b in zip(path[:-1], path[1:])]
+    # Each segment starts where the previous one ends
+    return LineString(np.concatenate([parts[0]] + [part[1:] for part in parts[1:]]))
+
+
+def plot_line(name, line, line_stops, G, file_path):
+    # Workers have no display
+    import matplotlib
+    matplotlib.use('Agg')
     import matplotlib.pyplot as plt
+
     f, ax = plt.subplots(1, 1, figsize=(6, 6), sharex=True, sharey=True)
     line.plot(color="#"+line.color.iloc[0], ax=ax)
     line_stops.plot(color="blue", ax=ax)
-    ax.set_title(line.name.iloc[0])
-    nx.draw(G, {n: [n[0], n[1]] for n in nodes}, ax=ax, node_size=3)
-    plt.show()
-
-    # Compute shortest paths on line graph
-    print("Computing shortest paths on network graph for each pair of stops...")
-    shortest_paths = nx.shortest_path(G)
-
-    # Compute pairs of stops by using the cartesian product of the dataframe with itself
-    line_stops_pairs = line_stops.assign(dummy=1).merge(line_stops.assign(
-        dummy=1), on='dummy', how='outer', suffixes=('_start', '_end'))
-    line_stops_pairs = line_stops_pairs.drop('dummy', axis=1)
-    line_stops_pairs = line_stops_pairs[line_stops_pairs.nearest_node_on_graph_start !=
-                                        line_stops_pairs.nearest_node_on_graph_end]
-    print(f"{len(line_stops_pairs)} pairs to process.")
-
-    # Compute shortest path for each pair
-    line_stops_pairs['shortest_path'] = line_stops_pairs.apply(
-        lambda row: shortest_paths[nodes[row.nearest_node_on_graph_start]][nodes[row.nearest_node_on_graph_end]], axis=1)
-    # Get the segments of the shortest path for further comparison with network dataframe
-    line_stops_pairs['shortest_path_segments'] = line_stops_pairs.apply(lambda row: [LineString(
-        x) for x in list(zip(row.shortest_path[0:-1], row.shortest_path[1:]))], axis=1)
-
-    # Compute line network with reverse segment
-    print("Extending network data with flipped segments.")
-    reverse_line = line.copy()
-    reverse_line.geometry = reverse_line.reverse()
-    line = pd.concat([line, reverse_line])
-
-    print("Building actual paths for every pair...")
-
-    # Compute (start, end) of each line segment
-    line['start_node'] = line.geometry.apply(lambda r: r.coords[0])
-    line['end_node'] = line.geometry.apply(lambda r: r.coords[-1])
-
-    # Build a path on network using segments of the shortest path between two stops
-    def get_shortest_path_from_segments(segments, line):
-        path = []
-        for s in segments:
-            s_start_node, s_end_node = s.coords[:]
-            s_path = line[(line.start_node == s_start_node) & (
-                line.end_node == s_end_node)].geometry.iloc[0]
-            path.append(s_path)
-        return linemerge(path)
-
-    line_stops_pairs['shortest_path'] = line_stops_pairs.shortest_path_segments.apply(
-        lambda row: get_shortest_path_from_segments(row, line))
-
-    print("Shortest paths computed.")
-
-    print("Interpolate paths...")
-
-    # """
-    # Optimisation: remove unnecessary shortest paths.
-    # -> Remove shortest paths which are too long.
-    # -> LineString length must not exceed 50 % of maximum length.
-    # """
-    # line_stops_pairs['length_in_meter'] = line_stops_pairs.shortest_path.apply(
-    #     lambda x: Utils.get_linestring_length_in_meters(x))
-    # max_length = max(line_stops_pairs['length_in_meter']) / 2
-    # optimised_line_stops_pairs = line_stops_pairs[line_stops_pairs['length_in_meter'] < max_length]
-    # optimisation_ratio = 1 - \
-    #     (len(optimised_line_stops_pairs) / len(line_stops_pairs))
-    # print(f"Removed {100*optimisation_ratio: .2f} % of unnecessary paths")
-    # line_stops_pairs = optimised_line_stops_pairs
+    ax.set_title(name)
+    nx.draw(G, {n: [n[0], n[1]] for n in G.nodes}, ax=ax, node_size=3)
+    f.savefig(file_path)
+    plt.close(f)
+
+
+def build_line(name, line, line_stops, line_pairs, pairs_mode, max_distance, plot_directory=None):
+    """Compute, interpolate and save shortest paths of a line. Return the report of the build."""
+    build_start = time.perf_counter()
+    line_id = line.id.iloc[0]
+    transportation_type = line.transportation_type.iloc[0]
+
+    line, G = connect_graph(name, line, max_distance)
+    nodes = list(G.nodes)
+
+    # Snap every stop of the line to its nearest graph node at once
+    node_ids, positions, _ = Snapper(nodes).snap(line_stops.geometry.x.values, line_stops.geometry.y.values)
+    line_stops['nearest_node_on_graph'] = node_ids
+    line_stops['position_on_graph'] = shapely.points(positions)
+
+    if plot_directory is not None:
+        plot_line(name, line, line_stops, G, os.path.join(plot_directory, f"{line_id}.png"))
+
+    # Number of ordered pairs of stops on distinct nodes
+    node_counts = line_stops.nearest_node_on_graph.value_counts()
+    n_all_pairs = len(line_stops) ** 2 - int((node_counts ** 2).sum())
+
+    if pairs_mode == "consecutive":
+        # Pairs of consecutive stops of the line, with their data
+        line_stops_by_id = line_stops.drop_duplicates('short_id')
+        line_stops_pairs = line_pairs.merge(line_stops_by_id.add_suffix('_start'), on='short_id_start')
+        line_stops_pairs = line_stops_pairs.merge(line_stops_by_id.add_suffix('_end'), on='short_id_end')
+        if len(line_stops_pairs) < len(line_pairs):
+            print(f"[{name}] --- {len(line_pairs) - len(line_stops_pairs)} pairs with stops missing "
+                  f"from stop database.")
+        line_stops_pairs = line_stops_pairs[line_stops_pairs.nearest_node_on_graph_start !=
+                                            line_stops_pairs.nearest_node_on_graph_end]
+    else:
+        # Compute pairs of stops by using the cartesian product of the dataframe with itself
+        line_stops_pairs = line_stops.assign(dummy=1).merge(line_stops.assign(
+            dummy=1), on='dummy', how='outer', suffixes=('_start', '_end'))
+        line_stops_pairs = line_stops_pairs.drop('dummy', axis=1)
+        line_stops_pairs = line_stops_pairs[line_stops_pairs.nearest_node_on_graph_start !=
+                                            line_stops_pairs.nearest_node_on_graph_end]
+    if len(line_stops_pairs) == 0:
+        raise ValueError("No pair of stops to process.")
+
+    # Length-weighted shortest paths, with one Dijkstra run per start stop
+    rail_graph = RailGraph.from_networkx(G)
+    rail_graph.compute(line_stops_pairs.nearest_node_on_graph_start.values)
+    line_stops_pairs['shortest_path'] = [
+        rail_graph.get_path(start, end) for start, end in
+        zip(line_stops_pairs.nearest_node_on_graph_start, line_stops_pairs.nearest_node_on_graph_end)]
+
+    # Graph may still be disconnected
+    reachable = line_stops_pairs.shortest_path.notna()
+    if not reachable.all():
+        print(f"[{name}] --- {(~reachable).sum()} pairs not connected on network graph.")
+    line_stops_pairs = line_stops_pairs[reachable].copy()
+
+    # Build a path on network by joining coordinates of the segments between its nodes
+    segment_coords = get_segment_coordinates(line)
+    line_stops_pairs['shortest_path'] = line_stops_pairs.shortest_path.apply(
+        lambda path: get_path_geometry([nodes[i] for i in path], segment_coords))
 
     if transportation_type in ("TRAIN", "RER"):
         DISTANCE_BETWEEN_POINTS = 80
@@ -226,41 +331,185 @@ for name in line_names:
     line_stops_pairs['shortest_path_interpolated'] = line_stops_pairs.shortest_path.apply(
         lambda x: Utils.interpolate_linestring(x, distance_between_points=DISTANCE_BETWEEN_POINTS))
 
-    print("Exporting shortest paths.")
-    line_stops_pairs_labels_to_export = {
-        'line_id_start': 'line_id',
-        'id_start': 'start_id',
-        'id_end': 'end_id',
-        'shortest_path_interpolated': 'shortest_path',
-    }
-    line_stops_pairs = line_stops_pairs[list(
-        line_stops_pairs_labels_to_export.keys())]
-    line_stops_pairs = line_stops_pairs.rename(
-        columns=line_stops_pairs_labels_to_export)
-    line_stops_pairs = line_stops_pairs.set_geometry("shortest_path")
-
-    save_directory = os.path.join('data', 'shortest_paths')
-    if not os.path.exists(save_directory):
-        os.mkdir(save_directory)
-    line_stops_pairs.to_file(os.path.join(save_directory, f"{line_id}.gpkg"))
-
+    if pairs_mode == "consecutive":
+        # Same schema as shortest paths read by live data (see ShortestPathStore)
+        line_stops_pairs_labels_to_export = {
+            'id_start': 'stop_id_start',
+            'short_id_start': 'stop_short_id_start',
+            'name_start': 'stop_name_start',
+            'id_end': 'stop_id_end',
+            'short_id_end': 'stop_short_id_end',
+            'name_end': 'stop_name_end',
+            'line_short_id': 'line_short_id',
+            'shortest_path_interpolated': 'line_geometry_interpolated',
+        }
+        line_stops_pairs = line_stops_pairs[list(
+            line_stops_pairs_labels_to_export.keys())]
+        line_stops_pairs = line_stops_pairs.rename(
+            columns=line_stops_pairs_labels_to_export)
+        line_stops_pairs['line_name'] = name
+        line_stops_pairs['line_transportation_type'] = transportation_type
+        line_stops_pairs = gpd.GeoDataFrame(line_stops_pairs, geometry='line_geometry_interpolated', crs=4326)
+        file_path = os.path.join(SAVE_DIRECTORY, f"{line_id}.parquet")
+        write_atomic(line_stops_pairs, file_path)
+    else:
+        line_stops_pairs_labels_to_export = {
+            'line_id_start': 'line_id',
+            'id_start': 'start_id',
+            'id_end': 'end_id',
+            'shortest_path_interpolated': 'shortest_path',
+        }
+        line_stops_pairs = line_stops_pairs[list(
+            line_stops_pairs_labels_to_export.keys())]
+        line_stops_pairs = line_stops_pairs.rename(
+            columns=line_stops_pairs_labels_to_export)
+        line_stops_pairs = line_stops_pairs.set_geometry("shortest_path")
+        file_path = os.path.join(SAVE_DIRECTORY, f"{line_id}.gpkg")
+        write_atomic(line_stops_pairs, file_path, driver="GPKG")
+
+    return {'name': name,
+            'file': file_path,
+            'pairs': len(line_stops_pairs),
+            'all_pairs': n_all_pairs,
+            'size': os.path.getsize(file_path),
+            'duration': time.perf_counter() - build_start}
+
+
+def print_summary(reports, skipped, failed, duration, pairs_mode):
     print("-------")
-
-# Export data
-print("Exporting processed network data.")
-network_df.to_file("data/network.json", driver="GeoJSON")
-
-print("Exporting stop database.")
-stops_df.to_file("data/stops.json", driver="GeoJSON")
-
-# Plot a few shortest path
-# import matplotlib.pyplot as plt
-# for i in random.sample(range(len(line_stops_pairs)), 6):
-#     f, ax = plt.subplots(1, 1, figsize=(6, 6), sharex=True, sharey=True)
-#     example = line_stops_pairs.iloc[i]
-#     print(example.name_start, example.name_end)
-#     sp = gpd.GeoSeries(example.shortest_path)
-#     sp.plot(color="red", ax=ax)
-#     sp_segments = gpd.GeoSeries(linemerge(example.shortest_path_segments))
-#     sp_segments.plot(color="blue", ax=ax)
-#     plt.show()
+    print(f"{len(reports)} lines built, {len(skipped)} unchanged lines skipped and {len(failed)} failed "
+          f"in {duration:.1f} s.")
+    if failed:
+        print(f"Failed lines: {', '.join(sorted(failed))}")
+    if len(reports) == 0:
+        return
+
+    report = pd.DataFrame(reports)
+    slowest = report.loc[report.duration.idxmax()]
+    print(f"Line builds took {report.duration.sum():.1f} s in total, "
+          f"slowest line {slowest['name']} ({slowest.duration:.1f} s).")
+
+    # Paths are built and interpolated one by one: size and build time are about proportional to pairs.
+    # Figures with every pair are extrapolated linearly (build with --pairs all to measure them).
+    if pairs_mode == "consecutive":
+        ratio = report.pairs.sum() / max(1, report.all_pairs.sum())
+        print(f"{report.pairs.sum()} consecutive pairs instead of {report.all_pairs.sum()} pairs of stops "
+              f"({100 * ratio:.1f} %).")
+        print(f"Path store: {report['size'].sum() / 1024 ** 2:.1f} MB "
+              f"(about {report['size'].sum() / max(ratio, 1e-9) / 1024 ** 2:.1f} MB with every pair, "
+              f"linear extrapolation).")
+        print(f"Build time: {report.duration.sum():.1f} s "
+              f"(about {report.duration.sum() / max(ratio, 1e-9):.0f} s with every pair, linear extrapolation).")
+
+
+def main(args):
+    # Load settings from settings.json
+    with open('settings.json', 'r') as json_file:
+        settings_data = json.load(json_file)
+    pairs_mode = args.pairs or settings_data.get("shortest_paths_pairs", "consecutive")
+    max_distance = settings_data["max_distance_between_two_subgraphes"]
+
+    prim = PRIM_API(api_key=settings_data["prim_api_key"])
+
+    # Download railroad network and stops database
+    if not os.path.exists(prim.NETWORK_DATA_FILE_PATH):
+        print("Download network data.")
+        prim.download_network()
+    if not os.path.exists(prim.STOPS_DATA_FILE_PATH):
+        print("Download stops data.")
+        prim.download_stops()
+
+    network_df = load_network(prim)
+    stops_df = load_stops(prim, network_df)
+
+    line_names = args.lines or sorted(set(network_df.name.values))
+    unknown = set(line_names) - set(network_df.name.values)
+    if unknown:
+        raise ValueError(f"Unknown lines: {', '.join(sorted(unknown))}")
+
+    os.makedirs(SAVE_DIRECTORY, exist_ok=True)
+    # Builds of other lines are kept with --force, only selected lines are rebuilt
+    manifest = {'lines': {}}
+    if os.path.exists(MANIFEST_FILE_PATH):
+        with open(MANIFEST_FILE_PATH, 'r') as file:
+            manifest = json.load(file)
+
+    consecutive_stop_pairs = None
+    if pairs_mode == "consecutive":
+        # Consecutive stops of every line, so that building other lines later reuses them
+        consecutive_stop_pairs = load_consecutive_stop_pairs(prim, manifest, set(network_df.id))
+        print(f"{len(consecutive_stop_pairs)} pairs of consecutive stops loaded.")
+
+    plot_directory = None
+    if args.plot:
+        plot_directory = os.path.join(SAVE_DIRECTORY, 'plots')
+        os.makedirs(plot_directory, exist_ok=True)
+
+    # Lines whose inputs changed since their last build
+    jobs = {}
+    skipped = []
+    for name in line_names:
+        line = network_df[network_df.name == name].copy()
+        line_id = line.id.iloc[0]
+        line_stops = stops_df[stops_df.line_id == line_id].copy()
+        line_pairs = None
+        if consecutive_stop_pairs is not None:
+            line_pairs = consecutive_stop_pairs[consecutive_stop_pairs.line_short_id == line_id]
+
+        line_hash = get_line_hash(line, line_stops, line_pairs, pairs_mode, max_distance)
+        previous = manifest['lines'].get(line_id)
+        if (not args.force and previous is not None and previous['hash'] == line_hash
+                and os.path.exists(previous['file'])):
+            skipped.append(name)
+            continue
+        jobs[name] = (line_id, line_hash, (name, line, line_stops, line_pairs, pairs_mode, max_distance,
+                                           plot_directory))
+    print(f"{len(jobs)} lines to build, {len(skipped)} unchanged lines skipped.")
+
+    build_start = time.perf_counter()
+    reports = []
+    failed = []
+    workers = args.workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as pool:
+        futures = {pool.submit(build_line, *job[2]): name for name, job in jobs.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            line_id, line_hash, _ = jobs[name]
+            try:
+                report = future.result()
+            except Exception as e:
+                print(f"[{name}] Build failed: {e!r}")
+                failed.append(name)
+                continue
+
+            # Record each line once built, so that an interrupted build resumes from there
+            reports.append(report)
+            manifest['lines'][line_id] = {'name': name,
+                                          'hash': line_hash,
+                                          'file': report['file'],
+                                          'pairs': report['pairs']}
+            write_manifest(manifest)
+            print(f"[{name}] {report['pairs']} paths saved to {report['file']} ({report['size'] / 1024:.0f} kB) "
+                  f"in {report['duration']:.1f} s ({len(reports) + len(failed)}/{len(jobs)}).")
+    write_manifest(manifest)
+
+    # Export data
+    print("Exporting processed network data.")
+    write_atomic(network_df, os.path.join('data', 'network.json'), driver="GeoJSON")
+
+    print("Exporting stop database.")
+    write_atomic(stops_df, os.path.join('data', 'stops.json'), driver="GeoJSON")
+
+    print_summary(reports, skipped, failed, time.perf_counter() - build_start, pairs_mode)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lines', nargs='+', default=None, help="names of lines to build (default: every line)")
+    parser.add_argument('--workers', type=int, default=None, help="processes building lines (default: CPU count)")
+    parser.add_argument('--pairs', choices=['consecutive', 'all'], default=None,
+                        help="pairs of stops to compute (default: shortest_paths_pairs setting)")
+    parser.add_argument('--force', action='store_true', help="rebuild lines (every line without --lines), even if unchanged")
+    parser.add_argument('--plot', action='store_true',
+                        help="save a plot of each line graph to data/shortest_paths/plots")
+    main(parser.parse_args())
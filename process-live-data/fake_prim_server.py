@@ -0,0 +1,211 @@
+"""Local stand-in for the PRIM API, used to test ingestion without spending quota.
+
+Serves stop-monitoring (one stop) and estimated-timetable (whole line) requests from the
+same simulated line: trains leave the first stop every `headway` seconds and reach each
+next stop `travel_time` seconds later.
+
+Run `python fake_prim_server.py --port 8080` and set "prim_base_url" to
+"http://127.0.0.1:8080/marketplace" in settings.json.
+"""
+import argparse
+import datetime
+import hashlib
+import random
+import time
+
+from aiohttp import web
+
+
+def format_date(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def build_stop_visit(line_short_id, stop_short_id, trip_id, arrival_timestamp, recorded_timestamp):
+    return {
+        'RecordedAtTime': format_date(recorded_timestamp),
+        'MonitoredVehicleJourney': {
+            'LineRef': {'value': f"STIF:Line::{line_short_id}:"},
+            'FramedVehicleJourneyRef': {'DatedVehicleJourneyRef': trip_id},
+            'DestinationRef': {'value': "STIF:StopPoint:Q:0:"},
+            'DestinationName': [{'value': "Terminus"}],
+            'DirectionName': [],
+            'JourneyNote': [{'value': trip_id[-4:].upper()}],
+            'MonitoredCall': {
+                'StopPointName': [{'value': f"Stop {stop_short_id}"}],
+                'ExpectedArrivalTime': format_date(arrival_timestamp),
+                'DestinationDisplay': [{'value': "Terminus"}],
+            },
+        },
+    }
+
+
+def build_estimated_call(stop_short_id, arrival_timestamp):
+    return {
+        'StopPointRef': {'value': f"STIF:StopPoint:Q:{stop_short_id}:"},
+        'StopPointName': [{'value': f"Stop {stop_short_id}"}],
+        'ExpectedArrivalTime': format_date(arrival_timestamp),
+        'DestinationDisplay': [{'value': "Terminus"}],
+    }
+
+
+def build_estimated_journey(line_short_id, trip_id, calls, recorded_timestamp):
+    return {
+        'RecordedAtTime': format_date(recorded_timestamp),
+        'LineRef': {'value': f"STIF:Line::{line_short_id}:"},
+        'DatedVehicleJourneyRef': {'value': trip_id},
+        'DestinationRef': {'value': "STIF:StopPoint:Q:0:"},
+        'DestinationName': [{'value': "Terminus"}],
+        'JourneyNote': [{'value': trip_id[-4:].upper()}],
+        'EstimatedCalls': {'EstimatedCall': calls},
+    }
+
+
+class FakePRIMServer:
+    def __init__(self, line_short_id, requests_per_second, daily_quota, error_rate, headway, update_period,
+                 stop_short_ids=None, travel_time=90, horizon=3600):
+        self.line_short_id = line_short_id
+        self.requests_per_second = requests_per_second
+        self.daily_quota = daily_quota
+        self.error_rate = error_rate
+        self.headway = headway
+        self.update_period = update_period
+        self.stop_short_ids = stop_short_ids or [str(i) for i in range(20)]
+        self.travel_time = travel_time
+        self.horizon = horizon
+
+        self.window_start = 0
+        self.window_requests = 0
+        self.daily_requests = 0
+        self.stats = {'ok': 0, 'throttled': 0, 'errors': 0}
+
+    def is_throttled(self):
+        now = int(time.time())
+        if now != self.window_start:
+            self.window_start = now
+            self.window_requests = 0
+        self.window_requests += 1
+        self.daily_requests += 1
+        if self.daily_quota is not None and self.daily_requests > self.daily_quota:
+            return True
+        return self.window_requests > self.requests_per_second
+
+    def get_recorded_time(self):
+        # Data only changes every update_period seconds, so that identical payloads can be observed
+        now = time.time()
+        return now - now % self.update_period
+
+    def get_stop_index(self, stop_short_id):
+        if stop_short_id in self.stop_short_ids:
+            return self.stop_short_ids.index(stop_short_id)
+        return int(hashlib.md5(stop_short_id.encode()).hexdigest(), 16) % len(self.stop_short_ids)
+
+    def get_trip_id(self, departure):
+        return f"FAKE:{self.line_short_id}:{int(departure)}"
+
+    def get_next_trips(self, stop_short_id):
+        recorded = self.get_recorded_time()
+        offset = self.get_stop_index(stop_short_id) * self.travel_time
+
+        # First departure from the first stop arriving at this stop after recorded time
+        first_departure = (recorded - offset) - (recorded - offset) % self.headway + self.headway
+        visits = []
+        for i in range(3):
+            departure = first_departure + i * self.headway
+            visits.append(build_stop_visit(self.line_short_id, stop_short_id, self.get_trip_id(departure),
+                                           departure + offset, recorded))
+        return visits
+
+    def get_estimated_journeys(self):
+        recorded = self.get_recorded_time()
+        trip_duration = (len(self.stop_short_ids) - 1) * self.travel_time
+
+        # Trains running now or departing within the horizon
+        departure = (recorded - trip_duration) - (recorded - trip_duration) % self.headway
+        journeys = []
+        while departure <= recorded + self.horizon:
+            calls = [build_estimated_call(stop_short_id, departure + i * self.travel_time)
+                     for i, stop_short_id in enumerate(self.stop_short_ids)
+                     if departure + i * self.travel_time >= recorded]
+            if calls:
+                journeys.append(build_estimated_journey(self.line_short_id, self.get_trip_id(departure),
+                                                        calls, recorded))
+            departure += self.headway
+        return journeys
+
+    def check_request(self):
+        if self.is_throttled():
+            self.stats['throttled'] += 1
+            return web.json_response({'error': 'Too Many Requests'}, status=429, headers={'Retry-After': '1'})
+        if random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            return web.json_response({'error': 'Service Unavailable'}, status=503)
+        self.stats['ok'] += 1
+        return None
+
+    async def stop_monitoring(self, request):
+        error = self.check_request()
+        if error is not None:
+            return error
+
+        monitoring_ref = request.query.get('MonitoringRef', '')
+        stop_short_id = monitoring_ref.rstrip(':').split(':')[-1]
+        return web.json_response({'Siri': {'ServiceDelivery': {
+            'ResponseTimestamp': format_date(time.time()),
+            'StopMonitoringDelivery': [{'MonitoredStopVisit': self.get_next_trips(stop_short_id)}]
+        }}})
+
+    async def estimated_timetable(self, request):
+        error = self.check_request()
+        if error is not None:
+            return error
+
+        line_ref = request.query.get('LineRef', '')
+        journeys = self.get_estimated_journeys() if line_ref.rstrip(':').split(':')[-1] == self.line_short_id else []
+        return web.json_response({'Siri': {'ServiceDelivery': {
+            'ResponseTimestamp': format_date(time.time()),
+            'EstimatedTimetableDelivery': [{'EstimatedJourneyVersionFrame': [
+                {'EstimatedVehicleJourney': journeys}
+            ]}]
+        }}})
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/marketplace/stop-monitoring', self.stop_monitoring)
+        app.router.add_get('/marketplace/estimated-timetable', self.estimated_timetable)
+        app.router.add_get('/stats', self.get_stats)
+        return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--line', default='C01742', help="line short id returned in visits")
+    parser.add_argument('--requests-per-second', type=int, default=50)
+    parser.add_argument('--daily-quota', type=int, default=None)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument('--headway', type=int, default=300, help="seconds between two trains")
+    parser.add_argument('--update-period', type=int, default=30, help="seconds between two payload updates")
+    parser.add_argument('--travel-time', type=int, default=90, help="seconds between two consecutive stops")
+    parser.add_argument('--stops', default=None,
+                        help="comma-separated stop short ids of the line (default: stops of the line in "
+                             "data/stops.parquet if available, else 20 dummy stops)")
+    args = parser.parse_args()
+
+    if args.stops is not None:
+        stop_short_ids = args.stops.split(',')
+    else:
+        try:
+            import pandas as pd
+            stops = pd.read_parquet('data/stops.parquet', columns=['short_id', 'line_short_id'])
+            stop_short_ids = sorted(set(stops[stops['line_short_id'] == args.line]['short_id'])) or None
+        except (OSError, ImportError):
+            stop_short_ids = None
+
+    server = FakePRIMServer(args.line, args.requests_per_second, args.daily_quota,
+                            args.error_rate, args.headway, args.update_period,
+                            stop_short_ids=stop_short_ids, travel_time=args.travel_time)
+    web.run_app(server.create_app(), host=args.host, port=args.port)
@@ -2,46 +2,132 @@ import os
 import json
 import geopandas as gpd
 import pandas as pd
-import numpy as np
 import asyncio
-import threading
 import time, datetime, pytz
 import traceback
-import aiohttp
-from aiolimiter import AsyncLimiter
-import json, gzip
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from src.PRIM_API import PRIM_API
-from src.ArrivalTime import ArrivalTime
-from src.GTFS import GTFS
-from src.Utils import Utils
+from src.Snapshot import Snapshot
+from src.PositionPublisher import PositionPublisher
+from src.PositionServer import PositionServer
+from src.FetchPlanner import FetchPlanner
+from src.AdaptivePoller import AdaptivePoller
+from src.SIRIParser import TripColumns
+from src.TimetableIndex import TimetableIndex
+from src.TripStateStore import TripStateStore
+from src.TrajectoryBuilder import TrajectoryBuilder
 
 import logging
 logging.basicConfig(format='[%(asctime)s.%(msecs)03d] %(levelname)-8s %(message)s',
                     level=logging.INFO, datefmt='%H:%M:%S')
 
-# Load settings from settings.json
-with open('settings.json', 'r') as json_file:
-    settings_data = json.load(json_file)
-prim = PRIM_API(api_key=settings_data["prim_api_key"])
-logging.info("Read settings and instantiate PRIM API.")
+# Worker processes of the trajectory pool import this module (as __mp_main__) but only need src:
+# settings, data and services are loaded by load_state() in the main process.
+settings_data = None
+prim = None
 
-# Load stops and network
-network = gpd.read_parquet('data/network.parquet')
-logging.info("Loaded network dataframe.")
+# Network and stops dataframes
+network = None
+stops = None
 
-stops = gpd.read_parquet('data/stops.parquet')
-logging.info("Loaded stops dataframe.")
+# Stops to poll for each line (every line of stops dataframe is fetched), and their names
+stops_by_line = {}
+stop_names = {}
 
-# Dict to store data for trips for each line
-trips_last_data = {}
-all_lines_trips = {}
+# Lines fetched with a single estimated-timetable request instead of one request per stop
+bulk_ingestion_lines = set()
 
-def get_remaining_time_until_next_fetch():
+fetch_planner = None
+
+# Stops are polled more or less often depending on how often their data changes
+adaptive_poller = None
+
+# Shortest paths are loaded once per line and kept in memory
+# Trajectories are computed in worker processes, each with its own shortest paths store.
+# A line is always built by the same worker, so that its shortest paths are only loaded by this worker.
+shortest_paths_directory = os.path.join('data', 'shortest_paths')
+shortest_paths_max_memory = None
+trajectory_pools = []
+trajectory_pool_by_line = {}
+
+# Timetable of metro and tramway lines indexed by arrival time: {line_short_id: (file mtime, TimetableIndex)}
+timetable_indexes = {}
+
+# Bounds (in seconds) of the delay of a real-time arrival matched to a scheduled one
+MAX_EARLY = 120
+MAX_DELAY = 1800
+
+# Latest observations of trips of lines with trip ids: {line_short_id: TripStateStore}
+trip_states = {}
+
+# Last trips (TripColumns) received for each (line_short_id, stop_short_id), reused for stops not polled in a cycle
+last_stop_trips = {}
+
+# Trips and trajectories of every line used to publish positions, replaced (never mutated) when a line is updated
+snapshot = Snapshot.empty()
+
+# Lines computed but not yet in the snapshot, applied at once by the next snapshot rebuild
+pending_lines = {}
+snapshot_lock = asyncio.Lock()
+
+# Positions are published as frames covering the next minutes
+position_publisher = None
+
+# Optional HTTP/WebSocket server of positions
+position_server = None
+
+
+def load_state():
+    global settings_data, prim, network, stops, stops_by_line, stop_names, bulk_ingestion_lines, fetch_planner, \
+        adaptive_poller, shortest_paths_max_memory, MAX_DELAY, position_publisher, position_server
+
+    # Load settings from settings.json
+    with open('settings.json', 'r') as json_file:
+        settings_data = json.load(json_file)
+    prim = PRIM_API(api_key=settings_data["prim_api_key"],
+                    base_url=settings_data.get("prim_base_url"),
+                    requests_per_second=settings_data.get("prim_requests_per_second", 50),
+                    daily_quota=settings_data.get("prim_daily_quota"),
+                    record_dir=settings_data.get("prim_record_dir"))
+    logging.info("Read settings and instantiate PRIM API.")
+
+    # Load stops and network
+    network = gpd.read_parquet('data/network.parquet')
+    logging.info("Loaded network dataframe.")
+
+    stops = gpd.read_parquet('data/stops.parquet')
+    logging.info("Loaded stops dataframe.")
+
+    stops_by_line = {line_short_id: sorted(set(line_stops.values))
+                     for line_short_id, line_stops in stops.groupby('line_short_id')['short_id']}
+    stop_names = dict(zip(stops.short_id, stops.name))
+
+    bulk_ingestion_lines = set(settings_data.get("bulk_ingestion_lines", []))
+
+    fetch_planner = FetchPlanner(requests_per_second=settings_data.get("prim_requests_per_second", 50))
+
+    adaptive_poller = AdaptivePoller(min_interval_ratio=settings_data.get("polling_min_interval_ratio", 0.5),
+                                     max_interval_ratio=settings_data.get("polling_max_interval_ratio", 4.0))
+
+    shortest_paths_max_memory = settings_data.get("shortest_paths_cache_max_mb", 512) * 1024 ** 2
+    MAX_DELAY = settings_data.get("timetable_max_delay", 1800)
+
+    position_publisher = PositionPublisher('data',
+                                           horizon=settings_data.get("publish_horizon", 120),
+                                           resolution=settings_data.get("publish_resolution", 10),
+                                           keyframe_interval=settings_data.get("publish_keyframe_interval", 30),
+                                           partition_zoom=settings_data.get("publish_partition_zoom", 13))
+
+    if settings_data.get("server_enabled", False):
+        position_server = PositionServer(zoom=settings_data.get("server_tile_zoom", 11))
+
+
+def get_fetch_interval():
     # Get the current time
     now = datetime.datetime.now()
     h = now.hour
-    m = now.minute
 
     # Define data fetch frequency in minutes
     if h == 5:
@@ -57,11 +143,58 @@ def get_remaining_time_until_next_fetch():
     else:
         fetch_frequency = 15
 
-    remaining_time = 60 * (fetch_frequency - m % fetch_frequency)
+    # Base polling interval of a stop in seconds
+    return 60 * fetch_frequency
+
+
+def get_polling_tick():
+    # Busiest stops are polled every min_interval_ratio * base interval
+    return get_fetch_interval() * adaptive_poller.min_interval_ratio
+
+
+def get_remaining_time_until_next_fetch():
+    now = datetime.datetime.now()
+    seconds = 3600 * now.hour + 60 * now.minute + now.second
+    tick = get_polling_tick()
+
+    remaining_time = tick - seconds % tick
     return remaining_time
 
 
-def rebuild_trip_ids_from_timetable(trips, timetable):
+def get_timetable_index(line_short_id):
+    # Timetable index is built once per service day (or when the timetable file changes)
+    timetable_path = os.path.join('data', 'timetable', line_short_id)
+    service_date = datetime.datetime.now(pytz.timezone('Europe/Paris')).date()
+    mtime = os.path.getmtime(timetable_path)
+
+    cached = timetable_indexes.get(line_short_id)
+    if cached is not None and cached[0] == mtime and cached[1].service_date == service_date:
+        return cached[1]
+
+    start = time.perf_counter()
+    index = TimetableIndex.from_dataframe(pd.read_parquet(timetable_path), service_date)
+    timetable_indexes[line_short_id] = (mtime, index)
+    logging.info(f"Built timetable index of line {line_short_id} for {service_date} "
+                 f"({len(index)} stop times, {time.perf_counter() - start:.2f} s).")
+    return index
+
+
+def apply_real_time_delays(tt, trips):
+    line_name = trips.iloc[0]['line_name']
+    if tt.empty:
+        return tt
+    start = time.perf_counter()
+
+    # Match real-time arrivals to scheduled arrivals and propagate delays to the next stops of each trip
+    tt, matches = TimetableIndex.apply_delays(tt, trips, max_early=MAX_EARLY, max_delay=MAX_DELAY)
+
+    logging.info(f"[{line_name}] Matched {len(matches)}/{len(trips)} real-time arrivals "
+                 f"({len(matches) / len(trips):.0%}) to {matches['id'].nunique()} scheduled trips "
+                 f"in {1000 * (time.perf_counter() - start):.1f} ms.")
+    return tt
+
+
+def rebuild_trip_ids_from_timetable(trips, timetable_index):
     output_keys = [
         'id',
         'name',
@@ -74,38 +207,9 @@ def rebuild_trip_ids_from_timetable(trips, timetable):
         'arrival_time',
     ]
 
-    # Get the current date in Paris time zone
-    day_of_week = datetime.datetime.now().strftime("%A")
-    paris_tz = pytz.timezone('CET')
-    today = datetime.date.today()
-    now = datetime.datetime.now(paris_tz)
-
-    # Filter timetable for current day of week
-    timetable = timetable[timetable[day_of_week.lower()] == True]
-    tt = timetable.copy()
-
-    # Parse data
-    tt['stop_short_id'] = tt['stop_id'].apply(lambda x: Utils.compute_short_id(x))
-    tt['arrival_time'] = tt['arrival_time'].apply(lambda x: GTFS.parse_time(x, tzinfo=paris_tz))
-    tt['start_date'] = tt['start_date'].apply(lambda x: GTFS.parse_date(x))
-    tt['end_date'] = tt['end_date'].apply(lambda x: GTFS.parse_date(x))
-    tt['destination_name'] = tt['trip_headsign']
-    tt['id'] = tt['trip_id']
-    tt['line_short_id'] = tt['route_short_id']
-    tt['name'] = ''
-
-    # Filter on trains of the day
-    tt = tt[today >= tt['start_date']]
-    tt = tt[today - datetime.timedelta(days=1) <= tt['end_date']]
-
-    # Assuming trains can be up to 2 minutes early
-    tt = tt[tt['arrival_time'] > now - datetime.timedelta(minutes=2)]
-
-    # Filter on trains expected within the next 60 minutes
-    tt = tt[tt['arrival_time'] < now + datetime.timedelta(minutes=60)]
-
-    # Parse trip destination
-    tt['destination_id'] = tt.sort_values(by=['stop_sequence']).groupby('trip_id')['stop_short_id'].transform('last')
+    # Scheduled arrivals of late trains are matched up to MAX_DELAY seconds in the past
+    now = time.time()
+    tt = timetable_index.get_window(now, before=MAX_DELAY + MAX_EARLY, after=3600)
 
     # Get stop name from real-time data
     stops_data = trips[['stop_short_id', 'stop_name']].drop_duplicates().set_index('stop_short_id')
@@ -118,269 +222,303 @@ def rebuild_trip_ids_from_timetable(trips, timetable):
     # Get line name
     tt['line_name'] = trips.iloc[0]['line_name']
 
-    # if trips.iloc[0]['line_name'] == "METRO 14":
-    #     print("DEBUG")
-    #     trips_last_data['debug'] = tt.copy()
+    # Shift scheduled arrival times by the delays observed in real-time data
+    tt = apply_real_time_delays(tt, trips)
 
-    # TODO: Use real-time data when trains are delayed
+    # Assuming trains can be up to 2 minutes early, keep trains expected within the next 60 minutes
+    if not tt.empty:
+        tt = tt[tt['arrival_time'] > pd.Timestamp(now - MAX_EARLY, unit='s', tz='UTC')]
 
-    try:
-        if not tt.empty:
-            return tt[output_keys]
-        else:
-            return None
-    except Exception as e:
-        logging.error(traceback.format_exc())
-        print(tt)
+    if not tt.empty:
+        return tt[output_keys]
+    else:
+        return None
+
+
+def get_trajectory_pool(line_short_id):
+    # Lines are assigned to workers in turn the first time they are built
+    if line_short_id not in trajectory_pool_by_line:
+        trajectory_pool_by_line[line_short_id] = trajectory_pools[len(trajectory_pool_by_line) % len(trajectory_pools)]
+    return trajectory_pool_by_line[line_short_id]
 
 
-def compute_coords_timestamps(trips):
+async def compute_coords_timestamps(trips):
     # Get line attributes
     line_name = trips.iloc[0]['line_name']
-    line_short_id = trips.iloc[0]['line_short_id']
 
-    # Load shortest paths database
-    sp = gpd.read_parquet(f'data/shortest_paths/{line_short_id}.parquet')
-    sp['stop_short_id_start'] = sp['stop_id_start'].apply(lambda x: Utils.compute_short_id(x))
-    sp['stop_short_id_end'] = sp['stop_id_end'].apply(lambda x: Utils.compute_short_id(x))
-    logging.info(f"[{line_name}] Loaded shortest paths dataframe.")
+    # Link time and positions of each trip in worker processes, so that the event loop keeps fetching other lines
+    metadata, args = TrajectoryBuilder.prepare(trips)
+    trajectory_pool = get_trajectory_pool(trips.iloc[0]['line_short_id'])
+    loop = asyncio.get_running_loop()
+    kept, trajectories, missing, cpu_time = await loop.run_in_executor(trajectory_pool, TrajectoryBuilder.build, *args)
 
-    # Link time and positions for each trip
-    trips['time_position'] = list(zip(trips.arrival_time,
-                                      trips.stop_short_id,
-                                      trips.stop_name))
-    
-    # TODO: remove duplicates in stop sequence
+    for start_stop_short_id, end_stop_short_id in missing:
+        logging.warning(f'[{line_name}] Could not find path between {start_stop_short_id} and {end_stop_short_id}.')
 
-    # Get all stops with arrival time for each trip
-    groupby_fields = ['id', 'line_short_id', 'name', 'destination_id']
-    df = trips.groupby(groupby_fields)['time_position'].unique().reset_index()
+    # Only keep trips with a path
+    df = metadata.iloc[kept].reset_index(drop=True)
+    logging.info(f"[{line_name}] Computed coordinates and timestamps ({trajectories}) in {cpu_time:.2f} s CPU time.")
 
-    # Sort list of stops by arrival time
-    def sort_by_arrival_time(tps):
-        return sorted(tps, key=lambda x: x[0])
-    df['time_position'] = df['time_position'].apply(lambda x: sort_by_arrival_time(x))
+    return df, trajectories
 
-    # Build trip path for each pairs of consecutive stops
-    def build_path(tps, sp, line_short_id):
-        coords = []
-        timestamps = []
 
-        for i in range(len(tps)-1):
-            start_stop_short_id = tps[i][1]
-            end_stop_short_id = tps[i+1][1]
+async def get_stop_by_stop_trips(line_short_id, line_name, schedule, skip_unchanged=True):
+    # Fetch all stops at once if no schedule is given
+    if schedule is None:
+        schedule = [(0, short_id) for short_id in stops_by_line[line_short_id]]
 
-            if start_stop_short_id == end_stop_short_id:
-                continue
+    async def get_next_trips_at_stop(delay, short_id):
+        # Wait for the request slot planned for the stop
+        await asyncio.sleep(delay)
+        return await prim.get_next_trips_at_stop(short_id, line_short_id)
 
-            start_time = tps[i][0].timestamp()
-            end_time = tps[i+1][0].timestamp()
+    # Fetch arrival times at each stop
+    tasks = [asyncio.ensure_future(get_next_trips_at_stop(delay, short_id)) for delay, short_id in schedule]
+    logging.info(f"[{line_name}] Created async tasks.")
 
-            # Get shortest path between A and B
-            cond1 = sp['stop_short_id_start'] == start_stop_short_id
-            cond2 = sp['stop_short_id_end'] == end_stop_short_id
-            cond3 = sp['line_short_id'] == line_short_id
-            path = sp[cond1 & cond2]['line_geometry_interpolated']
+    responses = await asyncio.gather(*tasks)
+    logging.info(f"[{line_name}] Executed {len(tasks)} tasks.")
 
-            if not path.empty:
-                path = path.iloc[0]
+    # Track changes of polled stops for adaptive polling
+    now = time.time()
+    n_changed = 0
+    n_failed = 0
+    for (_, short_id), response in zip(schedule, responses):
+        key = (line_short_id, short_id)
 
-                # Number of points of the shortest path between A and B
-                n_points = len(path.coords[:])
+        # Failed fetch: keep previous trips of the stop, which stays due for the next polling tick
+        if response is None:
+            n_failed += 1
+            continue
 
-                # Compute timestamps
-                ts = np.linspace(start_time, end_time, n_points)
+        changed = key not in last_stop_trips or prim.is_response_changed(short_id, line_short_id)
+        adaptive_poller.observe(key, changed, now)
+        last_stop_trips[key] = response
+        n_changed += changed
 
-                # Add data to list of coords/timestamps
-                timestamps.append(ts)
-                coords += path.coords[:]
+    if n_failed > 0:
+        logging.warning(f"[{line_name}] Could not get data of {n_failed}/{len(schedule)} stops, keeping their previous trips.")
 
-            else:
-                logging.warning(f'Could not find path between {start_stop_short_id} and {end_stop_short_id}.')
-                print(f"-----\n{stops[stops['short_id'] == start_stop_short_id].iloc[0]}\n-----\n")
-                print(f"-----\n{stops[stops['short_id'] == end_stop_short_id].iloc[0]}\n-----\n")
+    # Nothing to rebuild if no payload changed since the line was last computed
+    if skip_unchanged and n_changed == 0 and line_short_id in snapshot:
+        return None
 
-        if len(coords) > 0 and len(timestamps) > 0:
-            # Concatenate timestamps for each segment of the trip
-            timestamps = np.concatenate(timestamps)
+    # Stops not polled in this cycle use their last data
+    return TripColumns.concatenate([last_stop_trips[(line_short_id, short_id)]
+                                    for short_id in stops_by_line[line_short_id]
+                                    if (line_short_id, short_id) in last_stop_trips])
 
-            return pd.Series([list(zip(list(timestamps), coords))])
-        else:
-            return pd.Series([None])
 
-    df['time_position'] = df.apply(lambda x: build_path(x.time_position,
-                                                        sp,
-                                                        line_short_id),
-                                   axis=1)
-    logging.info(f"[{line_name}] Computed coordinates and timestamps.")
+async def get_bulk_trips(line_short_id, line_name, schedule, skip_unchanged=True):
+    # A single request is planned for the whole line
+    if schedule:
+        await asyncio.sleep(schedule[0][0])
 
-    return df
+    trips = await prim.get_line_estimated_timetable(line_short_id,
+                                                    stop_short_ids=stops_by_line[line_short_id],
+                                                    stop_names=stop_names)
+    logging.info(f"[{line_name}] Executed bulk request.")
 
+    # Failed request: keep previous trips of the line
+    if trips is None:
+        logging.warning(f"[{line_name}] Could not get estimated timetable, keeping previous trips.")
+        return None
 
-async def get_line_trips(line_short_id):
-    tasks = []
+    # Nothing to rebuild if payload did not change since the line was last computed
+    if skip_unchanged and not prim.is_response_changed(None, line_short_id) and line_short_id in snapshot:
+        return None
+    return trips
 
+
+async def get_line_trips(line_short_id, schedule=None):
     # Get line attributes (name, type, stops)
     line_name = network[network['short_id'] == line_short_id].iloc[0]['name']
     transportation_type = network[network['short_id'] == line_short_id].iloc[0]['transportation_type']
-    stop_short_ids = stops[stops['line_short_id'] == line_short_id].short_id
-    stop_short_ids = list(set(stop_short_ids.values))
-
-    async with aiohttp.ClientSession() as session:
-        # Fetch arrival times at each stop
-        for short_id in stop_short_ids:
-            tasks.append(asyncio.ensure_future(prim.get_next_trips_at_stop(short_id,
-                                                                           line_short_id,
-                                                                           session)))
-        logging.info(f"[{line_name}] Created async tasks.")
-
-        responses = await asyncio.gather(*tasks)
-        logging.info(f"[{line_name}] Executed {len(tasks)} tasks.")
-
-        # Generate trips dataframe for the line
-        trips = [t for r in responses for t in r if t is not None]
-        trips = pd.DataFrame.from_dict(trips)
+
+    # Trips of metro and tramway lines are rebuilt from a timetable window moving with the clock,
+    # so they are rebuilt even if no payload changed
+    skip_unchanged = transportation_type not in ("TRAMWAY", "METRO")
+
+    # Get next trips with one request per stop or one request for the whole line
+    if line_short_id in bulk_ingestion_lines:
+        trips = await get_bulk_trips(line_short_id, line_name, schedule, skip_unchanged)
+    else:
+        trips = await get_stop_by_stop_trips(line_short_id, line_name, schedule, skip_unchanged)
+
+    if trips is None:
+        logging.info(f"[{line_name}] No new data, keeping previous trips.")
+        return None
+
+    if len(trips) == 0:
+        logging.warning(f'[{line_name}] Dataframe trips is empty!')
+        return None
+
+    # RATP data is not complete for metro and tramway
+    # Thus we have to manually build trips using the timetable and real-time data for next trains.
+    if transportation_type in ("TRAMWAY", "METRO"):
+        trips = trips.to_dataframe()
         trips['line_name'] = line_name
         logging.info(f"[{line_name}] Generated dataframe with {len(trips)} rows from response.")
 
-        if len(trips) == 0:
-            logging.warning(f'[{line_name}] Dataframe trips is empty!')
-            return None
-
-        # RATP data is not complete for metro and tramway
-        # Thus we have to manually build trips using the timetable and real-time data for next trains.
-        if transportation_type in ("TRAMWAY", "METRO"):
-            timetable_dir = os.path.join('data', 'timetable')
-            timetable_path = os.path.join(timetable_dir, line_short_id)
-            timetable = pd.read_parquet(timetable_path)
-
-            trips = rebuild_trip_ids_from_timetable(trips, timetable)
-            logging.info(f"[{line_name}] Rebuit trips using schedule.")
-        
-        # Add previous data for lines with trip id. Keep latest data.
-        else:
-            if line_short_id in trips_last_data.keys():
-                previous_trips = trips_last_data[line_short_id]
-                trips = pd.concat([trips, previous_trips])
-                trips = trips.sort_values('update_time').drop_duplicates(subset=['id', 'stop_short_id'],
-                                                                         keep='last')
-                logging.info(f"[{line_name}] Enrich dataframe with previous data.")
-
-                # Clean data older than 2 hours
-                trips = trips[trips['update_time'] >= np.datetime64('now') - np.timedelta64(2, 'h')]
-                logging.info(f"[{line_name}] Clean old data out of dataframe.")
-            trips_last_data[line_short_id] = trips
-
-        return trips
+        trips = rebuild_trip_ids_from_timetable(trips, get_timetable_index(line_short_id))
+        logging.info(f"[{line_name}] Rebuit trips using schedule.")
 
+    # Add previous data for lines with trip id. Keep latest data.
+    else:
+        trip_state = trip_states.setdefault(line_short_id, TripStateStore(ttl=2 * 3600))
+        trip_state.upsert(trips)
+
+        # Clean data older than 2 hours
+        trip_state.expire(time.time())
+
+        trips = trip_state.to_dataframe()
+        trips['line_name'] = line_name
+        logging.info(f"[{line_name}] Generated dataframe with {len(trips)} rows from trip state {trip_state.get_stats()}.")
+
+    return trips
+
+
+async def update_snapshot(line_short_id, trips, trajectories):
+    global snapshot
+    pending_lines[line_short_id] = (trips, trajectories)
+
+    # Snapshot is rebuilt out of the event loop, one rebuild at a time.
+    # Lines computed during a rebuild are applied together by the next one.
+    async with snapshot_lock:
+        if line_short_id not in pending_lines:
+            return
+        updates = dict(pending_lines)
+        pending_lines.clear()
+
+        start = time.perf_counter()
+        snapshot = await asyncio.to_thread(snapshot.with_lines, updates)
+        logging.info(f"Built {snapshot} with {len(updates)} updated lines in {time.perf_counter() - start:.2f} s.")
 
-async def retrieve_data():
-    global all_lines_trips
 
-    line_short_ids = set(stops.line_short_id)
-    # Only select first 5 lines in list for testing
-    line_short_ids = list(line_short_ids)[:5]
-    
+async def retrieve_line_data(line_short_id, schedule):
     try:
-        # Retrieve real-time data for all lines
-        all_trips = await asyncio.gather(*[get_line_trips(line_id) for line_id in line_short_ids])
-        
-        for trips in all_trips:
-            if trips is not None and not trips.empty:
-                # Get interpolated coordinates/timestamps for line trips
-                trips = compute_coords_timestamps(trips)
-
-                # Get line attributes
-                line_short_id = trips['line_short_id'].iloc[0]
-                
-                # Update all_line_trips
-                all_lines_trips[line_short_id] = trips
+        trips = await get_line_trips(line_short_id, schedule)
+
+        if trips is not None and not trips.empty:
+            # Get interpolated coordinates/timestamps for line trips
+            trips, trajectories = await compute_coords_timestamps(trips)
+
+            # Swap snapshot so that the line is published without waiting for other lines
+            await update_snapshot(line_short_id, trips, trajectories)
 
     except Exception as e:
         logging.error(traceback.format_exc())
 
 
-# Define the function that continuously retrieves data
-def run_retrieve_data():
-    while True:
-        asyncio.run(retrieve_data())
-
-        # Once data is retrieved, sleep until next scheduled fetch
-        time_to_sleep = get_remaining_time_until_next_fetch()
-        logging.info(f"Will sleep {time_to_sleep} seconds until next fetch...")
-        time.sleep(time_to_sleep)
+async def retrieve_data():
+    # Only poll stops whose adaptive polling interval has elapsed
+    now = time.time()
+    keys = [(line_short_id, short_id) for line_short_id, short_ids in stops_by_line.items() for short_id in short_ids
+            if line_short_id not in bulk_ingestion_lines]
+    due_keys = adaptive_poller.get_due_keys(keys, get_fetch_interval(), now, get_polling_tick())
+    due_stops_by_line = {}
+    for line_short_id, short_id in due_keys:
+        due_stops_by_line.setdefault(line_short_id, []).append(short_id)
+    logging.info(f"Adaptive polling: {len(due_keys)}/{len(keys)} stops due, {adaptive_poller.get_stats()}")
+
+    # Lines with bulk ingestion need a single request per cycle
+    for line_short_id in bulk_ingestion_lines:
+        if line_short_id in stops_by_line:
+            due_stops_by_line[line_short_id] = [None]
+
+    # Spread requests of all lines over the time until next fetch
+    interval = get_remaining_time_until_next_fetch()
+    schedule, report = fetch_planner.plan(due_stops_by_line, interval)
+    logging.info(f"Fetch plan: {report}")
+    if not report['fits']:
+        logging.warning(f"Full sweep of {report['requests']} requests takes {report['sweep_duration']:.0f} seconds "
+                        f"and does not fit in the {interval} seconds fetch interval.")
+
+    # Each line is processed as soon as its own requests are done
+    await asyncio.gather(*[retrieve_line_data(line_short_id, line_schedule)
+                           for line_short_id, line_schedule in schedule.items()])
+
+
+async def retrieve_data_forever():
+    # Workers are started from a fork server, as forking a process running an event loop is unsafe.
+    # Each worker has its own executor so that lines can be routed to it, and a share of the shortest paths memory.
+    trajectory_workers = settings_data.get("trajectory_workers") or os.cpu_count()
+    mp_context = multiprocessing.get_context('forkserver')
+    for _ in range(trajectory_workers):
+        trajectory_pools.append(ProcessPoolExecutor(max_workers=1,
+                                                    mp_context=mp_context,
+                                                    initializer=TrajectoryBuilder.init_worker,
+                                                    initargs=(shortest_paths_directory,
+                                                              shortest_paths_max_memory // trajectory_workers)))
+    logging.info(f"Started trajectory pool with {trajectory_workers} workers "
+                 f"({shortest_paths_max_memory // trajectory_workers / 1024 ** 2:.0f} MB of shortest paths each).")
+
+    # A single event loop is used so that the HTTP session of PRIM API is reused between fetches
+    try:
+        while True:
+            await retrieve_data()
+            logging.info(f"PRIM API connection stats: {prim.get_connection_stats()}")
+            logging.info(f"PRIM API scheduler stats: {prim.scheduler.get_stats()}")
+            logging.info(f"PRIM API response cache stats: {prim.get_response_cache_stats()}")
+
+            # Once data is retrieved, sleep until next scheduled fetch
+            time_to_sleep = get_remaining_time_until_next_fetch()
+            logging.info(f"Will sleep {time_to_sleep} seconds until next fetch...")
+            await asyncio.sleep(time_to_sleep)
+    finally:
+        await prim.close_session()
+        for trajectory_pool in trajectory_pools:
+            trajectory_pool.shutdown()
 
 
 async def publish_next_positions(timestamp, frequency):
-    global all_lines_trips
-
-    data = {}
+    # Keep a reference to the current snapshot, it may be swapped meanwhile
+    current = snapshot
 
-    def get_next_ts(lst, min_value, max_value):
-        for element in lst:
-            # Assuming each element is a tuple or a list with at least 2 elements
-            if len(element) >= 2 and element[0] >= min_value and element[0] < max_value:
-                # Return the first time_position with time between min_value and max_value
-                return element
+    # Interpolate, serialize and write out of the event loop
+    await asyncio.to_thread(position_publisher.publish, current, timestamp)
 
-        # Return None if no element meets the condition
-        return None  
+    if position_server is not None:
+        await position_server.update(current.tick_engine, timestamp)
 
-    for short_line_id in all_lines_trips:
-        df = all_lines_trips[short_line_id]
-        for i in range(len(df)):
-            line = df.iloc[i].copy()
-            if line.time_position:
-                next_time_position = get_next_ts(line.time_position,
-                                                 timestamp,
-                                                 frequency+timestamp)
-                
-                if next_time_position:
-                    line['time_position'] = next_time_position
-                    line['time_generated'] = timestamp
-                    data[line.id] = line.to_dict()
 
-    # Save data to disk as compressed json
-    if len(data) > 0:
-        filename = 'data/next.json.gz'
-        with gzip.open(filename, 'wt', encoding="utf-8") as file:
-            json.dump(data, file)
-            logging.info(f'Saved next positions to {filename}.')
+async def publish_next_positions_forever(frequency):
+    # Run every X seconds so that the UNIX timestamp of the execution is a multiple of frequency.
+    # Ticks are computed from the clock (not by adding durations), so that timing does not drift.
+    while True:
+        tick = (time.time() // frequency + 1) * frequency
+        await asyncio.sleep(tick - time.time())
 
+        delay = time.time() - tick
+        if delay > frequency / 2:
+            logging.warning(f"Publication of positions at {tick} started {delay:.1f} seconds late.")
 
-def run_publish_next_positions():
-    frequency = 10 # in seconds
+        try:
+            await publish_next_positions(tick, frequency)
+        except Exception as e:
+            logging.error(traceback.format_exc())
 
-    # Run every X seconds so that the UNIX timestamp of the execution is a multiple of frequency
-    while True:    
-        # Get the current time
-        now = time.time()
 
-        # Run coroutine
-        asyncio.run(publish_next_positions(now, frequency))
+async def main():
+    if position_server is not None:
+        await position_server.start(settings_data.get("server_host", "0.0.0.0"),
+                                    settings_data.get("server_port", 8000))
 
-        # Sleep until next execution
-        time.sleep((time.time() // frequency + 1) * frequency - time.time())
+    # Fetch, compute and publish share a single event loop
+    await asyncio.gather(retrieve_data_forever(),
+                         publish_next_positions_forever(settings_data.get("publish_frequency", 10)))
 
 
 if __name__=='__main__':
-    # Create threads
-    thread1 = threading.Thread(target=run_retrieve_data)
-    thread2 = threading.Thread(target=run_publish_next_positions)
-
-    # Start threads
-    thread1.start()
-    thread2.start()
-
-    thread1.join()
-    thread2.join()
+    load_state()
+    asyncio.run(main())
 
 
 ### DEBUG ###
 
-# Test for one line
-line_id = "C01383"  # METRO 13
-# line_id = "C01727"  # RER C
-# line_id = "C01743"  # RER B
-shortest_paths = gpd.read_parquet(f'data/shortest_paths/{line_id}.parquet')
-t = asyncio.run(get_line_trips(line_id))
+# Test for one line (guarded, as worker processes import this module)
+if __name__ == '__main__':
+    line_id = "C01383"  # METRO 13
+    # line_id = "C01727"  # RER C
+    # line_id = "C01743"  # RER B
+    t = asyncio.run(get_line_trips(line_id))
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class AdaptivePoller:
+    """Per-stop polling intervals based on how often stop data actually changes.
+
+    The change rate of each stop is an exponentially weighted moving average of
+    "payload changed since last poll". Polling intervals are inversely proportional
+    to the change rate, bounded to [min_interval_ratio, max_interval_ratio] times the
+    base interval, and scaled so that the total number of requests per base interval
+    stays equal to the number of stops (same request budget as uniform polling).
+    """
+
+    def __init__(self, smoothing=0.3, min_interval_ratio=0.5, max_interval_ratio=4.0,
+                 min_change_rate=0.05, initial_change_rate=1.0):
+        self.smoothing = smoothing
+        self.min_interval_ratio = min_interval_ratio
+        self.max_interval_ratio = max_interval_ratio
+        self.min_change_rate = min_change_rate
+        self.initial_change_rate = initial_change_rate
+
+        self.change_rates = {}
+        self.last_polls = {}
+        self.intervals = {}
+
+    def observe(self, key, changed, timestamp):
+        """Record the result of a poll of stop key (e.g. (line_short_id, stop_short_id))."""
+        previous = self.change_rates.get(key, self.initial_change_rate)
+        self.change_rates[key] = (1 - self.smoothing) * previous + self.smoothing * float(changed)
+        self.last_polls[key] = timestamp
+
+    def compute_intervals(self, keys, base_interval):
+        """Compute polling interval (in seconds) of each stop key for the given base interval."""
+        keys = list(keys)
+        if len(keys) == 0:
+            return {}
+
+        rates = np.array([max(self.min_change_rate, self.change_rates.get(k, self.initial_change_rate))
+                          for k in keys])
+        min_interval = self.min_interval_ratio * base_interval
+        max_interval = self.max_interval_ratio * base_interval
+        target_frequency = len(keys) / base_interval
+
+        # Find scale c such that intervals c / rate (bounded) sum up to the target request frequency
+        def total_frequency(c):
+            return np.sum(1 / np.clip(c / rates, min_interval, max_interval))
+
+        low, high = min_interval * rates.min(), max_interval * rates.max()
+        for _ in range(50):
+            c = (low + high) / 2
+            if total_frequency(c) > target_frequency:
+                low = c
+            else:
+                high = c
+
+        intervals = np.clip(high / rates, min_interval, max_interval)
+        self.intervals.update(zip(keys, intervals.tolist()))
+        return dict(zip(keys, intervals.tolist()))
+
+    def get_due_keys(self, keys, base_interval, timestamp, tick):
+        """Return stop keys whose polling interval has elapsed (with half a tick of tolerance)."""
+        intervals = self.compute_intervals(keys, base_interval)
+        return [k for k in keys
+                if k not in self.last_polls or timestamp - self.last_polls[k] >= intervals[k] - tick / 2]
+
+    def get_intervals(self):
+        """Return the effective polling interval (in seconds) of each stop key."""
+        return dict(self.intervals)
+
+    def get_stats(self):
+        if len(self.intervals) == 0:
+            return {'stops': 0}
+        intervals = np.array(list(self.intervals.values()))
+        return {'stops': len(intervals),
+                'min_interval': float(intervals.min()),
+                'median_interval': float(np.median(intervals)),
+                'max_interval': float(intervals.max())}
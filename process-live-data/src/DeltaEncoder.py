@@ -0,0 +1,208 @@
+import struct
+
+import numpy as np
+
+from src.PositionCodec import PositionCodec
+
+
+class DeltaEncoder:
+    """Encode positions of successive ticks as a stream of keyframes and deltas.
+
+    A keyframe holds every running vehicle and is emitted every keyframe_interval ticks.
+    Vehicles get a slot number in the keyframe (their index), and vehicles appearing
+    afterwards get the next free slots. Deltas only hold removed slots, added vehicles
+    (slot, attributes and position) and slots whose quantized position changed.
+
+    Every message has a sequence number and the sequence number of its keyframe: a client
+    applies a delta only if it follows the last message it applied, otherwise it waits
+    for (or fetches) the latest keyframe and the deltas since then.
+
+    Message layout (little-endian, arrays 4-byte aligned, see PositionCodec):
+        magic b'IDFD', version (u8), kind (u8, 0 keyframe / 1 delta), reserved (u16),
+        sequence (u32), keyframe sequence (u32), UNIX timestamp (u32),
+        bounding box (f64 x 4), number of slots after the message (u32)
+        removed: count (u32), slots (u32)
+        added: count (u32), slots (u32), key table of PositionCodec.KEYS, x (u16), y (u16)
+        moved: count (u32), slots (u32), x (u16), y (u16)
+    """
+
+    MAGIC = b'IDFD'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBBHIII4dI')
+
+    KEYFRAME = 0
+    DELTA = 1
+
+    def __init__(self, keyframe_interval=30, bbox=PositionCodec.BBOX):
+        self.keyframe_interval = keyframe_interval
+        self.bbox = bbox
+
+        self.sequence = -1
+        self.keyframe_sequence = None
+        self.n_slots = 0
+
+        # State after the last message, sorted by vehicle id
+        self.ids = np.empty(0, dtype=object)
+        self.keys = {k: np.empty(0, dtype=object) for k in PositionCodec.KEYS}
+        self.slots = np.empty(0, dtype=np.int64)
+        self.qx = np.empty(0, dtype='<u2')
+        self.qy = np.empty(0, dtype='<u2')
+
+        self.stats = {'keyframes': 0, 'deltas': 0, 'added': 0, 'removed': 0, 'moved': 0}
+
+    def encode(self, timestamp, keys, x, y):
+        """Return (kind, payload) of the message for the positions of the vehicles in keys at timestamp."""
+        min_lon, min_lat, max_lon, max_lat = self.bbox
+        self.sequence += 1
+
+        # Sort vehicles by id (a vehicle appearing twice is only kept once)
+        ids, first = np.unique(np.asarray(keys['id'], dtype=object).astype(str), return_index=True)
+        ids = ids.astype(object)
+        keys = {k: np.asarray(keys[k], dtype=object)[first] for k in PositionCodec.KEYS}
+        qx = PositionCodec.quantize(np.asarray(x)[first], min_lon, max_lon)
+        qy = PositionCodec.quantize(np.asarray(y)[first], min_lat, max_lat)
+
+        if self.keyframe_sequence is None or self.sequence - self.keyframe_sequence >= self.keyframe_interval:
+            kind = self.KEYFRAME
+            self.keyframe_sequence = self.sequence
+            removed_slots = np.empty(0, dtype=np.int64)
+            added = np.arange(len(ids))
+            slots = added.copy()
+            moved = np.empty(0, dtype=np.int64)
+            self.n_slots = len(ids)
+        else:
+            kind = self.DELTA
+            _, previous, current = np.intersect1d(self.ids, ids, assume_unique=True, return_indices=True)
+
+            # Vehicles whose attributes changed are removed and added again
+            unchanged = np.ones(len(current), dtype=bool)
+            for k in PositionCodec.KEYS[1:]:
+                unchanged &= self.keys[k][previous] == keys[k][current]
+            previous, current = previous[unchanged], current[unchanged]
+
+            kept_previous = np.zeros(len(self.ids), dtype=bool)
+            kept_previous[previous] = True
+            removed_slots = self.slots[~kept_previous]
+
+            slots = np.full(len(ids), -1, dtype=np.int64)
+            slots[current] = self.slots[previous]
+            added = np.flatnonzero(slots < 0)
+            slots[added] = self.n_slots + np.arange(len(added))
+            self.n_slots += len(added)
+
+            moved = current[(self.qx[previous] != qx[current]) | (self.qy[previous] != qy[current])]
+
+        payload = self.encode_message(kind, timestamp, removed_slots, slots[added],
+                                      {k: keys[k][added] for k in PositionCodec.KEYS}, qx[added], qy[added],
+                                      slots[moved], qx[moved], qy[moved])
+
+        self.ids, self.keys, self.slots, self.qx, self.qy = ids, keys, slots, qx, qy
+
+        self.stats['keyframes' if kind == self.KEYFRAME else 'deltas'] += 1
+        self.stats['added'] += len(added)
+        self.stats['removed'] += len(removed_slots)
+        self.stats['moved'] += len(moved)
+        return kind, payload
+
+    def encode_message(self, kind, timestamp, removed_slots, added_slots, added_keys, added_qx, added_qy,
+                       moved_slots, moved_qx, moved_qy):
+        chunks = [self.HEADER.pack(self.MAGIC, self.VERSION, kind, 0, self.sequence, self.keyframe_sequence,
+                                   int(timestamp), *self.bbox, self.n_slots)]
+        size = PositionCodec.pad(chunks, self.HEADER.size)
+
+        def append_arrays(arrays):
+            nonlocal size
+            chunks.append(struct.pack('<I', len(arrays[0])))
+            size += 4
+            for array in arrays:
+                chunks.append(array.tobytes())
+                size = PositionCodec.pad(chunks, size + len(chunks[-1]))
+
+        append_arrays([removed_slots.astype('<u4')])
+        append_arrays([added_slots.astype('<u4')])
+        for k in PositionCodec.KEYS:
+            size = PositionCodec.encode_strings(added_keys[k], chunks, size)
+        for array in (added_qx, added_qy):
+            chunks.append(array.tobytes())
+            size = PositionCodec.pad(chunks, size + len(chunks[-1]))
+        append_arrays([moved_slots.astype('<u4'), moved_qx, moved_qy])
+
+        return b''.join(chunks)
+
+    def get_stats(self):
+        return dict(self.stats, sequence=self.sequence, keyframe_sequence=self.keyframe_sequence, slots=self.n_slots)
+
+
+class DeltaDecoder:
+    """Reference client of DeltaEncoder streams, keeping the vehicles of each slot."""
+
+    def __init__(self):
+        self.sequence = None
+        self.keyframe_sequence = None
+        self.timestamp = None
+        self.vehicles = {}
+
+    @staticmethod
+    def decode(payload):
+        """Return the message as a dict."""
+        (magic, version, kind, _, sequence, keyframe_sequence, timestamp,
+         min_lon, min_lat, max_lon, max_lat, n_slots) = DeltaEncoder.HEADER.unpack_from(payload, 0)
+        if magic != DeltaEncoder.MAGIC or version != DeltaEncoder.VERSION:
+            raise ValueError(f"Unsupported position delta (magic {magic}, version {version}).")
+
+        read_array = PositionCodec.read_array
+        position = DeltaEncoder.HEADER.size + (-DeltaEncoder.HEADER.size % 4)
+
+        (n_removed,) = struct.unpack_from('<I', payload, position)
+        removed, position = read_array(payload, position + 4, '<u4', n_removed)
+
+        (n_added,) = struct.unpack_from('<I', payload, position)
+        added, position = read_array(payload, position + 4, '<u4', n_added)
+        added_keys = {}
+        for k in PositionCodec.KEYS:
+            added_keys[k], position = PositionCodec.decode_strings(payload, position, n_added)
+        added_qx, position = read_array(payload, position, '<u2', n_added)
+        added_qy, position = read_array(payload, position, '<u2', n_added)
+
+        (n_moved,) = struct.unpack_from('<I', payload, position)
+        moved, position = read_array(payload, position + 4, '<u4', n_moved)
+        moved_qx, position = read_array(payload, position, '<u2', n_moved)
+        moved_qy, position = read_array(payload, position, '<u2', n_moved)
+
+        def dequantize(qx, qy):
+            return (PositionCodec.dequantize(qx, min_lon, max_lon).tolist(),
+                    PositionCodec.dequantize(qy, min_lat, max_lat).tolist())
+
+        return {'kind': kind,
+                'sequence': sequence,
+                'keyframe_sequence': keyframe_sequence,
+                'timestamp': timestamp,
+                'slots': n_slots,
+                'removed': removed.tolist(),
+                'added': (added.tolist(), added_keys, *dequantize(added_qx, added_qy)),
+                'moved': (moved.tolist(), *dequantize(moved_qx, moved_qy))}
+
+    def apply(self, payload):
+        """Apply a message, return False (and ignore it) if a message is missing before it."""
+        message = self.decode(payload)
+
+        if message['kind'] == DeltaEncoder.KEYFRAME:
+            self.vehicles = {}
+        elif self.sequence is None or message['sequence'] != self.sequence + 1:
+            return False
+
+        for slot in message['removed']:
+            del self.vehicles[slot]
+
+        slots, keys, x, y = message['added']
+        for i, slot in enumerate(slots):
+            self.vehicles[slot] = dict({k: keys[k][i] for k in PositionCodec.KEYS}, x=x[i], y=y[i])
+
+        for slot, x, y in zip(*message['moved']):
+            self.vehicles[slot]['x'] = x
+            self.vehicles[slot]['y'] = y
+
+        self.sequence = message['sequence']
+        self.keyframe_sequence = message['keyframe_sequence']
+        self.timestamp = message['timestamp']
+        return True
@@ -0,0 +1,39 @@
+class FetchPlanner:
+    """Spread the stop requests of every line over a fetch interval.
+
+    Lines are fetched one after the other and requests are evenly spaced over the usable
+    part of the interval, so that the request rate stays flat and each line completes
+    (and can be published) as early as possible.
+    """
+
+    def __init__(self, requests_per_second=50, usable_interval_ratio=0.8):
+        self.requests_per_second = requests_per_second
+        # Keep the end of the interval free to compute and publish the last lines
+        self.usable_interval_ratio = usable_interval_ratio
+
+    def plan(self, stops_by_line, interval):
+        """Return ({line_short_id: [(delay in seconds, stop_short_id)]}, report).
+
+        stops_by_line is a dict {line_short_id: list of stop short ids}.
+        """
+        n_requests = sum(len(s) for s in stops_by_line.values())
+        sweep_duration = n_requests / self.requests_per_second
+        usable_interval = interval * self.usable_interval_ratio
+
+        # If the sweep does not fit, send requests as fast as the rate budget allows
+        spacing = max(usable_interval, sweep_duration) / n_requests if n_requests > 0 else 0.0
+
+        schedule = {}
+        i = 0
+        for line_short_id, stop_short_ids in stops_by_line.items():
+            schedule[line_short_id] = [(k * spacing, stop_short_id) for k, stop_short_id in enumerate(stop_short_ids, i)]
+            i += len(stop_short_ids)
+
+        report = {'lines': len(stops_by_line),
+                  'requests': n_requests,
+                  'interval': interval,
+                  'sweep_duration': sweep_duration,
+                  'rate_budget_usage': sweep_duration / usable_interval if usable_interval > 0 else float('inf'),
+                  'fits': sweep_duration <= usable_interval}
+
+        return schedule, report
@@ -1,9 +1,12 @@
-from shapely import MultiLineString, LineString
+from shapely import MultiLineString, LineString, Point
 from shapely.ops import linemerge
 from shapely.ops import linemerge, substring
 
 import numpy as np
-import networkx as nx
+
+from src.RailGraph import RailGraph
+from src.Snapper import Snapper
+from src.Utils import Utils
 
 class Line:
     def __init__(self, id, name, company, transportation_type):
@@ -13,10 +16,30 @@ class Line:
         self.transportation_type = transportation_type
         self.segments = []
         self.graph = None
+        self.snapper = None
         self.shortest_path = {}
     
     def compute_graph(self):
         self.graph = linemerge(MultiLineString(self.segments))
+        self.snapper = None
+
+    def get_snapper(self):
+        """Return the Snapper of vertices of the line graph (built once per graph)."""
+        if self.graph is None:
+            self.compute_graph()
+        if self.snapper is None:
+            segments = list(self.graph.geoms) if self.graph.geom_type == "MultiLineString" else [self.graph]
+            self.snapper = Snapper.from_geometries(segments)
+        return self.snapper
+
+    def snap_stops(self, stops):
+        """Set the nearest vertex of the line graph (point_on_graph) and its segment (segment_idx) of stops at once."""
+        snapper = self.get_snapper()
+        vertices, positions, _ = snapper.snap([stop.position.x for stop in stops],
+                                              [stop.position.y for stop in stops])
+        for stop, vertex, position in zip(stops, vertices, positions):
+            stop.segment_idx = int(snapper.geometry_index[vertex])
+            stop.point_on_graph = Point(position)
     
     def __compute_adjacency_matrix(self):
         # TODO: make graph connected
@@ -34,8 +57,11 @@ class Line:
     
     def compute_segment_shortest_paths(self):
         self.__compute_adjacency_matrix()
-        G = nx.from_numpy_array(self.adjacency_matrix)
-        self.segment_shortest_paths = nx.shortest_path(G)
+
+        # Going from a segment to the next one covers half of each of them
+        lengths = np.array([Utils.get_linestring_length_in_meters(x) for x in list(self.graph.geoms)])
+        sources, targets = np.nonzero(np.triu(self.adjacency_matrix, k=1))
+        self.segment_graph = RailGraph(len(lengths), sources, targets, (lengths[sources] + lengths[targets]) / 2)
     
     def compute_path_between_two_stops(self, stop1, stop2):
         line = self
@@ -50,7 +76,7 @@ class Line:
             For each sub-segment we find the intersection with the next sub-segment
             and we trim the sub-segment to that intersection.
             """
-            segment_indices = line.segment_shortest_paths[stop1.segment_idx][stop2.segment_idx]
+            segment_indices = line.segment_graph.get_path(stop1.segment_idx, stop2.segment_idx)
             
             left = line.graph.geoms[segment_indices[0]]
             first_segment_start_idx = left.coords[:].index(stop1.point_on_graph.coords[0])
@@ -5,17 +5,20 @@ import shutil
 import logging
 import pytz
 import traceback
-from tenacity import retry, stop_after_attempt, wait_fixed
+import os
+import time
+import re
+import hashlib
+import asyncio
+import aiohttp
 
 from src.Line import Line
 from src.Stop import Stop
 from src.Trip import Trip
 from src.Utils import Utils
 from src.ArrivalTime import ArrivalTime
-
-# Limit to 50 requests/second
-from aiolimiter import AsyncLimiter
-limiter = AsyncLimiter(50, time_period=1)
+from src.RequestScheduler import RequestScheduler
+from src.SIRIParser import SIRIParser
 
 logging.basicConfig(format='[%(asctime)s.%(msecs)03d] %(levelname)-8s %(message)s',
                     level=logging.INFO, datefmt='%H:%M:%S')
@@ -31,19 +34,126 @@ class PRIM_API:
     NETWORK_DATA_FILE_PATH = "raw_data/network.json"
 
     # Next trip data
-    NEXT_TRIPS_BASE_URL = "https://prim.iledefrance-mobilites.fr/marketplace/stop-monitoring?MonitoringRef=%s"
+    PRIM_BASE_URL = "https://prim.iledefrance-mobilites.fr/marketplace"
+    NEXT_TRIPS_BASE_URL = PRIM_BASE_URL + "/stop-monitoring?MonitoringRef=%s"
+
+    # Next trip data for all stops of a line (bulk ingestion)
+    ESTIMATED_TIMETABLE_BASE_URL = PRIM_BASE_URL + "/estimated-timetable?LineRef=%s"
 
     # GTFS data (used for timetable)
     STATIC_GTFS_URL = "https://eu.ftp.opendatasoft.com/stif/GTFS/IDFM-gtfs.zip"
     STATIC_GTFS_FILE_PATH = "raw_data/gtfs.zip"
     STATIC_GTFS_PATH = "raw_data/gtfs"
 
-    def __init__(self, api_key="dummy_api_key"):
+    # HTTP connection pool settings (shared by all lines and fetch cycles)
+    CONNECTION_LIMIT = 100
+    CONNECTION_LIMIT_PER_HOST = 50
+    DNS_CACHE_TTL = 300 # in seconds
+    KEEPALIVE_TIMEOUT = 60 # in seconds
+    REQUEST_TIMEOUT = 30 # in seconds
+    CONNECT_TIMEOUT = 10 # in seconds
+
+    # Retry policy for real-time requests
+    MAX_ATTEMPTS = 3
+    THROTTLED_STATUS = (429, 503)
+
+    # Priority of stops without any upcoming arrival (in seconds until next arrival)
+    IDLE_STOP_PRIORITY = 3600
+
+    # Fields changing on every response, ignored when fingerprinting payloads
+    VOLATILE_FIELDS = re.compile(rb'"ResponseTimestamp"\s*:\s*"[^"]*"')
+
+    def __init__(self, api_key="dummy_api_key", base_url=None, requests_per_second=50, daily_quota=None,
+                 record_dir=None):
         self.api_key = api_key
         self.lines = {}
         self.stops = {}
         self.trips = {}
 
+        # Base URL can be overridden to use a local fake server
+        if base_url is not None:
+            self.PRIM_BASE_URL = base_url.rstrip('/')
+            self.NEXT_TRIPS_BASE_URL = self.PRIM_BASE_URL + "/stop-monitoring?MonitoringRef=%s"
+            self.ESTIMATED_TIMETABLE_BASE_URL = self.PRIM_BASE_URL + "/estimated-timetable?LineRef=%s"
+
+        # Rate limiting, daily quota and retries of real-time requests
+        self.scheduler = RequestScheduler(requests_per_second=requests_per_second,
+                                          daily_quota=daily_quota)
+
+        # Next expected arrival (UNIX timestamp) at each stop, used to prioritise requests
+        self.next_arrival_at_stop = {}
+
+        # Fingerprint and parsed trips of the last payload of each (stop_short_id, line_short_id)
+        self.response_cache = {}
+        self.response_changed = {}
+        self.response_cache_stats = {'hits': 0, 'misses': 0}
+
+        # Directory where raw stop-monitoring payloads are recorded (used for benchmarks)
+        self.record_dir = record_dir
+        if record_dir is not None:
+            os.makedirs(record_dir, exist_ok=True)
+
+        # Long-lived aiohttp session, created on first request
+        self.session = None
+        self.connection_stats = {'requests': 0,
+                                 'connections_created': 0,
+                                 'connections_reused': 0,
+                                 'dns_cache_hits': 0,
+                                 'dns_cache_misses': 0}
+
+    def __create_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        stats = self.connection_stats
+
+        async def on_request_start(session, context, params):
+            stats['requests'] += 1
+
+        async def on_connection_create_end(session, context, params):
+            stats['connections_created'] += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            stats['connections_reused'] += 1
+
+        async def on_dns_cache_hit(session, context, params):
+            stats['dns_cache_hits'] += 1
+
+        async def on_dns_cache_miss(session, context, params):
+            stats['dns_cache_misses'] += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    async def get_session(self):
+        # The session is bound to the running event loop: create it once per process
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.CONNECTION_LIMIT,
+                                             limit_per_host=self.CONNECTION_LIMIT_PER_HOST,
+                                             ttl_dns_cache=self.DNS_CACHE_TTL,
+                                             keepalive_timeout=self.KEEPALIVE_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT,
+                                            sock_connect=self.CONNECT_TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=timeout,
+                                                 trace_configs=[self.__create_trace_config()])
+            logging.info("Created PRIM API HTTP session.")
+        return self.session
+
+    async def close_session(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logging.info("Closed PRIM API HTTP session.")
+        self.session = None
+
+    def get_connection_stats(self):
+        stats = dict(self.connection_stats)
+        connections = stats['connections_created'] + stats['connections_reused']
+        stats['reuse_ratio'] = stats['connections_reused'] / connections if connections > 0 else 0.0
+        return stats
+
     def __download_json_data(self, url, file_path):
         try:
             # Sending a GET request to the API endpoint
@@ -161,32 +271,152 @@ class PRIM_API:
             return None
 
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(1)) # Retry using tenacity
-    async def get_next_trips_at_stop(self, stop_short_id, line_short_id, session):
+    def get_stop_priority(self, stop_short_id):
+        # Stops never polled come first, then stops with imminent arrivals
+        if stop_short_id not in self.next_arrival_at_stop:
+            return 0
+        next_arrival = self.next_arrival_at_stop[stop_short_id]
+        if next_arrival is None:
+            return self.IDLE_STOP_PRIORITY
+        return max(0, next_arrival - time.time())
+
+    @classmethod
+    def get_payload_fingerprint(cls, body):
+        return hashlib.blake2b(cls.VOLATILE_FIELDS.sub(b'', body), digest_size=16).digest()
+
+    def is_response_changed(self, stop_short_id, line_short_id):
+        """Return whether the last payload received for the stop differed from the previous one.
+
+        stop_short_id is None for estimated-timetable requests of the whole line.
+        """
+        return self.response_changed.get((stop_short_id, line_short_id), True)
+
+    def get_response_cache_stats(self):
+        stats = dict(self.response_cache_stats)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total > 0 else 0.0
+        return stats
+
+    async def __fetch_body(self, url, priority, description, session=None):
+        """Return raw body of a GET request on PRIM API, or None if every attempt failed."""
+        if session is None:
+            session = await self.get_session()
+        headers = {
+            "apiKey": self.api_key,
+            "accept": "application/json"
+        }
+
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            # Wait for the request scheduler
+            await self.scheduler.acquire(priority)
+
+            try:
+                # Fetch data using AioHttp
+                async with session.get(url, headers=headers) as resp:
+                    if resp.status in self.THROTTLED_STATUS:
+                        delay = self.scheduler.throttle(resp.headers.get('Retry-After'), attempt)
+                        logging.warning(f"Throttled by PRIM API (status {resp.status}) for {description}, "
+                                        f"pausing requests for {delay:.1f} seconds.")
+                        continue
+
+                    resp.raise_for_status()
+                    body = await resp.read()
+                    logging.debug(f"Got data for {description} from {url}")
+                    return body
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = self.scheduler.get_backoff(attempt)
+                logging.warning(f"Request for {description} failed ({e!r}), "
+                                f"attempt {attempt}/{self.MAX_ATTEMPTS}.")
+                if attempt < self.MAX_ATTEMPTS:
+                    await asyncio.sleep(delay)
+
+        logging.error(f"Could not get data for {description} after {self.MAX_ATTEMPTS} attempts.")
+        return None
+
+    def __get_cached_response(self, cache_key, body):
+        """Return cached parse of body if it did not change since last request, else None."""
+        fingerprint = self.get_payload_fingerprint(body)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None and cached[0] == fingerprint:
+            self.response_cache_stats['hits'] += 1
+            self.response_changed[cache_key] = False
+            return fingerprint, cached[1]
+        self.response_cache_stats['misses'] += 1
+        return fingerprint, None
+
+    def __record_payload(self, name, body):
+        if self.record_dir is not None:
+            with open(os.path.join(self.record_dir, f"{name}_{int(time.time())}.json"), 'wb') as f:
+                f.write(body)
+
+    async def get_next_trips_at_stop(self, stop_short_id, line_short_id, session=None, priority=None):
+        """Get next trips at a stop, or None if the request or the parsing of its payload failed."""
+        if priority is None:
+            priority = self.get_stop_priority(stop_short_id)
+
         # Create URL for the next trips of the stop
         url_arg_stop = urllib.parse.quote(f"STIF:StopPoint:Q:{stop_short_id}:")
         url = self.NEXT_TRIPS_BASE_URL % url_arg_stop
 
-        # Fetch data using the AsyncLimiter
-        async with limiter:
-            headers = {
-                "apiKey": self.api_key,
-                "accept": "application/json"
-            }
-
-            # Fetch data using AioHttp
-            async with session.get(url, headers=headers) as resp:
-                json_data = await resp.json()
-                logging.debug(f"Got data for stop {stop_short_id} from {url}")
-
-                try:
-                    trips = json_data['Siri']['ServiceDelivery']['StopMonitoringDelivery'][0]['MonitoredStopVisit']
-                    return [self.parse_trip_json(trip, stop_short_id, line_short_id) for trip in trips]
-                except Exception as e:
-                    logging.error(e)
-                    logging.error(json_data)
-        
-    
+        body = await self.__fetch_body(url, priority, f"stop {stop_short_id}", session)
+        if body is None:
+            return None
+
+        # Skip decoding and parsing if the payload did not change since last poll
+        cache_key = (stop_short_id, line_short_id)
+        fingerprint, trips = self.__get_cached_response(cache_key, body)
+        if trips is not None:
+            return trips
+
+        self.__record_payload(f"{line_short_id}_{stop_short_id}", body)
+
+        try:
+            trips = SIRIParser.parse_stop_monitoring(body, stop_short_id, line_short_id)
+        except Exception as e:
+            logging.error(f"Could not parse payload of stop {stop_short_id}: {e!r}")
+            return None
+
+        self.response_cache[cache_key] = (fingerprint, trips)
+        self.response_changed[cache_key] = True
+
+        # Remember next arrival at stop to prioritise the next request
+        self.next_arrival_at_stop[stop_short_id] = min(trips.arrival_time) if len(trips) > 0 else None
+        return trips
+
+    async def get_line_estimated_timetable(self, line_short_id, stop_short_ids=None, stop_names=None,
+                                           session=None, priority=0):
+        """Get next trips at every stop of a line with a single estimated-timetable request.
+
+        Rows have the same schema as get_next_trips_at_stop. Only stops in stop_short_ids are
+        kept (if given), and stop_names ({stop_short_id: name}) fills names missing from calls.
+        Return None if the request or the parsing of its payload failed.
+        """
+        url_arg_line = urllib.parse.quote(f"STIF:Line::{line_short_id}:")
+        url = self.ESTIMATED_TIMETABLE_BASE_URL % url_arg_line
+
+        body = await self.__fetch_body(url, priority, f"line {line_short_id}", session)
+        if body is None:
+            return None
+
+        # Skip decoding and parsing if the payload did not change since last poll
+        cache_key = (None, line_short_id)
+        fingerprint, trips = self.__get_cached_response(cache_key, body)
+        if trips is not None:
+            return trips
+
+        self.__record_payload(f"{line_short_id}_line", body)
+
+        try:
+            trips = SIRIParser.parse_estimated_timetable(body, line_short_id, stop_short_ids, stop_names)
+        except Exception as e:
+            logging.error(f"Could not parse estimated timetable of line {line_short_id}: {e!r}")
+            return None
+
+        self.response_cache[cache_key] = (fingerprint, trips)
+        self.response_changed[cache_key] = True
+        return trips
+
     def get_arrival_times_by_stop(self, stop):
         try:
             url = self.NEXT_TRIPS_BASE_URL + urllib.parse.quote(f"STIF:StopPoint:Q:{stop.get_short_id()}:")
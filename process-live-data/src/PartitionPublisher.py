@@ -0,0 +1,122 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from src.PositionCodec import PositionCodec
+from src.Tiles import Tiles
+from src.Utils import Utils
+
+
+class PartitionPublisher:
+    """Write position frames partitioned by slippy tile and by line, so that clients only fetch what they display.
+
+    A vehicle belongs to the partition of every tile it goes through during the frame, and
+    to the partition of its line. Each partition is a gzipped PositionCodec frame written to
+    <directory>/tiles/<zoom>/<x>/<y>.bin.gz or <directory>/lines/<line_short_id>.bin.gz.
+
+    A partition is only rewritten when its vehicles (or the data of their line) changed, or
+    when half of its frame has elapsed. <directory>/manifest.json lists every partition with
+    the start of its frame, and the partitions changed or removed at the last tick.
+    """
+
+    def __init__(self, directory, write_atomic, zoom=13, horizon=120, resolution=10, compresslevel=6):
+        self.directory = directory
+        # Function writing bytes to a path atomically (see PositionPublisher.write_atomic)
+        self.write_atomic = write_atomic
+        self.zoom = zoom
+        self.horizon = horizon
+        self.resolution = resolution
+        self.compresslevel = compresslevel
+
+        # {partition key: (fingerprint, frame start)} of written partitions
+        self.partitions = {}
+
+    def get_partitions(self, keys, ticks, tiles):
+        """Return {partition key: sorted vehicle indices} of a frame."""
+        n = 2 ** self.zoom
+
+        # Every (tile, vehicle) of the frame
+        vehicles = np.concatenate([v for v, x, y in ticks])
+        codes = np.concatenate(tiles)
+        pairs = np.unique(np.stack([codes, vehicles]), axis=1) if len(vehicles) else np.empty((2, 0), dtype=np.int64)
+
+        partitions = {}
+        for code, idx in Utils.group_indices(pairs[0]):
+            partitions[f"tiles/{Tiles.get_key(code // n, code % n, self.zoom)}"] = pairs[1][idx]
+        for line_short_id, idx in Utils.group_indices(np.asarray(keys['line_short_id']).astype(str)):
+            partitions[f"lines/{line_short_id}"] = idx
+        return partitions
+
+    @staticmethod
+    def get_rows(keys, ticks):
+        """Return, for each tick, the position of every vehicle of the key table in the tick (-1 if not running)."""
+        rows = np.full((len(ticks), len(keys['id'])), -1, dtype=np.int64)
+        for i, (vehicles, x, y) in enumerate(ticks):
+            rows[i, vehicles] = np.arange(len(vehicles))
+        return rows
+
+    @staticmethod
+    def select(keys, ticks, rows, selected):
+        """Return key table and ticks of the frame restricted to selected (sorted) vehicle indices."""
+        sub_keys = {k: np.asarray(v)[selected] for k, v in keys.items()}
+        sub_ticks = []
+        for (vehicles, x, y), tick_rows in zip(ticks, rows[:, selected]):
+            running = np.flatnonzero(tick_rows >= 0)
+            sub_ticks.append((running, x[tick_rows[running]], y[tick_rows[running]]))
+        return sub_keys, sub_ticks
+
+    @staticmethod
+    def get_fingerprint(keys, selected, line_versions):
+        # Positions of a vehicle only depend on its trajectory, which changes with the data of its line
+        h = hashlib.blake2b(digest_size=16)
+        for trip_id, line_short_id in zip(np.asarray(keys['id'])[selected], np.asarray(keys['line_short_id'])[selected]):
+            h.update(f"{trip_id}:{line_versions.get(line_short_id)}\n".encode('utf-8'))
+        return h.hexdigest()
+
+    def publish(self, start, keys, ticks, tiles, line_versions):
+        """Write changed partitions of the frame starting at start and the manifest.
+
+        keys and ticks are the key table and (vehicle indices, x, y) of each tick of the frame
+        (see PositionPublisher.get_frame_arrays), tiles the tile codes of the vehicles of each tick.
+        """
+        partitions = self.get_partitions(keys, ticks, tiles)
+
+        rows = self.get_rows(keys, ticks)
+        changed = []
+        for key, selected in partitions.items():
+            fingerprint = self.get_fingerprint(keys, selected, line_versions)
+            previous = self.partitions.get(key)
+            if previous is not None and previous[0] == fingerprint and start - previous[1] < self.horizon / 2:
+                continue
+
+            sub_keys, sub_ticks = self.select(keys, ticks, rows, selected)
+            payload = PositionCodec.encode(start, self.resolution, sub_keys, sub_ticks)
+            path = os.path.join(self.directory, f"{key}.bin.gz")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.write_atomic(path, gzip.compress(payload, compresslevel=self.compresslevel))
+            self.partitions[key] = (fingerprint, start)
+            changed.append(key)
+
+        removed = [key for key in self.partitions if key not in partitions]
+        for key in removed:
+            del self.partitions[key]
+            path = os.path.join(self.directory, f"{key}.bin.gz")
+            if os.path.exists(path):
+                os.remove(path)
+
+        manifest = {'timestamp': start,
+                    'zoom': self.zoom,
+                    'horizon': self.horizon,
+                    'resolution': self.resolution,
+                    'partitions': {key: {'start': self.partitions[key][1], 'vehicles': len(partitions[key])}
+                                   for key in sorted(partitions)},
+                    'changed': sorted(changed),
+                    'removed': sorted(removed)}
+        self.write_atomic(os.path.join(self.directory, 'manifest.json'), json.dumps(manifest).encode('utf-8'))
+        logging.info(f"Saved {len(changed)}/{len(partitions)} changed partitions ({len(removed)} removed) "
+                     f"to {self.directory}.")
+        return changed, removed
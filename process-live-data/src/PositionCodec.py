@@ -0,0 +1,150 @@
+import struct
+
+import numpy as np
+
+
+class PositionCodec:
+    """Compact binary columnar encoding of position frames (see PositionPublisher).
+
+    All values are little-endian and every array starts on a 4-byte boundary, so that
+    clients can read arrays without copying them (e.g. typed arrays in a browser).
+
+    Header:
+        magic b'IDFP', version (u8), reserved (u8), number of ticks (u16),
+        first tick UNIX timestamp (u32), seconds between ticks (u16), reserved (u16),
+        bounding box min_lon, min_lat, max_lon, max_lat (f64 x 4), number of vehicles (u32)
+    Key table, for each of KEYS:
+        number of distinct values n (u32), index width in bytes w (u8), padding,
+        string offsets (u32 x (n + 1)), UTF-8 strings, padding,
+        index of the value of each vehicle (u16 or u32 depending on w), padding
+    Then for each tick:
+        number of running vehicles m (u32), vehicle indices in the key table (u16 or u32
+        depending on the number of vehicles), padding, x (u16 x m), padding, y (u16 x m), padding
+
+    Coordinates are quantized on 16 bits over the bounding box (about 3 meters in Ile-de-France).
+    """
+
+    MAGIC = b'IDFP'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBBHIHH4dI')
+
+    KEYS = ['id', 'line_short_id', 'name', 'destination_id']
+
+    # Ile-de-France (min_lon, min_lat, max_lon, max_lat)
+    BBOX = (1.340332, 48.045038, 3.718872, 49.353756)
+
+    QUANTIZATION_STEPS = 65535
+
+    @staticmethod
+    def pad(chunks, size):
+        padding = -size % 4
+        if padding:
+            chunks.append(b'\x00' * padding)
+        return size + padding
+
+    @staticmethod
+    def get_index_dtype(n):
+        return np.dtype('<u2') if n <= 0xFFFF else np.dtype('<u4')
+
+    @classmethod
+    def quantize(cls, values, low, high):
+        q = np.rint((np.asarray(values, dtype=np.float64) - low) * (cls.QUANTIZATION_STEPS / (high - low)))
+        return np.clip(q, 0, cls.QUANTIZATION_STEPS).astype('<u2')
+
+    @classmethod
+    def dequantize(cls, q, low, high):
+        return low + q.astype(np.float64) * ((high - low) / cls.QUANTIZATION_STEPS)
+
+    @classmethod
+    def encode_strings(cls, values, chunks, size):
+        """Append dictionary of values and index of each value to chunks, return new size."""
+        uniques, inverse = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+        encoded = [s.encode('utf-8') for s in uniques]
+        offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        index_dtype = cls.get_index_dtype(len(uniques))
+
+        chunks.append(struct.pack('<IB', len(uniques), index_dtype.itemsize))
+        size = cls.pad(chunks, size + 5)
+        for chunk in (offsets.tobytes(), b''.join(encoded), inverse.astype(index_dtype).tobytes()):
+            chunks.append(chunk)
+            size = cls.pad(chunks, size + len(chunk))
+        return size
+
+    @classmethod
+    def encode(cls, start, resolution, keys, ticks, bbox=BBOX):
+        """Encode a frame.
+
+        keys is a dict {key: array of the value of each vehicle} and ticks a list of
+        (vehicle indices, x, y) arrays, the first tick being at start (integer seconds).
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        n_vehicles = len(keys[cls.KEYS[0]])
+        vehicle_dtype = cls.get_index_dtype(n_vehicles)
+
+        chunks = [cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, len(ticks), int(start), int(resolution), 0,
+                                  min_lon, min_lat, max_lon, max_lat, n_vehicles)]
+        size = cls.pad(chunks, cls.HEADER.size)
+
+        for k in cls.KEYS:
+            size = cls.encode_strings(keys[k], chunks, size)
+
+        for vehicles, x, y in ticks:
+            chunks.append(struct.pack('<I', len(vehicles)))
+            size += 4
+            for chunk in (np.asarray(vehicles).astype(vehicle_dtype).tobytes(),
+                          cls.quantize(x, min_lon, max_lon).tobytes(),
+                          cls.quantize(y, min_lat, max_lat).tobytes()):
+                chunks.append(chunk)
+                size = cls.pad(chunks, size + len(chunk))
+
+        return b''.join(chunks)
+
+    @staticmethod
+    def read_array(payload, position, dtype, count):
+        """Return (array, position of the next 4-byte aligned value)."""
+        array = np.frombuffer(payload, dtype=dtype, count=count, offset=position)
+        return array, position + array.nbytes + (-array.nbytes % 4)
+
+    @classmethod
+    def decode_strings(cls, payload, position, n_values):
+        """Return (list of the n_values strings, position after them) from a string column written by encode_strings."""
+        n_strings, width = struct.unpack_from('<IB', payload, position)
+        offsets, position = cls.read_array(payload, position + 8, '<u4', n_strings + 1)
+        blob, position = cls.read_array(payload, position, 'u1', int(offsets[-1]))
+        blob = blob.tobytes()
+        strings = [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(n_strings)]
+        index, position = cls.read_array(payload, position, np.dtype(f'<u{width}'), n_values)
+        return [strings[i] for i in index], position
+
+    @classmethod
+    def decode(cls, payload):
+        """Reference decoder, returns a dict with the same structure as JSON frames."""
+        (magic, version, _, n_ticks, start, resolution, _,
+         min_lon, min_lat, max_lon, max_lat, n_vehicles) = cls.HEADER.unpack_from(payload, 0)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError(f"Unsupported position payload (magic {magic}, version {version}).")
+
+        position = cls.HEADER.size + (-cls.HEADER.size % 4)
+        keys = {}
+        for k in cls.KEYS:
+            keys[k], position = cls.decode_strings(payload, position, n_vehicles)
+
+        vehicle_dtype = cls.get_index_dtype(n_vehicles)
+        ticks = []
+        for t in range(n_ticks):
+            (n_active,) = struct.unpack_from('<I', payload, position)
+            vehicles, position = cls.read_array(payload, position + 4, vehicle_dtype, n_active)
+            qx, position = cls.read_array(payload, position, '<u2', n_active)
+            qy, position = cls.read_array(payload, position, '<u2', n_active)
+            ticks.append({'time': start + t * resolution,
+                          'vehicles': vehicles.tolist(),
+                          'x': cls.dequantize(qx, min_lon, max_lon).tolist(),
+                          'y': cls.dequantize(qy, min_lat, max_lat).tolist()})
+
+        return {'start': start,
+                'resolution': resolution,
+                'horizon': n_ticks * resolution,
+                'bbox': (min_lon, min_lat, max_lon, max_lat),
+                'keys': keys,
+                'ticks': ticks}
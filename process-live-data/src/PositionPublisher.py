@@ -0,0 +1,167 @@
+import glob
+import gzip
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from src.DeltaEncoder import DeltaEncoder
+from src.PartitionPublisher import PartitionPublisher
+from src.PositionCodec import PositionCodec
+
+
+class PositionPublisher:
+    """Write vehicle positions to disk as multi-tick frames.
+
+    A frame covers the next `horizon` seconds at `resolution` seconds per tick. Vehicle
+    attributes are written once in a key table shared by every tick, and each tick only
+    holds indices into that table and coordinates, so that clients can animate vehicles
+    for the whole horizon from a single download.
+
+    Frames are written as JSON and in the binary format of PositionCodec (both gzipped).
+    Positions of each tick are also written as a DeltaEncoder message to stream/<sequence>.bin.gz,
+    the latest keyframe being stream/keyframe.bin.gz. With partition_zoom, frames are also
+    split by tile and by line in partitions/ (see PartitionPublisher).
+
+    Files are written to a temporary file and renamed, so readers never see a partial file.
+    """
+
+    COORDINATES_DECIMALS = 6
+    BINARY_COMPRESSION_LEVEL = 6
+
+    def __init__(self, directory='data', horizon=120, resolution=10, keyframe_interval=30, partition_zoom=None):
+        self.directory = directory
+        self.horizon = horizon
+        self.resolution = resolution
+
+        # Stream of keyframes and deltas, one message per tick
+        self.stream_directory = os.path.join(directory, 'stream')
+        self.delta_encoder = DeltaEncoder(keyframe_interval=keyframe_interval)
+        self.keyframe_sequences = []
+
+        self.partition_publisher = None
+        if partition_zoom is not None:
+            self.partition_publisher = PartitionPublisher(os.path.join(directory, 'partitions'), self.write_atomic,
+                                                          zoom=partition_zoom, horizon=horizon, resolution=resolution,
+                                                          compresslevel=self.BINARY_COMPRESSION_LEVEL)
+
+    @staticmethod
+    def write_atomic(path, payload):
+        """Write bytes to path through a temporary file in the same directory and os.replace."""
+        directory = os.path.dirname(path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(payload)
+            # Temporary files are only readable by their owner
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def write_json_gz(cls, path, data):
+        cls.write_atomic(path, gzip.compress(json.dumps(data).encode('utf-8')))
+
+    def write_bin_gz(self, path, start, keys, ticks):
+        # Trip ids make most of the payload and compress well
+        payload = PositionCodec.encode(start, self.resolution, keys, ticks)
+        self.write_atomic(path, gzip.compress(payload, compresslevel=self.BINARY_COMPRESSION_LEVEL))
+
+    def write_stream_message(self, start, keys, x, y):
+        # Sequence numbers restart with the process, remove messages of the previous run
+        if self.delta_encoder.sequence < 0:
+            os.makedirs(self.stream_directory, exist_ok=True)
+            for path in glob.glob(os.path.join(self.stream_directory, '*.bin.gz')):
+                os.remove(path)
+
+        kind, payload = self.delta_encoder.encode(start, keys, x, y)
+        payload = gzip.compress(payload, compresslevel=self.BINARY_COMPRESSION_LEVEL)
+        sequence = self.delta_encoder.sequence
+        self.write_atomic(os.path.join(self.stream_directory, f'{sequence}.bin.gz'), payload)
+
+        if kind == DeltaEncoder.KEYFRAME:
+            self.write_atomic(os.path.join(self.stream_directory, 'keyframe.bin.gz'), payload)
+
+            # Keep messages since the previous keyframe, for clients catching up
+            self.keyframe_sequences = self.keyframe_sequences[-1:] + [sequence]
+            for old_sequence in range(self.keyframe_sequences[0] - self.delta_encoder.keyframe_interval,
+                                      self.keyframe_sequences[0]):
+                path = os.path.join(self.stream_directory, f'{old_sequence}.bin.gz')
+                if os.path.exists(path):
+                    os.remove(path)
+
+        return kind, len(payload)
+
+    def get_ticks(self, start):
+        n_ticks = max(1, int(self.horizon // self.resolution))
+        return start + self.resolution * np.arange(n_ticks)
+
+    def get_frame_arrays(self, tick_engine, start, zoom=None):
+        """Return key table {key: array}, (vehicle indices, x, y) of each tick of the frame starting at start,
+        and tile codes at zoom of the vehicles of each tick (None without zoom)."""
+        if zoom is None:
+            positions = [(*tick_engine.get_positions(t), None) for t in self.get_ticks(start)]
+        else:
+            positions = [tick_engine.get_tiles(t, zoom) for t in self.get_ticks(start)]
+
+        # Key table of every vehicle running during the frame
+        trips = np.unique(np.concatenate([active for active, x, y, tiles in positions]))
+        keys = {k: tick_engine.metadata[k][trips] for k in tick_engine.METADATA_KEYS}
+        ticks = [(np.searchsorted(trips, active), x, y) for active, x, y, tiles in positions]
+        tiles = None if zoom is None else [tiles for active, x, y, tiles in positions]
+        return keys, ticks, tiles
+
+    def build_frame(self, start, keys, ticks):
+        """Return the JSON frame of positions of vehicles running between start and start + horizon."""
+        frame_ticks = []
+        for t, (vehicles, x, y) in zip(self.get_ticks(start), ticks):
+            frame_ticks.append({
+                'time': float(t),
+                'vehicles': vehicles.tolist(),
+                'x': np.round(x, self.COORDINATES_DECIMALS).tolist(),
+                'y': np.round(y, self.COORDINATES_DECIMALS).tolist(),
+            })
+
+        return {'start': float(start),
+                'resolution': self.resolution,
+                'horizon': self.horizon,
+                'keys': {k: v.tolist() for k, v in keys.items()},
+                'ticks': frame_ticks}
+
+    def publish(self, snapshot, start):
+        """Write positions at start (next.*) and the frame starting at start (frames.*), as JSON and binary."""
+        tick_engine = snapshot.tick_engine
+
+        # Single tick positions, as published so far
+        data = tick_engine.get_vehicles(start)
+        if len(data) == 0:
+            return
+
+        path = os.path.join(self.directory, 'next.json.gz')
+        self.write_json_gz(path, data)
+        logging.info(f'Saved next positions to {path}.')
+
+        active, x, y = tick_engine.get_positions(start)
+        keys = {k: tick_engine.metadata[k][active] for k in tick_engine.METADATA_KEYS}
+        path = os.path.join(self.directory, 'next.bin.gz')
+        self.write_bin_gz(path, start, keys, [(np.arange(len(active)), x, y)])
+        logging.info(f'Saved next positions to {path}.')
+
+        kind, size = self.write_stream_message(start, keys, x, y)
+        logging.info(f"Saved {'keyframe' if kind == DeltaEncoder.KEYFRAME else 'delta'} "
+                     f"{self.delta_encoder.sequence} ({size} bytes) to {self.stream_directory}.")
+
+        zoom = None if self.partition_publisher is None else self.partition_publisher.zoom
+        keys, ticks, tiles = self.get_frame_arrays(tick_engine, start, zoom)
+        path = os.path.join(self.directory, 'frames.json.gz')
+        self.write_json_gz(path, self.build_frame(start, keys, ticks))
+        path = os.path.join(self.directory, 'frames.bin.gz')
+        self.write_bin_gz(path, start, keys, ticks)
+        logging.info(f"Saved {len(ticks)} ticks of {len(keys['id'])} vehicles to frames.json.gz and frames.bin.gz.")
+
+        if self.partition_publisher is not None:
+            self.partition_publisher.publish(start, keys, ticks, tiles, snapshot.line_versions)
@@ -0,0 +1,240 @@
+import asyncio
+import gzip
+import json
+import logging
+import struct
+
+import numpy as np
+from aiohttp import web, WSMsgType
+
+from src.PositionCodec import PositionCodec
+from src.Tiles import Tiles
+from src.Utils import Utils
+
+
+class PositionClient:
+    """WebSocket client with its subscribed groups and a bounded queue of messages to send."""
+
+    def __init__(self, ws, queue_size):
+        self.ws = ws
+        self.groups = set()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def push(self, messages):
+        # Slow clients skip ticks instead of delaying other clients
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(messages)
+
+    async def send_forever(self):
+        try:
+            while True:
+                for message in await self.queue.get():
+                    await self.ws.send_bytes(message)
+        except ConnectionError:
+            # Client is gone, the WebSocket handler removes it
+            pass
+
+
+class PositionServer:
+    """HTTP/WebSocket server of the latest positions, kept in memory.
+
+    At each tick, vehicles are split in groups (slippy tiles at a fixed zoom and lines),
+    and each group is encoded once (gzipped PositionCodec frame), whatever the number of
+    clients subscribed to it.
+
+    HTTP (with ETag / If-None-Match):
+        /positions                          every vehicle
+        /positions/tiles/{zoom}/{x}/{y}     vehicles of a tile
+        /positions/lines/{line_short_id}    vehicles of a line
+        /stats                              server statistics
+    WebSocket (/ws): clients send {"bbox": [min_lon, min_lat, max_lon, max_lat]} and/or
+    {"lines": [line_short_id, ...]} and receive one binary message per subscribed group at
+    each tick: group key length (u16), group key (UTF-8, e.g. "tile/11/1036/704" or
+    "line/C01742"), then the gzipped frame. A frame without vehicles means the group is empty.
+    """
+
+    def __init__(self, zoom=11, max_tiles=256, queue_size=2, compresslevel=6):
+        self.zoom = zoom
+        self.max_tiles = max_tiles
+        self.queue_size = queue_size
+        self.compresslevel = compresslevel
+
+        self.timestamp = None
+        self.etag = None
+        self.snapshot = None
+        self.payloads = {}
+        self.messages = {}
+        self.clients = set()
+        self.stats = {'ticks': 0, 'messages': 0, 'not_modified': 0}
+
+    def encode(self, timestamp, keys, x, y):
+        payload = PositionCodec.encode(timestamp, 0, keys, [(np.arange(len(x)), x, y)])
+        return gzip.compress(payload, compresslevel=self.compresslevel)
+
+    def encode_empty(self, timestamp):
+        return self.encode(timestamp, {k: np.empty(0, dtype=object) for k in PositionCodec.KEYS},
+                           np.empty(0), np.empty(0))
+
+    @staticmethod
+    def frame_message(group, payload):
+        group = group.encode('utf-8')
+        return struct.pack('<H', len(group)) + group + payload
+
+    def encode_groups(self, tick_engine, timestamp):
+        """Return (payload of every vehicle, {group: payload}) of positions at timestamp."""
+        active, x, y = tick_engine.get_positions(timestamp)
+        keys = {k: tick_engine.metadata[k][active] for k in PositionCodec.KEYS}
+        snapshot = self.encode(timestamp, keys, x, y)
+
+        tile_x, tile_y = Tiles.lonlat_to_tile(x, y, self.zoom)
+        n = 2 ** self.zoom
+        groups = [(f"tile/{Tiles.get_key(code // n, code % n, self.zoom)}", idx)
+                  for code, idx in Utils.group_indices(tile_x * n + tile_y)]
+        groups += [(f"line/{line}", idx) for line, idx in Utils.group_indices(keys['line_short_id'].astype(str))]
+
+        payloads = {}
+        for group, idx in groups:
+            payloads[group] = self.encode(timestamp, {k: v[idx] for k, v in keys.items()}, x[idx], y[idx])
+        return snapshot, payloads
+
+    async def update(self, tick_engine, timestamp):
+        """Encode positions at timestamp and push them to WebSocket clients."""
+        snapshot, payloads = await asyncio.to_thread(self.encode_groups, tick_engine, timestamp)
+        messages = {group: self.frame_message(group, payload) for group, payload in payloads.items()}
+
+        # Groups that became empty are sent once, so that clients clear them
+        if len(self.payloads.keys() - payloads.keys()) > 0:
+            empty = self.encode_empty(timestamp)
+            for group in self.payloads.keys() - payloads.keys():
+                messages[group] = self.frame_message(group, empty)
+
+        self.timestamp = timestamp
+        self.etag = f'"{int(timestamp)}"'
+        self.snapshot = snapshot
+        self.payloads = payloads
+        self.messages = {group: messages[group] for group in payloads}
+        self.stats['ticks'] += 1
+
+        for client in self.clients:
+            client_messages = [messages[group] for group in client.groups if group in messages]
+            if client_messages:
+                client.push(client_messages)
+                self.stats['messages'] += len(client_messages)
+
+    def get_subscription(self, request):
+        """Return the set of groups of a subscription {"bbox": [...], "lines": [...]}."""
+        if not isinstance(request, dict):
+            raise ValueError("Subscription must be a JSON object.")
+
+        groups = set()
+        if request.get('bbox') is not None:
+            # Count tiles before listing them, as a bounding box may cover millions of tiles
+            n_tiles = Tiles.count_tiles_in_bbox(request['bbox'], self.zoom)
+            if n_tiles > self.max_tiles:
+                raise ValueError(f"Bounding box covers {n_tiles} tiles (maximum {self.max_tiles}).")
+            tiles = Tiles.get_tiles_in_bbox(request['bbox'], self.zoom)
+            groups |= {f"tile/{Tiles.get_key(x, y, self.zoom)}" for x, y in tiles}
+        for line_short_id in request.get('lines') or []:
+            groups.add(f"line/{line_short_id}")
+        return groups
+
+    @staticmethod
+    def accepts_gzip(request):
+        """Return whether the Accept-Encoding header of request allows gzip."""
+        for coding in request.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() not in ('gzip', '*'):
+                continue
+            # Quality value, gzip being refused with q=0
+            key, _, value = params.partition('=')
+            try:
+                q = float(value) if key.strip().lower() == 'q' else 1.0
+            except ValueError:
+                q = 0.0
+            if q > 0:
+                return True
+        return False
+
+    def get_response(self, request, payload):
+        if payload is None:
+            raise web.HTTPNotFound()
+        headers = {'ETag': self.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if request.headers.get('If-None-Match') == self.etag:
+            self.stats['not_modified'] += 1
+            return web.Response(status=304, headers=headers)
+
+        # Payloads are stored gzipped, and only decompressed for clients not accepting gzip
+        if self.accepts_gzip(request):
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            payload = gzip.decompress(payload)
+        return web.Response(body=payload, content_type='application/octet-stream', headers=headers)
+
+    async def get_positions(self, request):
+        return self.get_response(request, self.snapshot)
+
+    async def get_tile_positions(self, request):
+        group = f"tile/{request.match_info['zoom']}/{request.match_info['x']}/{request.match_info['y']}"
+        if request.match_info['zoom'] != str(self.zoom):
+            raise web.HTTPNotFound(text=f"Tiles are only available at zoom {self.zoom}.")
+        # Tiles without vehicles are empty, not missing
+        payload = self.payloads.get(group)
+        if payload is None and self.snapshot is not None:
+            payload = self.encode_empty(self.timestamp)
+        return self.get_response(request, payload)
+
+    async def get_line_positions(self, request):
+        return self.get_response(request, self.payloads.get(f"line/{request.match_info['line_short_id']}"))
+
+    async def get_stats(self, request):
+        return web.json_response(self.get_server_stats())
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+
+        client = PositionClient(ws, self.queue_size)
+        self.clients.add(client)
+        sender = asyncio.create_task(client.send_forever())
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    client.groups = self.get_subscription(json.loads(msg.data))
+                except (ValueError, TypeError, KeyError) as e:
+                    await ws.send_json({'error': str(e)})
+                    continue
+
+                # Send current positions of subscribed groups right away
+                client.push([self.messages[group] for group in client.groups if group in self.messages])
+        finally:
+            sender.cancel()
+            self.clients.discard(client)
+        return ws
+
+    def get_server_stats(self):
+        return dict(self.stats,
+                    clients=len(self.clients),
+                    groups=len(self.payloads),
+                    dropped=sum(client.dropped for client in self.clients),
+                    timestamp=self.timestamp)
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/positions', self.get_positions)
+        app.router.add_get('/positions/tiles/{zoom}/{x}/{y}', self.get_tile_positions)
+        app.router.add_get('/positions/lines/{line_short_id}', self.get_line_positions)
+        app.router.add_get('/stats', self.get_stats)
+        app.router.add_get('/ws', self.websocket)
+        return app
+
+    async def start(self, host='0.0.0.0', port=8000):
+        runner = web.AppRunner(self.create_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Position server listening on {host}:{port}.")
+        return runner
@@ -0,0 +1,80 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from shapely import LineString
+
+from src.Utils import Utils
+
+
+class RailGraph:
+    """Undirected graph of a rail network weighted by length in meters, stored as a CSR matrix.
+
+    Shortest paths are computed with the Dijkstra implementation of scipy.sparse.csgraph.
+    The predecessor tree of each source node is cached, so that paths from a source to any
+    number of targets only cost one Dijkstra run.
+    """
+
+    def __init__(self, n_nodes, sources, targets, weights):
+        # Both directions of every edge
+        sources, targets = (np.concatenate([sources, targets]).astype(np.int64),
+                            np.concatenate([targets, sources]).astype(np.int64))
+        weights = np.tile(np.asarray(weights, dtype=np.float64), 2)
+
+        # Keep the shortest of parallel edges (a CSR matrix would sum them), and no loop
+        order = np.lexsort((weights, targets, sources))
+        sources, targets, weights = sources[order], targets[order], weights[order]
+        first = np.ones(len(sources), dtype=bool)
+        first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        first &= sources != targets
+
+        self.n_nodes = n_nodes
+        self.matrix = csr_matrix((weights[first], (sources[first], targets[first])), shape=(n_nodes, n_nodes))
+        self.distances = {}
+        self.predecessors = {}
+
+    @classmethod
+    def from_networkx(cls, G):
+        """Build graph from a networkx graph (e.g. momepy primal graph), nodes being numbered in the order of G.nodes.
+
+        Edges are weighted by the length of their geometry, or of the straight line between their nodes.
+        """
+        nodes = {node: i for i, node in enumerate(G.nodes)}
+        sources, targets, weights = [], [], []
+        for u, v, data in G.edges(data=True):
+            geometry = data.get('geometry')
+            if geometry is None:
+                geometry = LineString([u, v])
+            sources.append(nodes[u])
+            targets.append(nodes[v])
+            weights.append(Utils.get_linestring_length_in_meters(geometry))
+        return cls(len(nodes), sources, targets, weights)
+
+    def compute(self, sources):
+        """Compute and cache predecessor trees of sources (all at once in a single Dijkstra call)."""
+        sources = [int(source) for source in np.unique(sources) if int(source) not in self.predecessors]
+        if len(sources) == 0:
+            return
+        distances, predecessors = dijkstra(self.matrix, directed=True, indices=sources, return_predecessors=True)
+        for i, source in enumerate(sources):
+            self.distances[source] = distances[i]
+            self.predecessors[source] = predecessors[i]
+
+    def get_distance(self, source, target):
+        """Return length in meters of the shortest path (inf if target cannot be reached)."""
+        self.compute([source])
+        return self.distances[int(source)][target]
+
+    def get_path(self, source, target):
+        """Return the list of nodes of the shortest path from source to target, or None if target cannot be reached."""
+        self.compute([source])
+        predecessors = self.predecessors[int(source)]
+        if source != target and predecessors[target] < 0:
+            return None
+
+        path = [int(target)]
+        while path[-1] != source:
+            path.append(int(predecessors[path[-1]]))
+        return path[::-1]
+
+    def __len__(self):
+        return self.n_nodes
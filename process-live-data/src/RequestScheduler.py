@@ -0,0 +1,152 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import pytz
+
+
+class RequestScheduler:
+    """Global scheduler for PRIM API requests.
+
+    Requests wait in a priority queue (lowest value first) and are released one by one,
+    spaced so that neither the per-second rate nor the daily quota is exceeded. When the
+    remaining daily quota cannot sustain the per-second rate until the quota resets at
+    midnight, the release rate is lowered to spread the remaining requests over the day.
+    A throttled response (429/503) pauses every request for Retry-After seconds plus jitter.
+    """
+
+    def __init__(self, requests_per_second=50, daily_quota=None, base_backoff=1.0, max_backoff=60.0,
+                 timezone='Europe/Paris'):
+        self.requests_per_second = requests_per_second
+        self.daily_quota = daily_quota
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.timezone = pytz.timezone(timezone)
+
+        self.queue = []
+        self.counter = itertools.count()
+        self.dispatcher = None
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+
+        self.quota_day = None
+        self.daily_used = 0
+
+        self.stats = {'requests': 0,
+                      'throttled': 0,
+                      'total_wait_time': 0.0,
+                      'max_wait_time': 0.0}
+
+    def __reset_daily_quota(self, now):
+        today = now.date()
+        if self.quota_day != today:
+            self.quota_day = today
+            self.daily_used = 0
+
+    def get_remaining_daily_quota(self):
+        if self.daily_quota is None:
+            return None
+        self.__reset_daily_quota(datetime.datetime.now(self.timezone))
+        return max(0, self.daily_quota - self.daily_used)
+
+    def get_rate(self):
+        """Return the current release rate in requests per second."""
+        rate = self.requests_per_second
+        if self.daily_quota is not None:
+            remaining = self.get_remaining_daily_quota()
+            rate = min(rate, remaining / self.__seconds_until_quota_reset())
+        return rate
+
+    def __seconds_until_quota_reset(self):
+        now = datetime.datetime.now(self.timezone)
+        midnight = self.timezone.localize(datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                                                    datetime.time()))
+        return max(1.0, (midnight - now).total_seconds())
+
+    async def __dispatch(self):
+        while self.queue:
+            # Wait for the next slot (rate limit) and the end of any server-requested pause
+            delay = max(self.next_slot, self.paused_until) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            rate = self.get_rate()
+            if rate <= 0:
+                logging.warning("Daily PRIM API quota exhausted, waiting until reset.")
+                self.next_slot = time.monotonic() + self.__seconds_until_quota_reset()
+                continue
+
+            priority, _, enqueue_time, future = heapq.heappop(self.queue)
+            if future.done():
+                # Request was cancelled while waiting
+                continue
+
+            now = time.monotonic()
+            wait_time = now - enqueue_time
+            self.stats['requests'] += 1
+            self.stats['total_wait_time'] += wait_time
+            self.stats['max_wait_time'] = max(self.stats['max_wait_time'], wait_time)
+            self.daily_used += 1
+
+            self.next_slot = now + 1 / rate
+            future.set_result(wait_time)
+
+    async def acquire(self, priority=0):
+        """Wait until a request may be sent. Return the time spent waiting in seconds."""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.counter), time.monotonic(), future))
+
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.ensure_future(self.__dispatch())
+
+        return await future
+
+    def get_backoff(self, attempt):
+        """Return exponential backoff delay with full jitter for a failed attempt (starting at 1)."""
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (attempt - 1))
+        return random.uniform(0, delay)
+
+    @staticmethod
+    def parse_retry_after(value):
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_date = parsedate_to_datetime(value)
+            # HTTP dates are in UTC ("-0000" zone gives a naive datetime)
+            if retry_date.tzinfo is None:
+                retry_date = retry_date.replace(tzinfo=datetime.timezone.utc)
+            return max(0.0, (retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def throttle(self, retry_after=None, attempt=1):
+        """Pause all requests after a 429/503 response. Return the pause duration in seconds."""
+        retry_after = self.parse_retry_after(retry_after)
+        if retry_after is None:
+            delay = self.get_backoff(attempt)
+        else:
+            # Never retry before Retry-After, add jitter so that waiting requests do not retry at once
+            delay = retry_after + random.uniform(0, self.base_backoff)
+
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        self.stats['throttled'] += 1
+        return delay
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queue_depth'] = len(self.queue)
+        stats['mean_wait_time'] = stats['total_wait_time'] / stats['requests'] if stats['requests'] > 0 else 0.0
+        stats['rate'] = self.get_rate()
+        stats['daily_used'] = self.daily_used
+        stats['daily_remaining'] = self.get_remaining_daily_quota()
+        return stats
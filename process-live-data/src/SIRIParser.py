@@ -0,0 +1,216 @@
+import logging
+
+import pandas as pd
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    import json
+    loads = json.loads
+
+
+class TripColumns:
+    """Columnar buffers of parsed trips (same fields as PRIM_API.parse_trip_json).
+
+    update_time and arrival_time are stored as UNIX timestamps (float).
+    """
+
+    KEYS = ['id', 'name', 'update_time', 'stop_short_id', 'stop_name', 'line_short_id',
+            'destination_id', 'destination_name', 'arrival_time']
+
+    __slots__ = KEYS
+
+    def __init__(self):
+        for k in self.KEYS:
+            setattr(self, k, [])
+
+    def __len__(self):
+        return len(self.id)
+
+    @classmethod
+    def concatenate(cls, columns_list):
+        result = cls()
+        for columns in columns_list:
+            for k in cls.KEYS:
+                getattr(result, k).extend(getattr(columns, k))
+        return result
+
+    def to_dataframe(self):
+        df = pd.DataFrame({k: getattr(self, k) for k in self.KEYS}, columns=self.KEYS)
+        # Same types as parse_trip_json: naive UTC update time, UTC-aware arrival time
+        df['update_time'] = pd.to_datetime(df['update_time'], unit='s')
+        df['arrival_time'] = pd.to_datetime(df['arrival_time'], unit='s', utc=True)
+        return df
+
+
+class SIRIParser:
+    """Fast path to parse SIRI StopMonitoring payloads into TripColumns."""
+
+    # Seconds since epoch at midnight of each date (cached by "YYYY-MM-DD")
+    __days = {}
+
+    @staticmethod
+    def days_from_civil(y, m, d):
+        # Days since 1970-01-01 in the proleptic Gregorian calendar
+        y -= m <= 2
+        era = y // 400
+        yoe = y - era * 400
+        doy = (153 * (m + (-3 if m > 2 else 9)) + 2) // 5 + d - 1
+        doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+        return era * 146097 + doe - 719468
+
+    @classmethod
+    def parse_timestamp(cls, s):
+        """Parse fixed-format UTC date "YYYY-MM-DDTHH:MM:SS[.fff]Z" to a UNIX timestamp."""
+        day = cls.__days.get(s[:10])
+        if day is None:
+            day = 86400 * cls.days_from_civil(int(s[0:4]), int(s[5:7]), int(s[8:10]))
+            cls.__days[s[:10]] = day
+        seconds = day + 3600 * int(s[11:13]) + 60 * int(s[14:16]) + int(s[17:19])
+        if s[19] == '.':
+            seconds += float(s[19:-1])
+        return seconds
+
+    @staticmethod
+    def first_value(values):
+        return values[0]['value'] if values else None
+
+    @classmethod
+    def parse_stop_monitoring(cls, body, stop_short_id, line_short_id, columns=None):
+        """Parse raw StopMonitoring payload of a stop and append visits of the line to columns."""
+        if columns is None:
+            columns = TripColumns()
+
+        visits = loads(body)['Siri']['ServiceDelivery']['StopMonitoringDelivery'][0]['MonitoredStopVisit']
+        parse_timestamp = cls.parse_timestamp
+        first_value = cls.first_value
+
+        errors = 0
+        for visit in visits:
+            try:
+                journey = visit['MonitoredVehicleJourney']
+
+                # Sometimes data from other lines pollute trips
+                if journey['LineRef']['value'].rstrip(':').rsplit(':', 1)[-1] != line_short_id:
+                    continue
+
+                call = journey['MonitoredCall']
+                arrival_time = call.get('ExpectedArrivalTime') or call.get('ExpectedDepartureTime')
+                if arrival_time is None:
+                    continue
+
+                destination_name = first_value(call.get('DestinationDisplay'))
+                if destination_name is None:
+                    destination_name = first_value(journey.get('DestinationName'))
+                if destination_name is None:
+                    destination_name = first_value(journey.get('DirectionName'))
+
+                note = journey.get('JourneyNote')
+                row = (journey['FramedVehicleJourneyRef']['DatedVehicleJourneyRef'],
+                       note[0]['value'] if note else "",
+                       parse_timestamp(visit['RecordedAtTime']),
+                       call['StopPointName'][0]['value'],
+                       journey['DestinationRef']['value'].rstrip(':').rsplit(':', 1)[-1],
+                       parse_timestamp(arrival_time))
+
+            except (KeyError, IndexError, TypeError, ValueError):
+                errors += 1
+                continue
+
+            # Append only complete rows
+            trip_id, name, update_time, stop_name, destination_id, arrival_time = row
+            columns.id.append(trip_id)
+            columns.name.append(name)
+            columns.update_time.append(update_time)
+            columns.stop_short_id.append(stop_short_id)
+            columns.stop_name.append(stop_name)
+            columns.line_short_id.append(line_short_id)
+            columns.destination_id.append(destination_id)
+            columns.destination_name.append(destination_name)
+            columns.arrival_time.append(arrival_time)
+
+        if errors > 0:
+            logging.warning(f"Could not parse {errors} visits at stop {stop_short_id}.")
+
+        return columns
+
+    @classmethod
+    def parse_estimated_timetable(cls, body, line_short_id, stop_short_ids=None, stop_names=None, columns=None):
+        """Parse raw EstimatedTimetable payload of a line and fan calls out to one row per (trip, stop).
+
+        Only calls at stops in stop_short_ids are kept (if given). Stop names missing from calls
+        are taken from stop_names ({stop_short_id: name}).
+        """
+        if columns is None:
+            columns = TripColumns()
+        if stop_short_ids is not None:
+            stop_short_ids = set(stop_short_ids)
+        if stop_names is None:
+            stop_names = {}
+
+        delivery = loads(body)['Siri']['ServiceDelivery']['EstimatedTimetableDelivery'][0]
+        parse_timestamp = cls.parse_timestamp
+        first_value = cls.first_value
+
+        errors = 0
+        for frame in delivery.get('EstimatedJourneyVersionFrame', []):
+            for journey in frame.get('EstimatedVehicleJourney', []):
+                try:
+                    # Sometimes data from other lines pollute trips
+                    if journey['LineRef']['value'].rstrip(':').rsplit(':', 1)[-1] != line_short_id:
+                        continue
+
+                    trip_id = journey.get('DatedVehicleJourneyRef')
+                    if isinstance(trip_id, dict):
+                        trip_id = trip_id['value']
+                    if trip_id is None:
+                        trip_id = journey['FramedVehicleJourneyRef']['DatedVehicleJourneyRef']
+
+                    note = journey.get('JourneyNote')
+                    name = note[0]['value'] if note else ""
+                    update_time = parse_timestamp(journey['RecordedAtTime'])
+                    destination_id = journey['DestinationRef']['value'].rstrip(':').rsplit(':', 1)[-1]
+                    journey_destination_name = first_value(journey.get('DestinationName'))
+                    if journey_destination_name is None:
+                        journey_destination_name = first_value(journey.get('DirectionName'))
+                    calls = journey['EstimatedCalls']['EstimatedCall']
+                except (KeyError, IndexError, TypeError, ValueError):
+                    errors += 1
+                    continue
+
+                for call in calls:
+                    try:
+                        stop_short_id = call['StopPointRef']['value'].rstrip(':').rsplit(':', 1)[-1]
+                        if stop_short_ids is not None and stop_short_id not in stop_short_ids:
+                            continue
+
+                        arrival_time = call.get('ExpectedArrivalTime') or call.get('ExpectedDepartureTime')
+                        if arrival_time is None:
+                            continue
+                        arrival_time = parse_timestamp(arrival_time)
+
+                        stop_name = first_value(call.get('StopPointName'))
+                        if stop_name is None:
+                            stop_name = stop_names.get(stop_short_id, "")
+                        destination_name = first_value(call.get('DestinationDisplay'))
+                        if destination_name is None:
+                            destination_name = journey_destination_name
+                    except (KeyError, IndexError, TypeError, ValueError):
+                        errors += 1
+                        continue
+
+                    columns.id.append(trip_id)
+                    columns.name.append(name)
+                    columns.update_time.append(update_time)
+                    columns.stop_short_id.append(stop_short_id)
+                    columns.stop_name.append(stop_name)
+                    columns.line_short_id.append(line_short_id)
+                    columns.destination_id.append(destination_id)
+                    columns.destination_name.append(destination_name)
+                    columns.arrival_time.append(arrival_time)
+
+        if errors > 0:
+            logging.warning(f"Could not parse {errors} journeys or calls of line {line_short_id}.")
+
+        return columns
@@ -0,0 +1,114 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from src.Utils import Utils
+
+
+class ShortestPathStore:
+    """Process-wide cache of shortest paths between stops, indexed by line.
+
+    Each line is loaded once from data/shortest_paths/{line_short_id}.parquet and
+    stored as a dict {(start_stop_short_id, end_stop_short_id): coords} where coords
+    is a (n, 2) float64 array. A line is reloaded only when the modification time of
+    its file changes. Least recently used lines are evicted when the total size of
+    the cached coordinates exceeds max_memory bytes.
+    """
+
+    # Rough per-entry overhead of the dict, key tuple and array header (in bytes)
+    ENTRY_OVERHEAD = 250
+
+    def __init__(self, directory=os.path.join('data', 'shortest_paths'), max_memory=512 * 1024 ** 2):
+        self.directory = directory
+        self.max_memory = max_memory
+        self.lines = OrderedDict()  # line_short_id -> (mtime, index, size)
+        self.memory_usage = 0
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get_file_path(self, line_short_id):
+        return os.path.join(self.directory, f"{line_short_id}.parquet")
+
+    @classmethod
+    def build_index(cls, sp):
+        # Reuse short ids from the file when available
+        if 'stop_short_id_start' in sp.columns and 'stop_short_id_end' in sp.columns:
+            starts = sp['stop_short_id_start'].astype(str).values
+            ends = sp['stop_short_id_end'].astype(str).values
+        else:
+            starts = [Utils.compute_short_id(x) for x in sp['stop_id_start'].values]
+            ends = [Utils.compute_short_id(x) for x in sp['stop_id_end'].values]
+
+        # Get coordinates of every path at once and split them by row
+        geometries = sp['line_geometry_interpolated'].values
+        coords, row_idx = shapely.get_coordinates(geometries, return_index=True)
+        bounds = np.searchsorted(row_idx, np.arange(len(geometries) + 1))
+
+        index = {}
+        size = 0
+        for i, key in enumerate(zip(starts, ends)):
+            # Keep the first path found for a pair of stops
+            if key in index or bounds[i] == bounds[i+1]:
+                continue
+            path = np.ascontiguousarray(coords[bounds[i]:bounds[i+1]])
+            index[key] = path
+            size += path.nbytes + cls.ENTRY_OVERHEAD
+
+        return index, size
+
+    def __evict(self):
+        # Always keep the most recently used line
+        while self.memory_usage > self.max_memory and len(self.lines) > 1:
+            line_short_id, (_, _, size) = self.lines.popitem(last=False)
+            self.memory_usage -= size
+            self.evictions += 1
+            logging.info(f"Evicted shortest paths of line {line_short_id} from cache.")
+
+    def get_line(self, line_short_id):
+        """Return the index {(start_stop_short_id, end_stop_short_id): coords} of a line."""
+        file_path = self.get_file_path(line_short_id)
+        mtime = os.stat(file_path).st_mtime_ns
+
+        with self.lock:
+            if line_short_id in self.lines:
+                cached_mtime, index, size = self.lines[line_short_id]
+                if cached_mtime == mtime:
+                    self.lines.move_to_end(line_short_id)
+                    self.hits += 1
+                    return index
+
+                # File changed on disk: drop the outdated index
+                del self.lines[line_short_id]
+                self.memory_usage -= size
+
+        # Load file outside of the lock so that other lines can still be served
+        index, size = self.build_index(gpd.read_parquet(file_path))
+        logging.info(f"Loaded {len(index)} shortest paths for line {line_short_id}.")
+
+        with self.lock:
+            if line_short_id in self.lines:
+                self.memory_usage -= self.lines.pop(line_short_id)[2]
+            self.lines[line_short_id] = (mtime, index, size)
+            self.memory_usage += size
+            self.loads += 1
+            self.__evict()
+
+        return index
+
+    def get_path(self, line_short_id, start_stop_short_id, end_stop_short_id):
+        return self.get_line(line_short_id).get((start_stop_short_id, end_stop_short_id))
+
+    def get_stats(self):
+        with self.lock:
+            return {'lines': len(self.lines),
+                    'memory_usage': self.memory_usage,
+                    'loads': self.loads,
+                    'hits': self.hits,
+                    'evictions': self.evictions}
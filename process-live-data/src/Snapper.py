@@ -0,0 +1,37 @@
+import numpy as np
+import shapely
+from shapely import STRtree
+
+
+class Snapper:
+    """Snap points to the nearest of a set of vertices (graph nodes or vertices of linestrings).
+
+    Vertices are indexed once in a shapely STRtree, and points are snapped in a single bulk query.
+    """
+
+    def __init__(self, coords, geometry_index=None):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        # Index of the geometry of each vertex (see from_geometries)
+        self.geometry_index = geometry_index
+        self.tree = STRtree(shapely.points(self.coords))
+
+    @classmethod
+    def from_geometries(cls, geometries):
+        """Build snapper of every vertex of geometries, keeping the index of the geometry of each vertex."""
+        coords, geometry_index = shapely.get_coordinates(geometries, return_index=True)
+        return cls(coords, geometry_index)
+
+    def snap(self, x, y):
+        """Return (vertex indices, snapped coordinates (n, 2), distances) of the nearest vertex of each point."""
+        points = shapely.points(np.atleast_1d(x), np.atleast_1d(y))
+        (inputs, vertices), distances = self.tree.query_nearest(points, return_distance=True, all_matches=False)
+
+        # Results are not guaranteed to follow the order of points
+        indices = np.empty(len(points), dtype=np.int64)
+        indices[inputs] = vertices
+        snapped_distances = np.empty(len(points))
+        snapped_distances[inputs] = distances
+        return indices, self.coords[indices], snapped_distances
+
+    def __len__(self):
+        return len(self.coords)
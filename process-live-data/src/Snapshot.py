@@ -0,0 +1,48 @@
+import time
+from types import MappingProxyType
+
+from src.TickEngine import TickEngine
+
+
+class Snapshot:
+    """Immutable state of every line, read by publishers.
+
+    Updating a line returns a new snapshot (the previous one is left untouched), so that
+    the retrieve side can swap the published snapshot with a single assignment.
+    """
+
+    __slots__ = ('lines', 'line_versions', 'tick_engine', 'version', 'created')
+
+    def __init__(self, lines, line_versions, tick_engine, version, created):
+        # lines: {line_short_id: (trips dataframe, Trajectories)}
+        self.lines = MappingProxyType(dict(lines))
+        # line_versions: {line_short_id: version of the snapshot where the line was last updated}
+        self.line_versions = MappingProxyType(dict(line_versions))
+        self.tick_engine = tick_engine
+        self.version = version
+        self.created = created
+
+    @classmethod
+    def empty(cls):
+        return cls({}, {}, TickEngine.from_lines({}), 0, time.time())
+
+    def with_line(self, line_short_id, trips, trajectories):
+        """Return a new snapshot where data of the line is replaced."""
+        return self.with_lines({line_short_id: (trips, trajectories)})
+
+    def with_lines(self, updates):
+        """Return a new snapshot where data of lines is replaced by updates {line_short_id: (trips, Trajectories)}.
+
+        The tick engine of every line is rebuilt, so updates received meanwhile should be applied at once.
+        """
+        lines = dict(self.lines)
+        lines.update(updates)
+        line_versions = dict(self.line_versions)
+        line_versions.update({line_short_id: self.version + 1 for line_short_id in updates})
+        return Snapshot(lines, line_versions, TickEngine.from_lines(lines), self.version + 1, time.time())
+
+    def __contains__(self, line_short_id):
+        return line_short_id in self.lines
+
+    def __repr__(self):
+        return f"Snapshot(version={self.version}, lines={len(self.lines)}, trajectories={len(self.tick_engine)})"
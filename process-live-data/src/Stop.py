@@ -20,18 +20,8 @@ class Stop:
         return self.id.split(":")[-1]
     
     def get_nearest_point_on_graph(self):
-        # Get the closest segment of the line graph
-        if self.line.graph.geom_type == "MultiLineString":
-            distances = [segment.distance(self.position) for segment in list(self.line.graph.geoms)]
-            self.segment_idx = min(enumerate(distances), key=lambda x: x[1])[0]
-            segment = self.line.graph.geoms[self.segment_idx]
-        else:
-            self.segment_idx = 0
-            segment = self.line.graph
-        
-        distances = [Point(s_point).distance(self.position) for s_point in segment.coords[:]]
-        point_on_segment_idx = min(enumerate(distances), key=lambda x: x[1])[0]
-        self.point_on_graph = Point(segment.coords[point_on_segment_idx])
+        # Closest vertex of the line graph, and its segment
+        self.line.snap_stops([self])
     
     def get_line_graph_segment(self):
         if not "point_on_graph" in dir(self):
@@ -0,0 +1,126 @@
+import numpy as np
+
+from src.Tiles import Tiles
+from src.Trajectories import Trajectories
+
+
+class TickEngine:
+    """Positions of every vehicle at a given time.
+
+    All trajectories are flattened into a single Trajectories container: samples of
+    trip k are stored in [offsets[k], offsets[k+1]) with timestamps sorted within
+    each trip.
+    """
+
+    METADATA_KEYS = ['id', 'line_short_id', 'name', 'destination_id']
+
+    def __init__(self, trajectories, metadata):
+        self.trajectories = trajectories
+        self.timestamps = trajectories.timestamps
+        self.x = trajectories.x
+        self.y = trajectories.y
+        self.offsets = trajectories.offsets
+        self.metadata = {k: np.asarray(v, dtype=object) for k, v in metadata.items()}
+        self.n_trips = len(trajectories)
+
+        starts = self.offsets[:-1]
+        ends = self.offsets[1:]
+        self.first_ts = self.timestamps[starts] if self.n_trips > 0 else np.empty(0)
+        self.last_ts = self.timestamps[ends - 1] if self.n_trips > 0 else np.empty(0)
+
+        # Shift timestamps of trip k by k * span so that the whole array is sorted.
+        # A single searchsorted then finds the bracketing samples of every trip.
+        self.base = self.timestamps.min() if len(self.timestamps) else 0.0
+        self.span = (self.timestamps.max() - self.base + 1.0) if len(self.timestamps) else 1.0
+        trip_idx = np.repeat(np.arange(self.n_trips), ends - starts)
+        self.keys = (self.timestamps - self.base) + trip_idx * self.span
+
+        # Slippy tiles of trajectory samples by zoom (see get_sample_tiles)
+        self.sample_tiles = {}
+
+    @classmethod
+    def from_lines(cls, all_lines_trips):
+        """Build engine from dict {line_short_id: (trips dataframe, Trajectories)} with one trajectory per row."""
+        trajectories = []
+        metadata = {k: [] for k in cls.METADATA_KEYS}
+
+        for df, line_trajectories in all_lines_trips.values():
+            # Interpolation needs at least two samples
+            mask = line_trajectories.lengths >= 2
+            trajectories.append(line_trajectories[mask])
+            for k in cls.METADATA_KEYS:
+                metadata[k].extend(df[k].values[mask])
+
+        return cls(Trajectories.concatenate(trajectories), metadata)
+
+    def locate(self, timestamp):
+        """Return (trip indices, left sample, right sample, interpolation weight) of vehicles running at timestamp."""
+        active = np.flatnonzero((self.first_ts <= timestamp) & (timestamp <= self.last_ts))
+        if len(active) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return active, empty, empty, np.empty(0)
+
+        queries = (timestamp - self.base) + active * self.span
+        right = np.searchsorted(self.keys, queries, side='right')
+
+        # Keep the bracketing samples inside each trip (handles timestamp == last sample)
+        right = np.clip(right, self.offsets[active] + 1, self.offsets[active + 1] - 1)
+        left = right - 1
+
+        # Segments of null duration give the end position
+        dt = self.timestamps[right] - self.timestamps[left]
+        w = np.divide(timestamp - self.timestamps[left], dt, out=np.ones_like(dt), where=dt > 0)
+        return active, left, right, w
+
+    def get_positions(self, timestamp):
+        """Return (trip indices, x, y) of vehicles running at timestamp."""
+        active, left, right, w = self.locate(timestamp)
+
+        # Linear interpolation
+        x = self.x[left] + w * (self.x[right] - self.x[left])
+        y = self.y[left] + w * (self.y[right] - self.y[left])
+
+        return active, x, y
+
+    def get_sample_tiles(self, zoom):
+        """Return slippy tile code (x * 2**zoom + y) of every trajectory sample, computed once per zoom."""
+        if zoom not in self.sample_tiles:
+            tile_x, tile_y = Tiles.lonlat_to_tile(self.x, self.y, zoom)
+            self.sample_tiles[zoom] = tile_x * 2 ** zoom + tile_y
+        return self.sample_tiles[zoom]
+
+    def get_tiles(self, timestamp, zoom):
+        """Return (trip indices, x, y, tile codes) of vehicles running at timestamp.
+
+        Vehicles between two samples of the same tile get the tile of the samples, the
+        others (crossing a tile border) get the tile of their interpolated position.
+        """
+        active, left, right, w = self.locate(timestamp)
+        x = self.x[left] + w * (self.x[right] - self.x[left])
+        y = self.y[left] + w * (self.y[right] - self.y[left])
+
+        sample_tiles = self.get_sample_tiles(zoom)
+        tiles = sample_tiles[left]
+        crossing = np.flatnonzero(tiles != sample_tiles[right])
+        if len(crossing) > 0:
+            tile_x, tile_y = Tiles.lonlat_to_tile(x[crossing], y[crossing], zoom)
+            tiles[crossing] = tile_x * 2 ** zoom + tile_y
+
+        return active, x, y, tiles
+
+    def get_vehicles(self, timestamp):
+        """Return {trip_id: vehicle dict} with the position of running vehicles at timestamp."""
+        active, x, y = self.get_positions(timestamp)
+        columns = [self.metadata[k][active] for k in self.METADATA_KEYS]
+
+        data = {}
+        for i, values in enumerate(zip(*columns)):
+            vehicle = dict(zip(self.METADATA_KEYS, values))
+            vehicle['time_position'] = (timestamp, (float(x[i]), float(y[i])))
+            vehicle['time_generated'] = timestamp
+            data[vehicle['id']] = vehicle
+
+        return data
+
+    def __len__(self):
+        return self.n_trips
@@ -0,0 +1,58 @@
+import math
+
+import numpy as np
+
+
+class Tiles:
+    """Slippy map tiles (Web Mercator, as used by OpenStreetMap) of coordinates in degrees."""
+
+    MAX_LATITUDE = 85.0511287798
+
+    @classmethod
+    def lonlat_to_tile(cls, lon, lat, zoom):
+        """Return tile (x, y) of coordinates (scalars or arrays) at zoom."""
+        n = 2 ** zoom
+        lat = np.radians(np.clip(lat, -cls.MAX_LATITUDE, cls.MAX_LATITUDE))
+        x = np.floor((np.asarray(lon) + 180.0) / 360.0 * n)
+        y = np.floor((1.0 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2.0 * n)
+        return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+    @staticmethod
+    def tile_to_lonlat(x, y, zoom):
+        """Return coordinates of the north-west corner of tile (x, y) at zoom."""
+        n = 2 ** zoom
+        lon = x / n * 360.0 - 180.0
+        lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+        return lon, lat
+
+    @classmethod
+    def get_tile_bounds(cls, x, y, zoom):
+        """Return (min_lon, min_lat, max_lon, max_lat) of tile (x, y) at zoom."""
+        min_lon, max_lat = cls.tile_to_lonlat(x, y, zoom)
+        max_lon, min_lat = cls.tile_to_lonlat(x + 1, y + 1, zoom)
+        return min_lon, min_lat, max_lon, max_lat
+
+    @classmethod
+    def get_tile_range(cls, bbox, zoom):
+        """Return (min_x, min_y, max_x, max_y) of tiles at zoom intersecting bbox (min_lon, min_lat, max_lon, max_lat)."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        if not np.all(np.isfinite(np.asarray([min_lon, min_lat, max_lon, max_lat], dtype=np.float64))):
+            raise ValueError(f"Invalid bounding box {bbox}.")
+        min_x, min_y = cls.lonlat_to_tile(min_lon, max_lat, zoom)
+        max_x, max_y = cls.lonlat_to_tile(max_lon, min_lat, zoom)
+        return int(min_x), int(min_y), int(max_x), int(max_y)
+
+    @classmethod
+    def count_tiles_in_bbox(cls, bbox, zoom):
+        min_x, min_y, max_x, max_y = cls.get_tile_range(bbox, zoom)
+        return max(0, max_x - min_x + 1) * max(0, max_y - min_y + 1)
+
+    @classmethod
+    def get_tiles_in_bbox(cls, bbox, zoom):
+        """Return the list of tiles (x, y) at zoom intersecting bbox (min_lon, min_lat, max_lon, max_lat)."""
+        min_x, min_y, max_x, max_y = cls.get_tile_range(bbox, zoom)
+        return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+    @staticmethod
+    def get_key(x, y, zoom):
+        return f"{zoom}/{x}/{y}"
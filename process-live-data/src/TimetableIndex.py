@@ -0,0 +1,141 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from src.Utils import Utils
+
+
+class TimetableIndex:
+    """Scheduled stop times of a line for one service day, sorted by arrival time.
+
+    Arrival times are stored as int32 seconds since midnight of the service day. GTFS
+    times past 24:00:00 are kept as is (e.g. 25:10:00 is 90600), and those of the
+    previous service day are shifted by -24 h, so that a time window is a searchsorted slice.
+    """
+
+    WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+    OUTPUT_KEYS = ['id', 'name', 'stop_short_id', 'stop_sequence', 'line_short_id',
+                   'destination_id', 'destination_name', 'arrival_time']
+
+    def __init__(self, service_date, midnight, arrival_seconds, rows):
+        self.service_date = service_date
+        # UNIX timestamp of midnight (local time) of the service day
+        self.midnight = midnight
+        self.arrival_seconds = arrival_seconds
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.arrival_seconds)
+
+    @staticmethod
+    def parse_seconds(values):
+        """Parse GTFS times ("HH:MM:SS", possibly past 24:00:00, or datetime.time) to seconds."""
+        values = pd.Series(values)
+        if len(values) > 0 and isinstance(values.iloc[0], datetime.time):
+            return np.array([3600 * t.hour + 60 * t.minute + t.second for t in values], dtype=np.int32)
+
+        hms = values.astype(str).str.split(':', expand=True).astype(np.int32)
+        return (3600 * hms[0] + 60 * hms[1] + hms[2]).to_numpy(dtype=np.int32)
+
+    @staticmethod
+    def parse_dates(values):
+        return pd.to_datetime(pd.Series(values).astype(str), format='%Y%m%d', errors='coerce').dt.date.to_numpy()
+
+    @classmethod
+    def get_active_mask(cls, timetable, start_dates, end_dates, date):
+        weekday = cls.WEEKDAYS[date.weekday()]
+        return (timetable[weekday].to_numpy(dtype=bool)
+                & (start_dates <= date)
+                & (end_dates >= date))
+
+    @classmethod
+    def from_dataframe(cls, timetable, service_date, timezone='Europe/Paris'):
+        """Build the index of a line timetable (data/timetable/<line_short_id>) for a service day."""
+        tz = pytz.timezone(timezone)
+        midnight = tz.localize(datetime.datetime.combine(service_date, datetime.time())).timestamp()
+
+        seconds = cls.parse_seconds(timetable['arrival_time'])
+        start_dates = cls.parse_dates(timetable['start_date'])
+        end_dates = cls.parse_dates(timetable['end_date'])
+
+        # Trips of the day, and trips of the previous day still running after midnight
+        today = cls.get_active_mask(timetable, start_dates, end_dates, service_date)
+        yesterday = cls.get_active_mask(timetable, start_dates, end_dates,
+                                        service_date - datetime.timedelta(days=1)) & (seconds >= 86400)
+
+        rows = pd.concat([timetable[today], timetable[yesterday]])
+        seconds = np.concatenate([seconds[today], seconds[yesterday] - 86400])
+
+        rows = pd.DataFrame({
+            'id': rows['trip_id'].to_numpy(),
+            'name': '',
+            'stop_short_id': rows['stop_id'].map(Utils.compute_short_id).to_numpy(),
+            'stop_sequence': rows['stop_sequence'].to_numpy(),
+            'line_short_id': rows['route_short_id'].to_numpy(),
+            'destination_name': rows['trip_headsign'].to_numpy(),
+        })
+
+        # Trip destination is its last stop
+        last_stops = rows.sort_values('stop_sequence').groupby('id')['stop_short_id'].last()
+        rows['destination_id'] = rows['id'].map(last_stops)
+
+        order = np.argsort(seconds, kind='stable')
+        return cls(service_date, midnight, seconds[order], rows.iloc[order].reset_index(drop=True))
+
+    def get_window(self, timestamp, before=120, after=3600):
+        """Return scheduled stop times with arrival in ]timestamp - before, timestamp + after[."""
+        seconds = timestamp - self.midnight
+        start = np.searchsorted(self.arrival_seconds, seconds - before, side='right')
+        end = np.searchsorted(self.arrival_seconds, seconds + after, side='left')
+
+        window = self.rows.iloc[start:end].copy()
+        window['arrival_time'] = pd.to_datetime(self.midnight + self.arrival_seconds[start:end], unit='s', utc=True)
+        return window[self.OUTPUT_KEYS]
+
+    @staticmethod
+    def apply_delays(window, real_time, max_early=120, max_delay=1800):
+        """Shift scheduled arrivals of a window by the delays observed in real-time arrivals.
+
+        Each real-time arrival (stop_short_id, destination_id, arrival_time) is matched to the
+        closest scheduled arrival at the same stop towards the same destination, from max_early
+        seconds after it (early train) to max_delay seconds before it (late train). The delay of
+        a match is propagated to the next stops of its trip, and arrival times are kept
+        non-decreasing along stop_sequence. Return (shifted window, matches).
+        """
+        # Real-time and scheduled arrival times may not have the same resolution
+        real_time = real_time[['stop_short_id', 'destination_id', 'arrival_time']].astype(
+            {'arrival_time': 'datetime64[ns, UTC]'}).reset_index(drop=True)
+        real_time['real_time_index'] = np.arange(len(real_time))
+        real_time = real_time.sort_values('arrival_time')
+        schedule = window[['id', 'stop_short_id', 'destination_id', 'arrival_time']].astype(
+            {'arrival_time': 'datetime64[ns, UTC]'})
+        schedule['scheduled_time'] = schedule['arrival_time']
+        schedule = schedule.sort_values('arrival_time')
+
+        # Late trains match the last scheduled arrival before them, early trains the first one after them
+        candidates = [pd.merge_asof(real_time, schedule, on='arrival_time', by=['stop_short_id', 'destination_id'],
+                                    direction=direction, tolerance=pd.Timedelta(seconds=tolerance))
+                      for direction, tolerance in (('backward', max_delay), ('forward', max_early))]
+        matches = pd.concat(candidates).dropna(subset=['id'])
+
+        # Keep the closest scheduled arrival of each real-time arrival, and the closest real-time arrival
+        # of each scheduled stop time
+        matches['delay'] = matches['arrival_time'] - matches['scheduled_time']
+        matches = (matches.assign(abs_delay=matches['delay'].abs())
+                   .sort_values('abs_delay', kind='stable')
+                   .drop_duplicates(subset=['real_time_index'])
+                   .drop_duplicates(subset=['id', 'stop_short_id']))
+
+        # Propagate observed delay to the next stops of each trip
+        shifted = window.astype({'arrival_time': 'datetime64[ns, UTC]'})
+        shifted = shifted.merge(matches[['id', 'stop_short_id', 'delay']], on=['id', 'stop_short_id'], how='left')
+        shifted = shifted.sort_values(['id', 'stop_sequence'])
+        shifted['delay'] = shifted.groupby('id')['delay'].ffill().fillna(pd.Timedelta(0))
+        shifted['arrival_time'] = shifted['arrival_time'] + shifted['delay']
+
+        # A smaller delay observed downstream must not move the train backwards
+        shifted['arrival_time'] = shifted.groupby('id')['arrival_time'].cummax()
+        return shifted.drop(columns=['delay']).reset_index(drop=True), matches
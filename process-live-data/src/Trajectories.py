@@ -0,0 +1,113 @@
+import numpy as np
+
+
+class Trajectories:
+    """Ragged arrays of (timestamp, x, y) samples for a set of trips.
+
+    Samples of trip k are stored in [offsets[k], offsets[k+1]) of the float64 arrays
+    timestamps, x and y. Timestamps are UNIX timestamps sorted within each trip.
+    """
+
+    __slots__ = ('timestamps', 'x', 'y', 'offsets')
+
+    def __init__(self, timestamps, x, y, offsets):
+        self.timestamps = np.ascontiguousarray(timestamps, dtype=np.float64)
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0), np.empty(0), np.empty(0), np.zeros(1, dtype=np.int64))
+
+    @classmethod
+    def from_arrays(cls, timestamps, coords):
+        """Build from a list of timestamp arrays and a list of (n, 2) coordinate arrays (one per trip)."""
+        if len(timestamps) == 0:
+            return cls.empty()
+
+        offsets = np.zeros(len(timestamps) + 1, dtype=np.int64)
+        np.cumsum([len(ts) for ts in timestamps], out=offsets[1:])
+        coords = np.concatenate(coords)
+        return cls(np.concatenate(timestamps), coords[:, 0], coords[:, 1], offsets)
+
+    @classmethod
+    def concatenate(cls, trajectories):
+        trajectories = [t for t in trajectories if len(t) > 0]
+        if len(trajectories) == 0:
+            return cls.empty()
+
+        # Shift offsets of each container by the number of samples before it
+        shifts = np.cumsum([0] + [t.n_samples for t in trajectories[:-1]])
+        offsets = np.concatenate([trajectories[0].offsets[:1]] +
+                                 [t.offsets[1:] - t.offsets[0] + shift for t, shift in zip(trajectories, shifts)])
+        return cls(np.concatenate([t.timestamps[t.offsets[0]:t.offsets[-1]] for t in trajectories]),
+                   np.concatenate([t.x[t.offsets[0]:t.offsets[-1]] for t in trajectories]),
+                   np.concatenate([t.y[t.offsets[0]:t.offsets[-1]] for t in trajectories]),
+                   offsets - offsets[0])
+
+    @property
+    def n_samples(self):
+        return int(self.offsets[-1] - self.offsets[0])
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        """Return trip samples (timestamps, x, y) for an int, or a new Trajectories for a slice or array of indices."""
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            start, end = self.offsets[key], self.offsets[key + 1]
+            return self.timestamps[start:end], self.x[start:end], self.y[start:end]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                # Contiguous trips: share memory with this container
+                offsets = self.offsets[start:max(start, stop) + 1]
+                start_sample, end_sample = offsets[0], offsets[-1]
+                return Trajectories(self.timestamps[start_sample:end_sample],
+                                    self.x[start_sample:end_sample],
+                                    self.y[start_sample:end_sample],
+                                    offsets - start_sample)
+            key = np.arange(start, stop, step)
+
+        # Fancy indexing (array of indices or boolean mask)
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        starts = self.offsets[key]
+        lengths = self.offsets[key + 1] - starts
+        offsets = np.zeros(len(key) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        samples = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return Trajectories(self.timestamps[samples], self.x[samples], self.y[samples], offsets)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __getstate__(self):
+        # Only pickle the samples referenced by offsets
+        start, end = self.offsets[0], self.offsets[-1]
+        return (self.timestamps[start:end], self.x[start:end], self.y[start:end], self.offsets - start)
+
+    def __setstate__(self, state):
+        self.timestamps, self.x, self.y, self.offsets = state
+
+    def memory_usage(self):
+        """Return memory used by the arrays in bytes."""
+        usage = {'timestamps': self.timestamps.nbytes,
+                 'x': self.x.nbytes,
+                 'y': self.y.nbytes,
+                 'offsets': self.offsets.nbytes}
+        usage['total'] = sum(usage.values())
+        return usage
+
+    def __repr__(self):
+        return f"Trajectories({len(self)} trips, {self.n_samples} samples, {self.memory_usage()['total']} bytes)"
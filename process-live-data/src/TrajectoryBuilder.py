@@ -0,0 +1,91 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.ShortestPathStore import ShortestPathStore
+from src.Trajectories import Trajectories
+
+
+class TrajectoryBuilder:
+    """Build trip trajectories of a line from stop arrival times and shortest paths between stops.
+
+    build() is meant to run in worker processes: inputs are flat arrays (one row per
+    trip stop), and each worker keeps its own ShortestPathStore created by init_worker(),
+    so lines should always be built by the same worker.
+    """
+
+    GROUPBY_FIELDS = ['id', 'line_short_id', 'name', 'destination_id']
+
+    # Shortest paths of the worker process
+    shortest_paths = None
+
+    @classmethod
+    def init_worker(cls, directory, max_memory):
+        cls.shortest_paths = ShortestPathStore(directory, max_memory=max_memory)
+
+    @classmethod
+    def prepare(cls, trips):
+        """Split trips dataframe into trip metadata and compact arguments of build()."""
+        groups = trips.groupby(cls.GROUPBY_FIELDS, sort=True)
+        trip_index = groups.ngroup().fillna(-1).to_numpy(dtype=np.int32)
+        metadata = groups.size().reset_index()[cls.GROUPBY_FIELDS]
+
+        # Rows with missing trip attributes have no group (NaN, then -1) and do not belong to any trip
+        valid = trip_index >= 0
+        arrival_times = (trips['arrival_time'] - pd.Timestamp(0, tz='UTC')).dt.total_seconds().to_numpy()
+        stop_codes, stop_ids = pd.factorize(trips['stop_short_id'].to_numpy()[valid])
+
+        args = (trips.iloc[0]['line_short_id'], trip_index[valid], arrival_times[valid],
+                stop_codes.astype(np.int32), np.asarray(stop_ids, dtype=object), len(metadata))
+        return metadata, args
+
+    @classmethod
+    def build(cls, line_short_id, trip_index, arrival_times, stop_codes, stop_ids, n_trips):
+        """Return (indices of trips with a path, Trajectories, missing stop pairs, CPU time in seconds)."""
+        start = time.process_time()
+
+        # Shortest paths database (indexed by pair of stops)
+        sp = cls.shortest_paths.get_line(line_short_id)
+
+        # Sort stops of each trip by arrival time and remove duplicates
+        order = np.lexsort((stop_codes, arrival_times, trip_index))
+        trip_index, arrival_times, stop_codes = trip_index[order], arrival_times[order], stop_codes[order]
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = ((trip_index[1:] != trip_index[:-1])
+                    | (arrival_times[1:] != arrival_times[:-1])
+                    | (stop_codes[1:] != stop_codes[:-1]))
+        trip_index, arrival_times, stop_codes = trip_index[keep], arrival_times[keep], stop_codes[keep]
+        bounds = np.searchsorted(trip_index, np.arange(n_trips + 1))
+
+        kept = []
+        timestamps_list = []
+        coords_list = []
+        missing = set()
+        for trip in range(n_trips):
+            timestamps = []
+            coords = []
+
+            # Build trip path for each pairs of consecutive stops
+            for i in range(bounds[trip], bounds[trip + 1] - 1):
+                if stop_codes[i] == stop_codes[i + 1]:
+                    continue
+
+                pair = (stop_ids[stop_codes[i]], stop_ids[stop_codes[i + 1]])
+                path = sp.get(pair)
+
+                if path is not None:
+                    # Compute timestamps for each point of the shortest path between A and B
+                    timestamps.append(np.linspace(arrival_times[i], arrival_times[i + 1], len(path)))
+                    coords.append(path)
+                else:
+                    missing.add(pair)
+
+            # Only keep trips with a path
+            if len(coords) > 0:
+                kept.append(trip)
+                timestamps_list.append(np.concatenate(timestamps))
+                coords_list.append(np.concatenate(coords))
+
+        trajectories = Trajectories.from_arrays(timestamps_list, coords_list)
+        return np.array(kept, dtype=np.int64), trajectories, sorted(missing), time.process_time() - start
@@ -0,0 +1,63 @@
+import heapq
+
+from src.SIRIParser import TripColumns
+
+
+class TripStateStore:
+    """Latest observation of each (trip id, stop short id) of a line, expired after ttl seconds.
+
+    Rows are kept as TripColumns tuples in a dict. A heap of (update_time, key) gives the
+    next entry to expire; entries updated since they were pushed are skipped when popped.
+    """
+
+    def __init__(self, ttl=7200):
+        self.ttl = ttl
+        self.rows = {}
+        self.expiry_heap = []
+        self.upserts = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def upsert(self, columns):
+        """Insert or update rows of TripColumns, keeping the latest update of each key."""
+        rows = self.rows
+        update_times = columns.update_time
+        for i, row in enumerate(zip(*(getattr(columns, k) for k in TripColumns.KEYS))):
+            key = (row[0], row[3])
+            previous = rows.get(key)
+            if previous is not None and (previous[2] > update_times[i] or previous == row):
+                continue
+            rows[key] = row
+            if previous is None or previous[2] != update_times[i]:
+                heapq.heappush(self.expiry_heap, (update_times[i], key))
+            self.upserts += 1
+
+    def expire(self, timestamp):
+        """Remove rows not updated since timestamp - ttl."""
+        limit = timestamp - self.ttl
+        heap = self.expiry_heap
+        while heap and heap[0][0] < limit:
+            update_time, key = heapq.heappop(heap)
+            row = self.rows.get(key)
+            # Only the heap item of the latest update of a row removes it
+            if row is not None and row[2] == update_time:
+                del self.rows[key]
+                self.evictions += 1
+
+    def to_columns(self):
+        columns = TripColumns()
+        if len(self.rows) > 0:
+            for k, values in zip(TripColumns.KEYS, zip(*self.rows.values())):
+                setattr(columns, k, list(values))
+        return columns
+
+    def to_dataframe(self):
+        return self.to_columns().to_dataframe()
+
+    def get_stats(self):
+        return {'live_entries': len(self.rows),
+                'heap_size': len(self.expiry_heap),
+                'upserts': self.upserts,
+                'evictions': self.evictions}
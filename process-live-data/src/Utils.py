@@ -9,6 +9,14 @@ class Utils:
     def compute_short_id(x):
         return x.rstrip(":").split(":")[-1]
 
+    @staticmethod
+    def group_indices(values):
+        """Return [(value, sorted indices of the rows with this value)] for each distinct value."""
+        uniques, inverse = np.unique(values, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(uniques) + 1))
+        return [(value, order[bounds[i]:bounds[i + 1]]) for i, value in enumerate(uniques.tolist())]
+
     @staticmethod
     def get_linestring_length_in_meters(line):
         # Distance in meter
@@ -0,0 +1,123 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from src.TimetableIndex import TimetableIndex
+
+# Tuesday
+SERVICE_DATE = datetime.date(2024, 3, 12)
+MIDNIGHT = pd.Timestamp('2024-03-12 00:00', tz='Europe/Paris').timestamp()
+
+
+def get_timetable():
+    # (trip_id, days, end_date, [(stop, arrival_time)])
+    trips = [
+        ('DAY', 'weekdays', '20241231', [('A', '23:50:00'), ('B', '24:10:00'), ('C', '25:00:00')]),
+        # Trip of the previous service day running after midnight
+        ('NIGHT', 'monday', '20241231', [('A', '23:00:00'), ('B', '24:20:00'), ('C', '24:40:00')]),
+        ('SUNDAY', 'sunday', '20241231', [('A', '10:00:00'), ('B', '10:10:00')]),
+        ('EXPIRED', 'weekdays', '20240301', [('A', '10:00:00'), ('B', '10:10:00')]),
+    ]
+    rows = []
+    for trip_id, days, end_date, stop_times in trips:
+        for sequence, (stop, arrival_time) in enumerate(stop_times):
+            row = {'trip_id': trip_id, 'stop_id': f"IDFM:{stop}", 'stop_sequence': sequence,
+                   'route_short_id': 'C00000', 'trip_headsign': 'C', 'arrival_time': arrival_time,
+                   'start_date': '20240101', 'end_date': end_date}
+            for i, weekday in enumerate(TimetableIndex.WEEKDAYS):
+                row[weekday] = int(days == weekday or (days == 'weekdays' and i < 5))
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def get_stop_times(window):
+    return sorted(zip(window['id'], window['stop_short_id']))
+
+
+def test_index_keeps_times_past_midnight():
+    index = TimetableIndex.from_dataframe(get_timetable(), SERVICE_DATE)
+
+    # GTFS times past 24:00 of the day are kept, those of the previous day (NIGHT, and DAY of Monday)
+    # are shifted by -24 h, and stop times of the previous day before 24:00 are dropped
+    assert index.arrival_seconds.tolist() == [600, 1200, 2400, 3600, 85800, 87000, 90000]
+    assert list(zip(index.rows['id'], index.rows['stop_short_id'])) == [
+        ('DAY', 'B'), ('NIGHT', 'B'), ('NIGHT', 'C'), ('DAY', 'C'), ('DAY', 'A'), ('DAY', 'B'), ('DAY', 'C')]
+    assert set(index.rows['destination_id']) == {'C'}
+
+
+def test_window_bounds_are_exclusive():
+    index = TimetableIndex.from_dataframe(get_timetable(), SERVICE_DATE)
+    timestamp = MIDNIGHT + 1320
+
+    # NIGHT arrives at B 120 s before timestamp and at C 1080 s after it
+    assert get_stop_times(index.get_window(timestamp, before=120, after=1080)) == []
+    assert get_stop_times(index.get_window(timestamp, before=121, after=1081)) == [('NIGHT', 'B'), ('NIGHT', 'C')]
+
+
+def test_window_arrival_times():
+    index = TimetableIndex.from_dataframe(get_timetable(), SERVICE_DATE)
+    window = index.get_window(MIDNIGHT + 86400, before=601, after=3601)
+
+    assert get_stop_times(window) == [('DAY', 'A'), ('DAY', 'B'), ('DAY', 'C')]
+    # 23:50 and 24:10 of the service day, 01:00 of the next day (Paris time, UTC+1)
+    assert window['arrival_time'].tolist() == [pd.Timestamp('2024-03-12 22:50', tz='UTC'),
+                                               pd.Timestamp('2024-03-12 23:10', tz='UTC'),
+                                               pd.Timestamp('2024-03-13 00:00', tz='UTC')]
+
+
+NOW = 1_700_000_000
+HEADWAY = 1080
+STOPS = ['S0', 'S1', 'S2', 'S3', 'S4']
+
+
+def get_window():
+    # Trips T1 and T2 calling at S0-S4 every 120 seconds, T1 being at S2 10 minutes ago
+    rows = []
+    for k, trip_id in enumerate(['T1', 'T2']):
+        for sequence, stop in enumerate(STOPS):
+            rows.append({'id': trip_id, 'name': '', 'stop_short_id': stop, 'stop_sequence': sequence,
+                         'line_short_id': 'C00000', 'destination_id': 'S4', 'destination_name': 'S4',
+                         'arrival_time': NOW - 600 + k * HEADWAY + (sequence - 2) * 120})
+    window = pd.DataFrame(rows)
+    # Same resolution as TimetableIndex.get_window
+    window['arrival_time'] = pd.to_datetime(window['arrival_time'].to_numpy(), unit='s', utc=True)
+    return window.astype({'arrival_time': 'datetime64[s, UTC]'})
+
+
+def get_real_time(arrivals):
+    # Same resolution as TripColumns.to_dataframe with sub-second arrival times
+    return pd.DataFrame({'stop_short_id': [stop for stop, t in arrivals],
+                         'destination_id': 'S4',
+                         'arrival_time': pd.to_datetime([t for stop, t in arrivals], unit='s', utc=True)})
+
+
+def get_arrivals(shifted, trip_id):
+    trip = shifted[shifted['id'] == trip_id].sort_values('stop_sequence')
+    return ((trip['arrival_time'] - pd.Timestamp(0, tz='UTC')).dt.total_seconds()).to_numpy()
+
+
+def test_late_train_matches_its_own_trip():
+    window = get_window()
+    real_time = get_real_time([('S2', NOW - 59.75)])
+    assert real_time['arrival_time'].dtype != window['arrival_time'].dtype
+
+    shifted, matches = TimetableIndex.apply_delays(window, real_time)
+
+    # Late T1 (540.25 s) and not T2, which is closer but would be 539.75 s early
+    assert matches['id'].tolist() == ['T1']
+    assert matches['delay'].iloc[0] == pd.Timedelta(seconds=540.25)
+    np.testing.assert_allclose(get_arrivals(shifted, 'T1')[2:], get_arrivals(get_window(), 'T1')[2:] + 540.25)
+    np.testing.assert_allclose(get_arrivals(shifted, 'T2'), get_arrivals(get_window(), 'T2'))
+
+
+def test_arrival_times_never_decrease_along_trip():
+    window = get_window()
+    # Late T1 at S2, then a real-time arrival at S3 matching T1 with a smaller delay
+    real_time = get_real_time([('S2', NOW - 60), ('S3', NOW - 420)])
+
+    shifted, matches = TimetableIndex.apply_delays(window, real_time)
+
+    assert sorted(matches['id']) == ['T1', 'T1']
+    for trip_id in ['T1', 'T2']:
+        assert np.all(np.diff(get_arrivals(shifted, trip_id)) >= 0)